@@ -0,0 +1,124 @@
+import numpy as np
+
+# Compute backends for the per-frame binning kernel of IntegrationEngine.integrate
+# Every backend adds one detector frame into running per-bin accumulators: the sum of monitor normalized intensities,
+# the number of pixels and the sum of squared intensities. Dead pixels (negative counts) are skipped and pixels whose
+# bin is past the end of the accumulators (the overflow bin beyond 180 degrees) are dropped.
+# In the same pass each backend counts the frame's raw totals for the per-frame ledger and returns them as
+# (total counts of live pixels, dead pixels, pixels at or above the saturation level).
+# weights, when given, are the per-pixel intensity corrections of IntegrationEngine.get_pixel_weights, multiplied into
+# the normalized intensity of each pixel in the same pass.
+
+SATURATION_LEVEL = 1048575  # largest count of the Pilatus 20 bit pixel counter
+
+
+def frame_summary(raw, saturation=SATURATION_LEVEL):
+    """Ledger totals of a frame's unmasked raw counts, the same numbers every backend returns from accumulate."""
+    live = raw >= 0
+    return int(raw[live].sum(dtype=np.int64)), int(len(raw) - live.sum()), int((raw >= saturation).sum())
+
+
+class NumpyBackend:
+    """Reference backend, bincount passes over the frame with numpy temporaries."""
+    name = 'numpy'
+    bytes_per_pixel = 48  # temporaries per pixel, integrate streams frames through in blocks that fit its memory budget
+
+    def accumulate(self, frame, pix_index, bins, i0, sums, counts, sumsq=None, saturation=SATURATION_LEVEL, weights=None):
+        nbins = len(sums)
+        raw = frame[pix_index]
+        y = raw/i0
+        if weights is not None:
+            y *= weights
+        y_1 = (y >= 0).astype(float)
+        y_0 = y*y_1
+        sums += np.bincount(bins, weights=y_0, minlength=nbins + 1)[:nbins]
+        counts += np.bincount(bins, weights=y_1, minlength=nbins + 1)[:nbins]
+        if sumsq is not None:
+            sumsq += np.bincount(bins, weights=y_0*y, minlength=nbins + 1)[:nbins]
+        return frame_summary(raw, saturation)
+
+
+def _compile_fused_kernel():
+    import numba
+
+    @numba.njit(nogil=True, cache=True)
+    def fused_kernel(frame, pix_index, bins, i0, sums, counts, sumsq, saturation, weights, weighted):
+        # One pass over the unmasked pixels: read, normalize, accumulate and count the ledger totals, no temporaries
+        nbins = sums.shape[0]
+        total = 0
+        dead = 0
+        saturated = 0
+        for j in range(pix_index.shape[0]):
+            value = frame[pix_index[j]]
+            if value < 0:
+                dead += 1
+                continue
+            total += value
+            if value >= saturation:
+                saturated += 1
+            b = bins[j]
+            if b >= nbins:
+                continue
+            y = value/i0
+            if weighted:
+                y *= weights[j]
+            sums[b] += y
+            counts[b] += 1.0
+            sumsq[b] += y*y
+        return total, dead, saturated
+
+    return fused_kernel
+
+
+class NumbaBackend:
+    """JIT compiled backend, one fused loop over the pixels of a frame (needs the optional numba package)."""
+    name = 'numba'
+    bytes_per_pixel = 0  # no temporaries, a whole frame is one block
+
+    def __init__(self):
+        self.kernel = _compile_fused_kernel()
+        self._scratch = np.zeros(0)
+        self._no_weights = np.ones(1)  # stands in for the weights array when there are no corrections
+        # Compile now for the argument types integrate uses (int32 frames, intp pixel indices, int32 bins), so a failure
+        # falls back at selection time instead of in the middle of a scan
+        self.kernel(np.zeros(1, np.int32), np.zeros(1, np.intp), np.zeros(1, np.int32), 1.0,
+                    np.zeros(1), np.zeros(1), np.zeros(1), SATURATION_LEVEL, self._no_weights, False)
+
+    def accumulate(self, frame, pix_index, bins, i0, sums, counts, sumsq=None, saturation=SATURATION_LEVEL, weights=None):
+        if sumsq is None:
+            if len(self._scratch) != len(sums):
+                self._scratch = np.zeros(len(sums))
+            sumsq = self._scratch  # the kernel always accumulates it, the result is simply not used
+        weighted = weights is not None
+        total, dead, saturated = self.kernel(frame, pix_index, bins, float(i0), sums, counts, sumsq, int(saturation),
+                                             weights if weighted else self._no_weights, weighted)
+        return int(total), int(dead), int(saturated)
+
+
+BACKENDS = {'numpy': NumpyBackend, 'numba': NumbaBackend}
+_instances = {}  # one instance per backend name, None once it has failed to load
+_errors = {}
+_reported = set()
+
+
+def get_backend(name='auto'):
+    """Return the backend called name ('auto' picks numba when it can be used), falling back on numpy.
+
+    The fallback is silent for 'auto' and reported once on the console when a missing backend was asked for by name.
+    """
+    if name != 'auto' and name not in BACKENDS:
+        raise ValueError(f"Unknown compute backend {name}")
+    candidates = ['numba', 'numpy'] if name == 'auto' else [name, 'numpy']
+    for candidate in candidates:
+        if candidate not in _instances:
+            try:
+                _instances[candidate] = BACKENDS[candidate]()
+            except Exception as e:  # not installed (ImportError) or failed to compile, remember and fall back
+                _instances[candidate] = None
+                _errors[candidate] = str(e)
+        if _instances[candidate] is not None:
+            return _instances[candidate]
+        if candidate == name and name not in _reported:
+            _reported.add(name)
+            print(f"Compute backend '{name}' is not available ({_errors[name]}), using numpy")
+    raise RuntimeError("No compute backend could be loaded")
@@ -0,0 +1,398 @@
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import contextlib
+import math
+import numpy as np
+import Integration_engine as engine
+import Integration_backends
+
+# Conformance harness for the accelerated integration paths (compute backends, stacked mode, worker processes, sweeps)
+#
+#   python Integration_conformance.py freeze DIR   writes synthetic scans into DIR and freezes the reference engine
+#                                                  path's output for every case as the golden result
+#   python Integration_conformance.py check DIR    runs every registered mode on the same scans, compares x/y/e with
+#                                                  the frozen results within each mode's tolerances and times it
+#                                                  against the reference path; exits non-zero on any divergence
+#
+# The reference path is plain IntegrationEngine.integrate/integrate_var with the numpy backend, one process and no
+# stacking. It is itself checked against the frozen results, so changes to the engine show up too.
+#
+# The frozen results come from whatever engine ran freeze, so a regression it shares with every fast path would be
+# frozen in as well. The plain cases are therefore also checked against a standalone copy of the engine's original
+# integration that uses none of the engine's code paths: baseline_poisson, the whole-frame histogram integration, for
+# the Poisson error model and baseline_azimuthal, the per-bin mean and variance, for the azimuthal one.
+# A mode is only run on the cases whose settings actually take its path, on the others it is reported as n/a.
+
+USER = 'conformance'
+SPEC_NAME = 'conformance.spec'
+CALIBRATION = ([243.5, 97.25], 1000.0)  # direct beam pixel (x, y) and detector distance in pixels
+RINGS = [(8.3, 0.06, 900.0), (11.7, 0.08, 400.0), (14.2, 0.07, 1500.0), (17.9, 0.09, 250.0), (21.5, 0.08, 700.0),
+         (24.0, 0.10, 350.0), (28.3, 0.10, 500.0)]  # (2-theta, FWHM, peak counts) of the synthetic powder rings
+
+# Scans written by make_scans as (scan number, first 2-theta, last 2-theta, frames); scan 2 holds the detector still
+SCANS = [(1, 5.0, 25.0, 12), (2, 12.0, 12.0, 6)]
+
+BASE_SETTINGS = {'min_tth': 0.5, 'max_tth': 180.0, 'stepsize': '0.02', 'img_clip_low': 20, 'img_clip_high': 467,
+                 'error_model': 'poisson', 'backend': 'numpy', 'stacked': False, 'processes': 1}
+
+# Cases frozen by freeze, each a scan and the settings it is integrated with (on top of BASE_SETTINGS)
+CASES = {'poisson': (1, {}),
+         'azimuthal': (1, {'error_model': 'azimuthal'}),
+         'sigma_clip': (1, {'outlier_rejection': 'sigma', 'outlier_threshold': 5.0}),
+         'mad_clip': (1, {'outlier_rejection': 'mad', 'outlier_threshold': 5.0}),
+         'split': (1, {'integration_method': 'split'}),
+         'corrected': (1, {'solid_angle_correction': True, 'polarization_correction': True}),
+         'static': (2, {}),
+         'coarse': (1, {'stepsize': '0.1', 'img_clip_low': 60, 'img_clip_high': 420})}
+
+DEFAULT_TOLERANCE = {'x': (0.0, 0.0), 'y': (1e-9, 1e-12), 'e': (1e-9, 1e-12)}  # (rtol, atol) of each output column
+BASELINE = 'baseline'  # report name of the check of the frozen results against baseline_poisson/baseline_azimuthal
+
+
+def _integrate(integrator, spec, image_path, scan_num, xyz_map, settings):
+    # Runner of the reference path and of every mode that only changes settings
+    if settings.get('error_model', 'poisson') == 'azimuthal':
+        return integrator.integrate_var(spec, scan_num, image_path, USER, xyz_map, settings)[1:]
+    return integrator.integrate(spec, scan_num, image_path, USER, xyz_map, settings)[1:]
+
+
+def _sweep(integrator, spec, image_path, scan_num, xyz_map, settings):
+    # A one-configuration settings sweep, which bins from the shared per-frame 2-theta of IntegrationEngine.sweep
+    return integrator.sweep(spec, scan_num, image_path, USER, xyz_map, [settings])[0][1:]
+
+
+def _merge(integrator, spec, image_path, scan_num, xyz_map, settings):
+    # A merge of the scan with itself halves nothing but goes through merge_scans' accumulator arithmetic
+    use_variance = settings.get('error_model', 'poisson') == 'azimuthal'
+    return integrator.merge_scans(spec, [scan_num], image_path, USER, xyz_map, settings, use_variance)[1:]
+
+
+def _numba_available():
+    return Integration_backends.get_backend('auto').name == 'numba'
+
+
+# Which of IntegrationEngine.integrate's paths a case's settings take, the same tests integrate makes
+def _poisson(settings):
+    return settings.get('error_model', 'poisson') == 'poisson'
+
+
+def _pooled(settings):
+    # worker processes do plain binning, optionally outlier clipped
+    return (_poisson(settings) and settings.get('integration_method', 'histogram') != 'split'
+            and not settings.get('caked', False))
+
+
+def _fused(settings):
+    # the compute backend and stacked mode do plain binning only
+    return _pooled(settings) and settings.get('outlier_rejection', 'none') == 'none'
+
+
+def _plain(settings):
+    # what baseline_poisson can reproduce: no outlier rejection, corrections, background or mask
+    return (_fused(settings) and engine.correction_key(settings) is None and not settings.get('background_scan')
+            and not settings.get('mask_file'))
+
+
+def _plain_azimuthal(settings):
+    # what baseline_azimuthal can reproduce: the same, for integrate_var without caking
+    return (settings.get('error_model', 'poisson') == 'azimuthal' and settings.get('outlier_rejection', 'none') == 'none'
+            and not settings.get('caked', False) and engine.correction_key(settings) is None
+            and not settings.get('background_scan') and not settings.get('mask_file'))
+
+
+def _baseline(settings):
+    # The baseline a case's frozen result is checked against, None when neither reproduces its settings
+    if _plain(settings):
+        return baseline_poisson
+    if _plain_azimuthal(settings):
+        return baseline_azimuthal
+    return None
+
+
+# Registered modes: name -> settings overrides, runner, tolerances, availability and applicability checks
+MODES = {}
+
+
+def register_mode(name, settings=None, runner=None, tolerance=None, available=None, applies=None):
+    """Add a fast path to the harness: settings laid over each case's, an optional runner in place of integrate or
+    integrate_var returning (x, y, e), per-column (rtol, atol), a check that the path exists here, and
+    applies(settings), true for the case settings that actually take the path (the rest are reported n/a)."""
+    MODES[name] = {'settings': dict(settings or {}), 'runner': runner or _integrate,
+                   'tolerance': dict(DEFAULT_TOLERANCE, **(tolerance or {})), 'available': available,
+                   'applies': applies}
+
+
+register_mode('reference')
+register_mode('numba', {'backend': 'numba'}, available=_numba_available, applies=_fused)
+register_mode('stacked', {'stacked': True}, applies=_fused)
+register_mode('processes', {'processes': 2}, applies=_pooled)
+register_mode('sweep', runner=_sweep, applies=_poisson)
+register_mode('merge', runner=_merge)
+
+
+def _baseline_frames(directory, scan_num, settings):
+    # (2-theta, I0 normalised intensity) of every pixel of every frame of a scan, clipped columns set to -2 like
+    # read_RAW does, computed from the files alone; yields the scan's first I0 ahead of the frames
+    lowclip, highclip = int(settings['img_clip_low']), int(settings['img_clip_high'])
+    tth, i0 = engine.SPECread(os.path.join(directory, SPEC_NAME), scan_num)
+    yield float(i0[0])
+    db_pixel, det_R = engine.Read_Cal(os.path.join(directory, 'conformance.cal'))
+    shape = engine.DEFAULT_SHAPE
+    rows, cols = np.unravel_index(np.arange(shape[0]*shape[1]), shape)
+    xyz_map = np.vstack((rows - db_pixel[1], cols - db_pixel[0], np.full(len(rows), det_R)))
+    for k in range(0, len(tth)):
+        filename = os.path.join(directory, 'images', f"{USER}_{SPEC_NAME}_scan{scan_num}_{str(k).zfill(4)}.raw")
+        data = np.fromfile(filename, dtype=np.int32).reshape(shape).astype(float)
+        data[:, :lowclip] = -2.0
+        data[:, highclip:] = -2.0
+        angle = np.radians(tth[k])
+        rotated = np.array([[1.0, 0.0, 0.0], [0.0, np.cos(angle), np.sin(angle)],
+                            [0.0, -np.sin(angle), np.cos(angle)]]) @ xyz_map
+        x = np.degrees(np.arctan(np.sqrt((rotated[:2]**2).sum(axis=0))/rotated[2])) % 180.0
+        yield x, data.ravel()/i0[k]
+
+
+def baseline_poisson(directory, scan_num, settings):
+    """(x, y, e) of a scan by the engine's original Poisson integration: every pixel of every frame is histogrammed
+    from its own rotated coordinates, then spline interpolated onto rounded bin positions. Only the file readers are
+    shared with the engine, so it stays an independent check on the frozen results of the plain cases."""
+    from scipy import interpolate
+    stepsize = float(settings['stepsize'])
+    frames = _baseline_frames(directory, scan_num, settings)
+    mult = next(frames)
+    bins = np.arange(0.0, 180.0, stepsize)
+    nbins = int(math.ceil(180.0/stepsize))
+    digit_y = np.zeros_like(bins)
+    digit_norm = np.zeros_like(bins)
+    for x, y in frames:
+        digit_y += np.histogram(x + stepsize, weights=np.where(y < 0, 0.0, y), range=(0, 180), bins=nbins)[0]
+        digit_norm += np.histogram(x + stepsize, weights=np.where(y < 0, 0.0, 1.0), range=(0, 180), bins=nbins)[0]
+    nonzeros = np.nonzero(digit_norm)
+    interp = interpolate.InterpolatedUnivariateSpline(bins[nonzeros], digit_y[nonzeros]/digit_norm[nonzeros])
+    interpbins = np.around(np.arange(min(bins[nonzeros]), max(bins[nonzeros]), stepsize), decimals=3)
+    interpy = mult*interp(interpbins)
+    good = (interpbins >= float(settings['min_tth'])) & (interpbins <= float(settings['max_tth']))
+    return interpbins[good], interpy[good], np.sqrt(np.abs(interpy[good]))
+
+
+def baseline_azimuthal(directory, scan_num, settings):
+    """(x, y, e) of a scan by the engine's original azimuthal integration: the mean and sample variance of the
+    non-negative pixels digitize puts in each bin, over the whole scan at once. The mean and the squared deviations
+    from it are summed over all pixels with np.add.at rather than folded per frame, so it checks the engine's
+    per-block moments without sharing their arithmetic. Like the original, the output keeps the first bins, as many
+    as the rounded bin positions inside min_tth..max_tth, and e is the variance."""
+    stepsize = float(settings['stepsize'])
+    frames = _baseline_frames(directory, scan_num, settings)
+    mult = next(frames)
+    bins = np.arange(0.0, 180.0, stepsize)
+    indices = []
+    values = []
+    for x, y in frames:
+        index = np.digitize(x, bins)
+        keep = (y >= 0) & (index < len(bins))
+        indices.append(index[keep])
+        values.append(y[keep])
+    index = np.concatenate(indices)
+    y = np.concatenate(values)
+    n = np.zeros(len(bins))
+    total = np.zeros(len(bins))
+    np.add.at(n, index, 1.0)
+    np.add.at(total, index, y)
+    mean = np.zeros(len(bins))
+    mean[n > 0] = total[n > 0]/n[n > 0]
+    M2 = np.zeros(len(bins))
+    np.add.at(M2, index, (y - mean[index])**2)
+    variance = np.full(len(bins), np.nan)
+    variance[n >= 2] = M2[n >= 2]/(n[n >= 2] - 1)
+    nonzeros = np.nonzero(mean)
+    interpbins = np.around(np.arange(min(bins[nonzeros]), max(bins[nonzeros]), stepsize), decimals=3)
+    good = np.nonzero((interpbins >= float(settings['min_tth'])) & (interpbins <= float(settings['max_tth'])))
+    return bins[good], mult*mean[good], mult*variance[good]
+
+
+def make_scans(directory, seed=0):
+    """Write the synthetic SPEC file, calibration and frames of SCANS into directory.
+
+    Frames are Poisson counts of a few powder rings on a sloping background, with a fixed set of dead pixels and a
+    few zingers per frame so outlier rejection has something to do.
+    """
+    rng = np.random.default_rng(seed)
+    shape = engine.DEFAULT_SHAPE
+    image_path = os.path.join(directory, 'images')
+    os.makedirs(image_path, exist_ok=True)
+    engine.write_calibration(os.path.join(directory, 'conformance.cal'), *CALIBRATION)
+    xyz_map = engine.make_map(*CALIBRATION, shape)
+    dead = rng.choice(shape[0]*shape[1], size=shape[0]*shape[1]//1000, replace=False)
+    with open(os.path.join(directory, SPEC_NAME), 'w') as spec:
+        spec.write(f"#F {SPEC_NAME}\n#C User = {USER}\n#O0 tth th chi\n")
+        for scan_num, first, last, frames in SCANS:
+            spec.write(f"\n#S {scan_num} ascan tth {first:g} {last:g} {frames - 1} 1\n#P0 {first:.4f} 0.0 0.0\n"
+                       "#L tth Epoch Monitor Detector\n")
+            for k, tth in enumerate(np.linspace(first, last, frames)):
+                monitor = 100000.0*(1.0 + 0.05*np.sin(k))
+                pixel_tth = engine.cart2tth(engine.rotate_operation(xyz_map, tth))
+                expected = 30.0 + 20.0*np.exp(-pixel_tth/15.0)
+                for center, fwhm, height in RINGS:
+                    expected += height*np.exp(-4.0*np.log(2.0)*((pixel_tth - center)/fwhm)**2)
+                counts = rng.poisson(expected*monitor/100000.0).astype(np.int32)
+                counts[dead] = -1
+                counts[rng.choice(len(counts), size=3, replace=False)] = 50000  # zingers
+                counts.reshape(shape).tofile(os.path.join(image_path, f"{USER}_{SPEC_NAME}_scan{scan_num}_{str(k).zfill(4)}.raw"))
+                spec.write(f"{tth:.4f} {k} {monitor:.0f} 0\n")
+
+
+def _run(mode, directory, case, repeat=1):
+    # Integrate one case with one mode on a fresh engine, returns ((x, y, e), best time of repeat runs)
+    scan_num, overrides = CASES[case]
+    settings = dict(BASE_SETTINGS, **overrides)
+    settings.update(mode['settings'])
+    xyz_map = engine.make_map(*engine.Read_Cal(os.path.join(directory, 'conformance.cal')), engine.detector_shape(settings))
+    integrator = engine.IntegrationEngine()
+    best = None
+    result = None
+    try:
+        for _ in range(0, repeat):  # later repeats run from warm geometry caches, like the second scan of a session
+            integrator._accumulator_cache.clear()  # but every repeat bins its frames again, merge_scans included
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):  # the engine prints timings of its own
+                result = mode['runner'](integrator, os.path.join(directory, SPEC_NAME), os.path.join(directory, 'images'),
+                                        scan_num, xyz_map, settings)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        integrator.close()
+    return result, best
+
+
+def freeze(directory, seed=0):
+    """Generate the synthetic scans and store the reference path's output for every case as the golden results."""
+    make_scans(directory, seed)
+    arrays = {}
+    manifest = {'seed': seed, 'created': time.strftime("%Y-%m-%d %H:%M:%S"), 'base_settings': BASE_SETTINGS,
+                'cases': {}}
+    for case, (scan_num, overrides) in CASES.items():
+        (x, y, e), elapsed = _run(MODES['reference'], directory, case)
+        arrays[case + '_x'], arrays[case + '_y'], arrays[case + '_e'] = x, y, e
+        manifest['cases'][case] = {'scan': scan_num, 'settings': overrides, 'points': len(x), 'seconds': elapsed}
+        print(f"froze {case}: {len(x)} points")
+        settings = dict(BASE_SETTINGS, **overrides)
+        baseline = _baseline(settings)
+        if baseline is not None:
+            report = compare((x, y, e), baseline(directory, scan_num, settings), DEFAULT_TOLERANCE)
+            if not all(passed for _, _, passed in report.values()):
+                print(f"warning: the engine's {case} result differs from {baseline.__name__}, it is frozen as it is")
+    np.savez_compressed(os.path.join(directory, 'reference.npz'), **arrays)
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def compare(frozen, result, tolerance):
+    """Per column (max absolute difference, max relative difference, within tolerance) of a result against the
+    frozen (x, y, e); NaNs have to match, and a column of the wrong length never passes."""
+    report = {}
+    for column, expected, actual in zip('xye', frozen, result):
+        expected = np.asarray(expected)
+        actual = np.asarray(actual)
+        if expected.shape != actual.shape:
+            report[column] = (np.inf, np.inf, False)
+            continue
+        rtol, atol = tolerance[column]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            difference = np.abs(actual - expected)
+            relative = difference/np.abs(expected)
+        finite = np.isfinite(difference)
+        same_nan = np.array_equal(np.isnan(expected), np.isnan(actual))
+        passed = same_nan and bool(np.all(difference[finite] <= atol + rtol*np.abs(expected[finite])))
+        report[column] = (float(difference[finite].max(initial=0.0)),
+                          float(relative[finite & np.isfinite(relative)].max(initial=0.0)), passed)
+    return report
+
+
+def check(directory, modes=None, repeat=2):
+    """Run the registered modes against the frozen results and print a divergence and speed report.
+
+    Returns a list of (case, mode, status, report, seconds, reference seconds); status is 'ok', 'DIVERGES',
+    'n/a' (the case's settings do not take the mode's path) or 'skipped' (the mode is not available here).
+    The 'baseline' rows compare the frozen results of the plain cases with baseline_poisson or baseline_azimuthal.
+    """
+    reference = np.load(os.path.join(directory, 'reference.npz'))
+    names = modes or [BASELINE] + list(MODES)
+    rows = []
+    for case in CASES:
+        if case + '_x' not in reference.files:
+            print(f"{case}: not frozen, run freeze again")
+            continue
+        frozen = tuple(reference[case + '_' + column] for column in 'xye')
+        scan_num, overrides = CASES[case]
+        settings = dict(BASE_SETTINGS, **overrides)
+        _, reference_seconds = _run(MODES['reference'], directory, case, repeat)
+        for name in names:
+            mode = MODES.get(name)
+            if name == BASELINE:
+                applies = _baseline(settings) is not None
+            else:
+                applies = mode['applies'] is None or mode['applies'](dict(settings, **mode['settings']))
+            if not applies:
+                rows.append((case, name, 'n/a', None, None, reference_seconds))
+                continue
+            if mode is not None and mode['available'] is not None and not mode['available']():
+                rows.append((case, name, 'skipped', None, None, reference_seconds))
+                continue
+            try:
+                if name == BASELINE:
+                    start = time.perf_counter()
+                    result = _baseline(settings)(directory, scan_num, settings)
+                    seconds = time.perf_counter() - start
+                else:
+                    result, seconds = _run(mode, directory, case, repeat)
+            except Exception as e:
+                rows.append((case, name, f"FAILED: {e}", None, None, reference_seconds))
+                continue
+            report = compare(frozen, result, DEFAULT_TOLERANCE if mode is None else mode['tolerance'])
+            status = 'ok' if all(passed for _, _, passed in report.values()) else 'DIVERGES'
+            rows.append((case, name, status, report, seconds, reference_seconds))
+    print_report(rows)
+    return rows
+
+
+def print_report(rows):
+    print(f"{'case':<12}{'mode':<11}{'status':<10}{'max |dy|':>11}{'max rel dy':>12}{'max |de|':>11}"
+          f"{'seconds':>10}{'speedup':>10}")
+    for case, name, status, report, seconds, reference_seconds in rows:
+        line = f"{case:<12}{name:<11}{status:<10}"
+        if report is not None:
+            line += f"{report['y'][0]:>11.2e}{report['y'][1]:>12.2e}{report['e'][0]:>11.2e}"
+            if not report['x'][2]:
+                line += "  x differs"
+        else:
+            line += " "*34
+        if report is not None and seconds and reference_seconds:
+            line += f"{seconds:>10.3f}{reference_seconds/seconds:>9.2f}x"
+        print(line.rstrip())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Golden-output conformance harness for the integration fast paths")
+    parser.add_argument('command', choices=['freeze', 'check'])
+    parser.add_argument('directory', help="fixture directory (synthetic scans and frozen results)")
+    parser.add_argument('--modes', nargs='*', default=None,
+                        help=f"modes to check, from {', '.join([BASELINE] + list(MODES))}")
+    parser.add_argument('--repeat', type=int, default=2, help="runs per mode, the best time is reported")
+    parser.add_argument('--seed', type=int, default=0, help="random seed of the synthetic scans (freeze)")
+    args = parser.parse_args()
+    if args.command == 'freeze':
+        freeze(args.directory, args.seed)
+        return 0
+    unknown = [name for name in args.modes or [] if name not in MODES and name != BASELINE]
+    if unknown:
+        parser.error(f"unknown modes {', '.join(unknown)}")
+    rows = check(args.directory, args.modes, args.repeat)
+    return 1 if any(status not in ('ok', 'n/a', 'skipped') for _, _, status, _, _, _ in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,9 @@
-from PyQt5.QtCore import QThread, pyqtSignal  # may not need this
 import numpy as np
-from scipy.optimize import curve_fit
-import scipy.interpolate as interpolate
+# scipy is imported inside the functions that use it so that importing the engine (and starting the GUI) stays fast
 import math
 import os
 import time  # used only for benchmarking purposes in how fast variance calculations are
+import Integration_backends
 from typing import Optional, Callable  # For type hints on progress_callback
 
 
@@ -35,25 +34,96 @@ class RunningStats:  # used to calculate the variance using Welford's algorithm
         if self.n < 2:
             return float('nan')  # Variance is undefined for n < 2
         return self.M2 / self.n
+
+# Detector formats as (rows, columns) of the int32 .raw frames, picked with the 'detector' setting
+# Any other format can be given as a 'rows x columns' string
+DETECTORS = {'Pilatus 100K': (195, 487),
+             'Pilatus 300K': (619, 487),
+             'Pilatus 300K-W': (195, 1475),
+             'Pilatus 1M': (1043, 981),
+             'Pilatus 2M': (1679, 1475),
+             'Eiger 1M': (1065, 1030),
+             'Eiger 4M': (2167, 2070)}
+DEFAULT_DETECTOR = 'Pilatus 100K'
+DEFAULT_SHAPE = DETECTORS[DEFAULT_DETECTOR]
+
+# Per-pixel work (geometry, binning) is done in blocks of pixels small enough that the temporaries of one block stay
+# within the 'memory_budget' setting (megabytes), so peak memory does not grow with the size of the detector
+DEFAULT_MEMORY_BUDGET = 256
+GEOMETRY_BYTES_PER_PIXEL = 160  # rotated coordinates, 2-theta and bin index temporaries of one pixel
+SPLIT_BYTES_PER_PIXEL = 5*GEOMETRY_BYTES_PER_PIXEL  # the same for a pixel's center and four corners
+STACKED_BYTES_PER_PIXEL = 48  # counts, combined bin index and intensity temporaries of one pixel of a stacked frame
+
+DEFAULT_POLARIZATION_FRACTION = 0.95  # part of the beam polarized perpendicular to the scattering plane
+
+def detector_shape(settings):
+    # (rows, columns) of the detector named in the settings, either a DETECTORS entry or a 'rows x columns' string
+    name = settings.get('detector', DEFAULT_DETECTOR)
+    if name in DETECTORS:
+        return DETECTORS[name]
+    try:
+        rows, cols = (int(n) for n in name.lower().replace('x', ' ').split())
+    except ValueError:
+        raise ValueError(f"Unknown detector {name}, give one of {', '.join(DETECTORS)} or 'rows x columns'")
+    return rows, cols
+
+def pixel_blocks(npixels, bytes_per_pixel, budget=DEFAULT_MEMORY_BUDGET):
+    # Slices splitting npixels into blocks whose per-pixel temporaries fit in budget megabytes (one block when free)
+    if bytes_per_pixel <= 0:
+        return [slice(0, npixels)]
+    size = max(int(budget*2**20)//bytes_per_pixel, 1)
+    return [slice(start, min(start + size, npixels)) for start in range(0, max(npixels, 1), size)]
     
-def read_RAW(file, minx, maxx, mask = True):
+def read_RAW(file, minx, maxx, mask = True, shape=DEFAULT_SHAPE):
     ##print "Reading RAW file here..."
     try:
-        im = open(file, 'rb')
-        arr = np.fromstring(im.read(), dtype='int32')
-        im.close()
-        arr.shape = (195, 487)
+        arr = np.fromfile(file, dtype='int32')
+        arr.shape = shape
         #arr = np.fliplr(arr)               # for the way mounted at BL2-1
         if mask:
-            for i in range(0, minx):
-                arr[:,i] = -2.0
-            for i in range(maxx, 487):
-                arr[:,i] = -2.0
+            arr[:, :minx] = -2
+            arr[:, maxx:] = -2
         return arr
     except:
         print("Error reading file: %s" % file)
         return None
 
+def read_mask(filename, shape=DEFAULT_SHAPE):
+    # Read a static detector mask (bad pixels, module gaps, beamstop shadow), any nonzero value marks a masked pixel
+    # Accepts a .npy array, a .raw image in the same int32 format as the detector frames, or a whitespace delimited text grid
+    if filename.endswith('.npy'):
+        mask = np.load(filename)
+    elif filename.endswith('.raw'):
+        mask = np.fromfile(filename, dtype='int32')
+        mask.shape = shape
+    else:
+        mask = np.loadtxt(filename)
+    if mask.shape != tuple(shape):
+        raise ValueError(f"Mask {filename} has shape {mask.shape}, expected {tuple(shape)}")
+    return mask != 0
+
+def read_flat_field(filename, shape=DEFAULT_SHAPE):
+    # Read a flat field (relative pixel efficiency), in any of the formats read_mask accepts
+    if filename.endswith('.npy'):
+        flat = np.load(filename)
+    elif filename.endswith('.raw'):
+        flat = np.fromfile(filename, dtype='int32')
+        flat.shape = shape
+    else:
+        flat = np.loadtxt(filename)
+    if flat.shape != tuple(shape):
+        raise ValueError(f"Flat field {filename} has shape {flat.shape}, expected {tuple(shape)}")
+    return flat.astype(float)
+
+def make_pixel_mask(minx, maxx, bad_pixels=None, shape=DEFAULT_SHAPE):
+    # Combine the column clip range with an optional static bad pixel mask into one boolean map (True = pixel is used)
+    valid = np.ones(shape, dtype=bool)
+    valid[:, :minx] = False
+    valid[:, maxx:] = False
+    if bad_pixels is not None:
+        valid &= ~bad_pixels
+    return valid
+
 def SPECread(filename, scan_number):
     #print "Reading SPEC file here..."
     tth = []
@@ -105,9 +175,9 @@ def SPECread(filename, scan_number):
 def Read_Cal(filename):
     cal = open(filename)
     line = cal.readline()
-    db_x = int(line.split()[-1])
+    db_x = float(line.split()[-1])  # refined calibrations give the direct beam to a fraction of a pixel
     line = cal.readline()
-    db_y = int(line.split()[-1])
+    db_y = float(line.split()[-1])
     line = cal.readline()
     det_R = float(line.split()[-1])
     cal.close()
@@ -115,13 +185,11 @@ def Read_Cal(filename):
     #db_pixel = [487-db_x, db_y]  #This line is important for the way the detector is mounted at BL2-1
     return db_pixel, det_R
 
-def make_map(db_pixel, det_R):
+def make_map(db_pixel, det_R, shape=DEFAULT_SHAPE):
     # Map each pixel into cartesian coordinates (x,y,z) in number of pixels from sample for direct beam conditions (2-theta = 0)
     # We only need to do this once, so we can be inefficient about it
     #filename = image_path + user + spec_name + "_scan" + str(scan_number) + "_" + str(0).zfill(4) + ".raw"
-    data = np.zeros((195, 487))
-    
-    tup = np.unravel_index(np.arange(len(data.flatten())), data.shape)
+    tup = np.unravel_index(np.arange(shape[0]*shape[1]), shape)
     xyz_map = np.vstack((tup[0], tup[1], det_R*np.ones(tup[0].shape)))
     xyz_map -= [[db_pixel[1]], 
                 [db_pixel[0]], 
@@ -141,23 +209,843 @@ def rotate_operation(map, tth):
     xyz_map_prime = np.matmul(rot_op, map)
     return xyz_map_prime
         
-def cart2sphere(map):
+def cart2tth(map):
+    # Convert a rotated cartesian coordinate map (any number of pixels) to a flat array of 2-theta values
+    _r = np.sqrt((map[:2,:]**2).sum(axis=0))
+    tth = np.arctan(_r/map[2, :])*180.0/np.pi
+    return tth%180.0
+
+def cart2chi(map):
+    # Azimuthal angle (chi, degrees from -180 to 180) of every pixel around the direct beam in a rotated cartesian coordinate map
+    return np.arctan2(map[0, :], map[1, :])*180.0/np.pi
+
+def cart2sphere(map, shape=DEFAULT_SHAPE):
     # Convert the rotated cartesian coordinate map to spherical coordinates
     # This should also be efficiently implemented
-    data = np.zeros((195, 487))
-    tth_map = np.empty_like(data, dtype=float).flatten()
-    _r = np.sqrt((map[:2,:]**2).sum(axis=0))
-    #print _r.shape
-    tth_map = np.arctan(_r/map[2, :])*180.0/np.pi
-    tth_map = tth_map.reshape(data.shape)
-    return tth_map%180.0
+    return cart2tth(map).reshape(shape)
+
+def solid_angle_factor(map):
+    # Solid angle of each pixel of an unrotated cartesian map relative to a pixel at the direct beam, cos^3 of the
+    # angle between the pixel's ray and the detector normal; it turns with the detector so 2-theta does not change it
+    return (map[2, :]/np.sqrt((map**2).sum(axis=0)))**3
+
+def polarization_factor(map, fraction):
+    # Polarization factor of every pixel of a rotated cartesian map, fraction is the part of the beam polarized along
+    # the 2-theta rotation axis (x, perpendicular to the scattering plane) and the rest is polarized along y
+    r2 = (map**2).sum(axis=0)
+    return fraction*(1.0 - map[0, :]**2/r2) + (1.0 - fraction)*(1.0 - map[1, :]**2/r2)
+
+def correction_key(settings):
+    # The intensity corrections switched on in the settings as a hashable key, or None when they are all off
+    # ('solid_angle_correction', 'polarization_correction' with 'polarization_fraction', and 'flat_field_file')
+    solid_angle = bool(settings.get('solid_angle_correction', False))
+    flat_file = settings.get('flat_field_file') or None
+    fraction = (float(settings.get('polarization_fraction', DEFAULT_POLARIZATION_FRACTION))
+                if settings.get('polarization_correction', False) else None)
+    if not solid_angle and flat_file is None and fraction is None:
+        return None
+    return solid_angle, flat_file, os.path.getmtime(flat_file) if flat_file else None, fraction
+
+def tth_bin_index(tth_values, stepsize):
+    # Index of the 2-theta bin each value falls in, using the same 0-180 degree edges as the histogram in integrate
+    # Values past 180 degrees land in an overflow bin at nbins so callers can bincount without filtering first
+    # The bin is worked out arithmetically and then corrected by at most one against the edges themselves, which gives
+    # exactly what searchsorted(edges, shifted, side='right') - 1 would at a fraction of the cost
+    nbins = int(math.ceil(180.0/stepsize))
+    edges = np.linspace(0.0, 180.0, nbins + 1)
+    shifted = tth_values + stepsize
+    index = np.minimum((shifted*(nbins/180.0)).astype(np.intp), nbins)
+    index -= edges[index] > shifted
+    index += (edges[np.minimum(index + 1, nbins)] <= shifted) & (index < nbins)
+    index[shifted == 180.0] = nbins - 1
+    return index
+
+def roi_layout(windows, stepsize):
+    # Bins of a local ROI pattern: the 2-theta bins (same edges as tth_bin_index) covering each window, end to end
+    # Returns (bin number of every local bin, [slice of the local pattern belonging to each window])
+    nbins = int(math.ceil(180.0/stepsize))
+    parts = []
+    slices = []
+    start = 0
+    for lo, hi in windows:
+        first, last = tth_bin_index(np.array([float(lo), float(hi)]), stepsize)
+        part = np.arange(first, min(last, nbins - 1) + 1)
+        parts.append(part)
+        slices.append(slice(start, start + len(part)))
+        start += len(part)
+    local_bins = np.concatenate(parts) if parts else np.zeros(0, dtype=np.intp)
+    if len(np.unique(local_bins)) != len(local_bins):
+        raise ValueError("ROI windows must not overlap")
+    return local_bins, slices
+
+def cake_bin_index(tth_values, chi_values, tth_step, chi_step):
+    # Flat index into a (2-theta, chi) image for every pixel, rows follow the same 2-theta bins as tth_bin_index
+    # Pixels past 180 degrees 2-theta land in an overflow row after the last real one
+    nchi = int(math.ceil(360.0/chi_step))
+    chi_index = np.minimum(((chi_values + 180.0)/chi_step).astype(np.intp), nchi - 1)
+    return tth_bin_index(tth_values, tth_step)*nchi + chi_index
+
+def split_matrix(tth_lo, tth_hi, stepsize):
+    # Sparse (nbins+1 x npixels) matrix spreading each pixel over the 2-theta bins its footprint [tth_lo, tth_hi] covers
+    # Each pixel's weights are the fraction of its footprint inside each bin, so every column sums to one
+    # Bins use the same edges as tth_bin_index, with the last row collecting anything past 180 degrees
+    import scipy.sparse as sparse
+    nbins = int(math.ceil(180.0/stepsize))
+    width = 180.0/nbins
+    lo = (tth_lo + stepsize)/width
+    hi = (tth_hi + stepsize)/width
+    first = np.floor(lo).astype(np.intp)
+    nspan = np.floor(hi).astype(np.intp) - first + 1
+    span = np.maximum(hi - lo, 1e-12)
+    pixels = np.arange(len(lo))
+    rows = []
+    cols = []
+    weights = []
+    for j in range(0, int(nspan.max())):  # a pixel only ever covers a few bins, so this loop is short
+        hit = nspan > j
+        b = first[hit] + j
+        overlap = (np.minimum(hi[hit], b + 1) - np.maximum(lo[hit], b))/span[hit]
+        overlap[hi[hit] == lo[hit]] = 1.0  # a pixel with no 2-theta extent goes entirely into its bin
+        rows.append(np.minimum(b, nbins))
+        cols.append(pixels[hit])
+        weights.append(overlap)
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    weights = np.concatenate(weights)
+    return sparse.csr_matrix((weights, (rows, cols)), shape=(nbins + 1, len(lo)))
+
+def _segment_median(values, sorted_bins, starts, counts):
+    # Median of each bin for values already grouped by bin, rejected entries are +inf so they sort to the end of their bin
+    ordered = values[np.lexsort((values, sorted_bins))]
+    filled = counts > 0
+    lo = starts + np.maximum(counts - 1, 0)//2
+    hi = starts + counts//2
+    median = np.zeros(len(counts))
+    median[filled] = 0.5*(ordered[lo[filled]] + ordered[hi[filled]])
+    return median
+
+def reject_outliers(bin_index, y, keep, method='sigma', threshold=5.0, max_iter=3, order=None):
+    # Iterative per-bin outlier (zinger/hot pixel) rejection, returns an updated copy of keep
+    # 'sigma' clips on the bin mean and standard deviation, 'mad' clips on the bin median and median absolute deviation
+    # Everything is done with bincount over the whole frame, there is no loop over bins
+    # order is an optional cached argsort of bin_index so the pixels do not need to be grouped by bin again
+    nbins = int(bin_index.max()) + 1
+    keep = keep.copy()
+    if method == 'mad':
+        if order is None:
+            order = np.argsort(bin_index, kind='stable')
+        sorted_bins = bin_index[order]
+        starts = np.cumsum(np.bincount(sorted_bins, minlength=nbins)) - np.bincount(sorted_bins, minlength=nbins)
+    for iteration in range(0, max_iter):
+        weight = keep.astype(float)
+        y_kept = y*weight
+        n = np.bincount(bin_index, weights=weight, minlength=nbins)
+        n_safe = np.maximum(n, 1)
+        mean = np.bincount(bin_index, weights=y_kept, minlength=nbins)/n_safe
+        var = np.bincount(bin_index, weights=y_kept*y, minlength=nbins)/n_safe - mean**2
+        sigma = np.sqrt(np.maximum(var, 0.0))
+        center = mean
+        if method == 'mad':
+            counts = n.astype(int)
+            center = _segment_median(np.where(keep, y, np.inf)[order], sorted_bins, starts, counts)
+            deviation = np.abs(y - center[bin_index])
+            mad = _segment_median(np.where(keep, deviation, np.inf)[order], sorted_bins, starts, counts)
+            sigma = np.where(mad > 0, 1.4826*mad, sigma)  # integer counts often give a MAD of zero, fall back on the standard deviation
+        deviation = np.abs(y - center[bin_index])
+        new_keep = keep & ((deviation <= threshold*sigma[bin_index]) | (n[bin_index] < 3))  # too few pixels in a bin to judge
+        if new_keep.sum() == keep.sum():
+            break
+        keep = new_keep
+    return keep
+
+# Per-frame ledger of an integrated scan: detector position, monitor, raw totals and the span of bins the frame touched
+LEDGER_FIELDS = [('tth', float), ('i0', float), ('total', np.int64), ('dead', np.int64), ('saturated', np.int64),
+                 ('lo', np.int64), ('hi', np.int64)]
+
+def frame_flags(ledger, window=5, i0_drop=0.5, rate_drop=0.2, rate_jump=5.0, dead_jump=100):
+    # Flag suspicious frames of a scan from its ledger, returns a list of reasons (empty when fine) for every frame
+    # Each frame is compared with the median of its neighbours (window frames centred on it) rather than the whole scan,
+    # since the intensity legitimately changes as the detector moves through the pattern
+    i0 = ledger['i0'].astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rate = np.where(i0 > 0, ledger['total']/i0, 0.0)  # monitor normalized counts
+    half = window//2
+    def local_median(values):
+        padded = np.pad(values.astype(float), half, mode='reflect' if len(values) > half else 'edge')  # end frames are judged by their neighbours too
+        return np.median(np.lib.stride_tricks.sliding_window_view(padded, 2*half + 1), axis=1)
+    i0_ref = local_median(i0)
+    rate_ref = local_median(rate)
+    dead_ref = local_median(ledger['dead'])
+    flags = []
+    for k in range(0, len(ledger)):
+        reasons = []
+        if i0[k] <= 0 or i0[k] < i0_drop*i0_ref[k]:
+            reasons.append('low I0')
+        if rate[k] < rate_drop*rate_ref[k]:
+            reasons.append('low counts')  # beam dump or closed shutter
+        elif rate[k] > rate_jump*rate_ref[k]:
+            reasons.append('high counts')
+        if ledger['saturated'][k] > 0:
+            reasons.append('saturated')
+        if ledger['dead'][k] > dead_ref[k] + dead_jump:
+            reasons.append('dead pixels')
+        flags.append(reasons)
+    return flags
+
+def frame_contribution(frame_y, frame_norm):
+    # A frame's (first bin, sums, norms) over just the span of bins it touched, as kept in the frame ledger
+    touched = np.flatnonzero(frame_norm)
+    lo, hi = (int(touched[0]), int(touched[-1]) + 1) if len(touched) else (0, 0)
+    return lo, frame_y[lo:hi].copy(), frame_norm[lo:hi].copy()
+
+def bin_moments(bin_index, y, nbins):
+    # Per-bin pixel count, mean and sum of squared deviations from the mean (Welford's M2) of one block of pixels,
+    # two bincount passes so M2 is taken about the bin's own mean rather than from a sum of squares
+    n = np.bincount(bin_index, minlength=nbins)[:nbins]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(n > 0, np.bincount(bin_index, weights=y, minlength=nbins)[:nbins]/np.maximum(n, 1), 0.0)
+    inside = bin_index < nbins
+    M2 = np.bincount(bin_index[inside], weights=(y[inside] - mean[bin_index[inside]])**2, minlength=nbins)[:nbins]
+    return n, mean, M2
+
+def add_moments(n, mean, M2, n_b, mean_b, M2_b):
+    # Fold one block's per-bin moments into running ones in place (Chan et al.'s pairwise update of Welford's sums)
+    some = n_b > 0
+    total = n[some] + n_b[some]
+    delta = mean_b[some] - mean[some]
+    M2[some] += M2_b[some] + delta*delta*n[some]*n_b[some]/total
+    mean[some] += delta*n_b[some]/total
+    n[some] = total
+
+def sweep_name(spec_name, scan_num, settings):
+    # Output name of one configuration of a settings sweep, naming the settings a sweep usually varies
+    return (f"{spec_name}_scan{scan_num}_step{float(settings['stepsize']):g}"
+            f"_clip{int(settings['img_clip_low'])}-{int(settings['img_clip_high'])}"
+            f"_tth{float(settings['min_tth']):g}-{float(settings['max_tth']):g}.xye")
+
+def background_scale(x, sample, background, settings):
+    # Factor the background is multiplied by before it is subtracted. Both are already per unit monitor, so monitor
+    # scaling is just the fixed 'background_factor' (a transmission correction, say); 'fitted' scaling is the least
+    # squares factor of the background against the sample inside the fit range (the output range by default)
+    if settings.get('background_scale', 'monitor') != 'fitted':
+        return float(settings.get('background_factor', 1.0))
+    lo = settings.get('background_fit_min')
+    hi = settings.get('background_fit_max')
+    lo = float(settings.get('min_tth') or 0.0) if lo is None else float(lo)
+    hi = float(settings.get('max_tth') or 180.0) if hi is None else float(hi)
+    inside = (x >= lo) & (x <= hi) & np.isfinite(sample) & np.isfinite(background)
+    denominator = np.sum(background[inside]**2)
+    if denominator <= 0:
+        raise ValueError(f"The background has no intensity between {lo:g} and {hi:g} degrees to fit its scale to")
+    return float(np.sum(sample[inside]*background[inside])/denominator)
+
+def finish_poisson(bins, digit_y, digit_norm, mult, stepsize, settings, background=None):
+    # Turn summed intensity and normalization accumulators into the (2-theta, intensity, esd) output pattern
+    # The normalized intensities are spline interpolated onto rounded bin positions and put on the scale of mult
+    # background is the accumulator record of a background scan binned the same way, it is scaled and subtracted
+    # bin by bin before interpolating, on bins both scans cover; its Poisson variance (on the scale of its own
+    # monitor) is added to the sample's
+    import scipy.interpolate as interpolate
+    covered = digit_norm != 0
+    if background is not None:
+        covered &= background['digit_norm'] != 0
+    nonzeros = np.nonzero(covered)
+    values = digit_y[nonzeros]/digit_norm[nonzeros]
+    variance = None
+    if background is not None:
+        background_values = background['digit_y'][nonzeros]/background['digit_norm'][nonzeros]
+        factor = background_scale(bins[nonzeros], values, background_values, settings)
+        variance = mult*np.abs(values) + factor**2*mult**2/background['mult']*np.abs(background_values)
+        values = values - factor*background_values
+    interp = interpolate.InterpolatedUnivariateSpline(bins[nonzeros], values)
+    
+    interpbins = np.arange(min(bins[nonzeros]), max(bins[nonzeros]), stepsize)
+    interpbins = np.around(interpbins, decimals=3)
+    interpy = interp(interpbins)
+    
+    good_data = np.where(np.logical_and(interpbins>=settings['min_tth'], interpbins<=settings['max_tth']))  # only take data above a certain 2-theta value
+    if variance is not None:
+        esd = np.sqrt(np.interp(interpbins[good_data], bins[nonzeros], variance))
+        return interpbins[good_data], mult * interpy[good_data], esd
+    return interpbins[good_data], mult * interpy[good_data], np.sqrt(np.abs(mult * interpy[good_data]))
+
+def finish_variance(bins, n, mean, M2, mult, stepsize, settings, background=None):
+    # Turn per-bin pixel counts, means and sums of squared deviations (Welford's M2) into the output pattern
+    # of the azimuthal error model, the esd column holds the sample variance on the scale of mult
+    # background is the variance accumulator record of a background scan, its scaled mean is subtracted and its
+    # scaled variance added bin by bin; bins the background does not cover are left undefined (NaN)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var_array = np.where(n >= 2, M2/np.maximum(n - 1, 1), np.nan)  # variance is undefined for fewer than two pixels
+    nonzeros = np.nonzero(mean)
+    if background is not None:
+        n_b = background['n']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var_b = np.where(n_b >= 2, background['M2']/np.maximum(n_b - 1, 1), np.nan)
+        both = (n > 0) & (n_b > 0)
+        factor = background_scale(bins[both], mean[both], background['mean'][both], settings)
+        mean = np.where(n_b > 0, mean - factor*background['mean'], np.nan)
+        var_array = var_array + factor**2*var_b
+    interpbins = np.arange(min(bins[nonzeros]), max(bins[nonzeros]), stepsize)
+    interpbins = np.around(interpbins, decimals=3)
+    
+    good_data = np.where(np.logical_and(interpbins>=settings['min_tth'], interpbins<=settings['max_tth']))  # only take data above a certain 2-theta value
+    return bins[good_data], mult * mean[good_data], mult * var_array[good_data]
+
+def _entry_nbytes(entry):
+    # Memory held by one cached detector position: bin map plus any orderings, cake indices, split matrix, correction
+    # weights or ROI pixel subsets added later
+    total = 0
+    for value in entry.values():
+        if isinstance(value, dict):  # ROI pixel subset
+            total += sum(array.nbytes for array in value.values())
+            continue
+        if isinstance(value, tuple):
+            value = value[0]  # cake index, (index, first cell, span)
+        if hasattr(value, 'indptr'):  # sparse split matrix
+            total += value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+        elif isinstance(value, np.ndarray):
+            total += value.nbytes
+    return total
 
 class IntegrationEngine:
     def __init__(self):
         self.progress_callback = None  # Callback for progress updates
+        self._pixel_index_cache = {}  # compressed pixel indices keyed on (mask file, mask mtime, clip range)
+        self._bin_index_cache = {}  # pixel-to-bin maps keyed on (geometry, pixel index, 2-theta position, stepsize)
+        self._bin_index_bytes = 0  # memory held by the bin index cache, kept up to date by get_bin_index and cache_extra
+        self.max_cached_positions = 512  # detector positions kept in the bin index cache before the oldest are dropped
+        self.max_cache_bytes = 1 << 30  # and the most memory those positions may hold, large detectors hit this first
+        self.memory_budget = DEFAULT_MEMORY_BUDGET  # megabytes of per-pixel temporaries, set from each scan's settings
+        self.last_cake = None  # (2-theta, chi) image from the most recent integration when caking is switched on
+        self._process_pool = None  # shared memory worker processes, only started when more than one process is requested
+        self._accumulator_cache = {}  # raw bin accumulators of integrated scans, keyed on scan, geometry and binning settings
+        self.max_cached_scans = 64  # scans kept in the accumulator cache for merging before the oldest are dropped
+        self._ledger_names = {}  # output pattern name -> accumulator key of the integration that produced it
+        self._background_cache = {}  # accumulators of background scans, kept apart so sample scans never push them out
+        self.max_cached_backgrounds = 8
+        self._weight_cache = {}  # 2-theta independent correction weights keyed on geometry, pixel index and corrections
     
     def set_progress_callback(self, callback):
         self.progress_callback = callback
+
+    def get_pixel_index(self, settings):
+        # Return the flat indices of every pixel that survives the static mask and clip range
+        # The mask file is only read again if it changes on disk, so the frame loop never has to look at masked pixels
+        lowclip = int(settings['img_clip_low'])
+        highclip = int(settings['img_clip_high'])
+        mask_file = settings.get('mask_file') or None
+        mtime = os.path.getmtime(mask_file) if mask_file else None
+        shape = detector_shape(settings)
+        key = (shape, mask_file, mtime, lowclip, highclip)
+        if key not in self._pixel_index_cache:
+            bad_pixels = read_mask(mask_file, shape) if mask_file else None
+            self._pixel_index_cache[key] = np.flatnonzero(make_pixel_mask(lowclip, highclip, bad_pixels, shape))
+        return self._pixel_index_cache[key]
+
+    def get_process_pool(self, settings):
+        # Return the shared memory process pool for the requested number of processes, or None to bin in this process
+        processes = int(settings.get('processes', 1))
+        if processes <= 1:
+            return None
+        rows, cols = detector_shape(settings)
+        if (self._process_pool is None or self._process_pool.processes != processes
+                or self._process_pool.frame_size != rows*cols):
+            import Integration_shared  # only needed (and only pays for starting processes) when asked for
+            self.close()
+            self._process_pool = Integration_shared.SharedIntegrationPool(processes, frame_size=rows*cols)
+        return self._process_pool
+
+    def close(self):
+        # Shut down any worker processes and free their shared memory
+        if self._process_pool is not None:
+            self._process_pool.close()
+            self._process_pool = None
+
+    def pixel_blocks(self, npixels, bytes_per_pixel):
+        # Blocks of pixels to stream per-pixel work through within the current memory budget
+        return pixel_blocks(npixels, bytes_per_pixel, self.memory_budget)
+
+    def get_bin_index(self, xyz_map, pix_index, tth, stepsize, pixel_bins=None):
+        # Return the cached bin of every unmasked pixel for a detector 2-theta position, plus a dict for per-position extras
+        # Scans revisit the same detector positions, so the geometry only has to be worked out the first time
+        # pix_index arrays live for the life of the engine in _pixel_index_cache, so their id is a stable key
+        # pixel_bins, when given, is called for the bins of the pixels in pix_index instead of rotating the map here
+        key = (xyz_map.shape, tuple(xyz_map[:, 0]), id(pix_index), float(tth), stepsize)
+        if key not in self._bin_index_cache:
+            # Oldest positions go first once either the position count or the memory they hold is used up
+            while self._bin_index_cache and (len(self._bin_index_cache) >= self.max_cached_positions
+                                             or self._bin_index_bytes + 4*len(pix_index) > self.max_cache_bytes):
+                self._bin_index_bytes -= _entry_nbytes(self._bin_index_cache.pop(next(iter(self._bin_index_cache))))
+            bins = np.empty(len(pix_index), dtype=np.int32)  # half the size of intp, bin numbers never need more
+            if pixel_bins is not None:
+                bins[:] = pixel_bins()
+            else:
+                for block in self.pixel_blocks(len(pix_index), GEOMETRY_BYTES_PER_PIXEL):
+                    x = cart2tth(rotate_operation(xyz_map[:, pix_index[block]], tth))
+                    bins[block] = tth_bin_index(x, stepsize)
+            self._bin_index_cache[key] = {'bins': bins}
+            self._bin_index_bytes += bins.nbytes
+        return self._bin_index_cache[key]
+
+    def get_pixel_weights(self, xyz_map, pix_index, tth, settings, entry=None):
+        # Combined intensity correction of every unmasked pixel at a detector position, multiplied into the monitor
+        # normalized counts, or None when every correction is off so the binning skips the multiply altogether
+        # Solid angle and flat field do not change with 2-theta and are worked out once per geometry and pixel index;
+        # with polarization on the combined weights are kept per position in the bin index cache entry
+        key = correction_key(settings)
+        if key is None:
+            return None
+        solid_angle, flat_file, _, fraction = key
+        static_key = (xyz_map.shape, tuple(xyz_map[:, 0]), id(pix_index)) + key[:3]
+        static = self._weight_cache.get(static_key)
+        if static is None:
+            static = np.ones(len(pix_index))
+            if solid_angle:
+                for block in self.pixel_blocks(len(pix_index), GEOMETRY_BYTES_PER_PIXEL):
+                    static[block] /= solid_angle_factor(xyz_map[:, pix_index[block]])
+            if flat_file:
+                flat = read_flat_field(flat_file, detector_shape(settings)).ravel()[pix_index]
+                if not np.all(np.isfinite(flat) & (flat > 0)):
+                    raise ValueError(f"Flat field {flat_file} has pixels without a positive efficiency, mask them")
+                static /= flat/flat.mean()  # relative to the average pixel so intensities keep their scale
+            if len(self._weight_cache) >= 8:
+                self._weight_cache.pop(next(iter(self._weight_cache)))
+            self._weight_cache[static_key] = static
+        if fraction is None:
+            return static
+        if entry is None:
+            entry = self.get_bin_index(xyz_map, pix_index, tth, float(settings['stepsize']))
+        extra = ('weights',) + key
+        if extra not in entry:
+            weights = np.empty(len(pix_index))
+            for block in self.pixel_blocks(len(pix_index), GEOMETRY_BYTES_PER_PIXEL):
+                xyz_map_prime = rotate_operation(xyz_map[:, pix_index[block]], tth)
+                weights[block] = static[block]/polarization_factor(xyz_map_prime, fraction)
+            self.cache_extra(entry, extra, weights)
+        return entry[extra]
+
+    def cache_extra(self, entry, key, value):
+        # Store a per-position extra (bin ordering, pixel counts, cake index, split matrix) in a bin index cache entry
+        entry[key] = value
+        self._bin_index_bytes += _entry_nbytes({key: value})
+        return value
+
+    def get_roi_index(self, xyz_map, pix_index, tth, stepsize, windows):
+        # (frame index, local bin) of just the unmasked pixels that fall inside the ROI windows at a detector position,
+        # plus their positions in pix_index for the correction weights; cached with the position's bin map
+        entry = self.get_bin_index(xyz_map, pix_index, tth, stepsize)
+        key = ('roi', tuple((float(lo), float(hi)) for lo, hi in windows))
+        if key not in entry:
+            local_bins, _ = roi_layout(windows, stepsize)
+            lookup = np.full(int(math.ceil(180.0/stepsize)) + 1, -1, dtype=np.int32)
+            lookup[local_bins] = np.arange(len(local_bins))
+            local = lookup[entry['bins']]
+            selected = np.flatnonzero(local >= 0)
+            self.cache_extra(entry, key, {'pixels': pix_index[selected], 'local': local[selected], 'selected': selected})
+        return entry, entry[key]
+
+    def roi_frame(self, frame, xyz_map, pix_index, tth, i0, settings, windows, nlocal):
+        # Bin only the ROI pixels of one frame (flat raw counts) into the nlocal bins of the windows' local pattern
+        # Returns the (intensity sums, normalizations) of the local bins, corrected like integrate's when corrections are on
+        entry, roi = self.get_roi_index(xyz_map, pix_index, tth, float(settings['stepsize']), windows)
+        raw = frame[roi['pixels']]
+        y = raw/i0
+        weights = self.get_pixel_weights(xyz_map, pix_index, tth, settings, entry)
+        if weights is not None:
+            y *= weights[roi['selected']]
+        keep = raw >= 0
+        sums = np.bincount(roi['local'], weights=np.where(keep, y, 0.0), minlength=nlocal)
+        norms = np.bincount(roi['local'], weights=keep, minlength=nlocal)
+        return sums, norms
+
+    def get_bin_order(self, entry):
+        # Pixel ordering grouped by bin for a cached position, only built when something (outlier rejection) asks for it
+        if 'order' not in entry:
+            self.cache_extra(entry, 'order', np.argsort(entry['bins'], kind='stable'))
+        return entry['order']
+
+    def get_bin_counts(self, entry, nbins):
+        # Number of unmasked pixels in each bin (plus the overflow bin) for a cached position, the normalization a frame
+        # with no dead pixels adds, so stacked binning only has to bincount the dead pixels to get a frame's norms
+        if 'counts' not in entry:
+            self.cache_extra(entry, 'counts', np.bincount(entry['bins'], minlength=nbins + 1).astype(float))
+        return entry['counts']
+
+    def get_cake_index(self, entry, xyz_map, pix_index, tth, tth_step, chi_step):
+        # Flat (2-theta, chi) image index of every unmasked pixel, cached alongside the 1D bins for this detector position
+        # Stored relative to the first cell this position touches so each frame only bincounts over its own span
+        key = ('cake', tth_step, chi_step)
+        if key not in entry:
+            index = np.empty(len(pix_index), dtype=np.intp)
+            for block in self.pixel_blocks(len(pix_index), GEOMETRY_BYTES_PER_PIXEL):
+                xyz_map_prime = rotate_operation(xyz_map[:, pix_index[block]], tth)
+                index[block] = cake_bin_index(cart2tth(xyz_map_prime), cart2chi(xyz_map_prime), tth_step, chi_step)
+            start = int(index.min())
+            self.cache_extra(entry, key, (index - start, start, int(index.max()) + 1 - start))
+        return entry[key]
+
+    def new_cake(self, settings):
+        # Empty intensity and pixel count accumulators for caked integration, or None when caking is switched off
+        if not settings.get('caked', False):
+            return None
+        tth_step = float(settings.get('cake_tth_step', 0.05))
+        chi_step = float(settings.get('chi_step', 1.0))
+        shape = (int(math.ceil(180.0/tth_step)), int(math.ceil(360.0/chi_step)))
+        return {'tth_step': tth_step, 'chi_step': chi_step, 'shape': shape,
+                'sum': np.zeros(shape[0]*shape[1]), 'counts': np.zeros(shape[0]*shape[1])}
+
+    def add_to_cake(self, cake, xyz_map, pix_index, tth, stepsize, y_0, y_1, block=slice(None)):
+        # Accumulate one frame into the cake with a single pair of bincounts on the cached sparse index
+        # y_0 and y_1 may cover just a block of the unmasked pixels, given as a slice of pix_index
+        entry = self.get_bin_index(xyz_map, pix_index, tth, stepsize)
+        index, start, span = self.get_cake_index(entry, xyz_map, pix_index, tth, cake['tth_step'], cake['chi_step'])
+        index = index[block]
+        span = min(span, len(cake['sum']) - start)  # anything past the end is the overflow row beyond 180 degrees
+        if span > 0:
+            cake['sum'][start:start + span] += np.bincount(index, weights=y_0, minlength=span)[:span]
+            cake['counts'][start:start + span] += np.bincount(index, weights=y_1, minlength=span)[:span]
+
+    def finish_cake(self, cake, mult):
+        # Normalize the cake and trim it to the 2-theta rows that were actually measured
+        if cake is None:
+            return None
+        total = cake['sum'].reshape(cake['shape'])
+        counts = cake['counts'].reshape(cake['shape'])
+        rows = np.nonzero(counts.sum(axis=1))[0]
+        rows = slice(rows[0], rows[-1] + 1) if len(rows) else slice(0, 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            intensity = mult*total[rows]/counts[rows]  # unmeasured (2-theta, chi) cells are left as nan
+        tth_axis = np.arange(cake['shape'][0])[rows]*cake['tth_step']
+        chi_axis = -180.0 + (np.arange(cake['shape'][1]) + 0.5)*cake['chi_step']
+        return {'tth': tth_axis, 'chi': chi_axis, 'intensity': intensity.astype(np.float32),
+                'counts': counts[rows].astype(np.int32)}
+
+    def get_split_matrix(self, entry, xyz_map, pix_index, tth, stepsize):
+        # Pixel splitting matrix for this detector position, built from the 2-theta of each pixel's corners and center
+        if 'split' not in entry:
+            tth_lo = np.empty(len(pix_index))
+            tth_hi = np.empty(len(pix_index))
+            for block in self.pixel_blocks(len(pix_index), SPLIT_BYTES_PER_PIXEL):
+                pix_map = xyz_map[:, pix_index[block]]
+                corners = [cart2tth(rotate_operation(pix_map, tth))]
+                for drow, dcol in ((-0.5, -0.5), (-0.5, 0.5), (0.5, -0.5), (0.5, 0.5)):
+                    corners.append(cart2tth(rotate_operation(pix_map + [[drow], [dcol], [0.0]], tth)))
+                corners = np.array(corners)
+                tth_lo[block] = corners.min(axis=0)
+                tth_hi[block] = corners.max(axis=0)
+            self.cache_extra(entry, 'split', split_matrix(tth_lo, tth_hi, stepsize))
+        return entry['split']
+
+    def accumulator_key(self, specfile, scan_num, xyz_map, settings, use_variance):
+        # Everything that changes a scan's raw bin accumulators, the 2-theta output range is applied later and is left out
+        mask_file = settings.get('mask_file') or None
+        return (specfile, int(scan_num), bool(use_variance), xyz_map.shape, tuple(xyz_map[:, 0]), float(settings['stepsize']),
+                int(settings['img_clip_low']), int(settings['img_clip_high']),
+                mask_file, os.path.getmtime(mask_file) if mask_file else None,
+                settings.get('integration_method', 'histogram'), settings.get('outlier_rejection', 'none'),
+                float(settings.get('outlier_threshold', 5.0)), int(settings.get('outlier_iterations', 3)),
+                correction_key(settings))
+
+    def store_accumulators(self, key, accumulators):
+        # Keep a scan's accumulators so later merges can use them without reading its frames again
+        self._accumulator_cache.pop(key, None)
+        if len(self._accumulator_cache) >= self.max_cached_scans:
+            evicted = next(iter(self._accumulator_cache))
+            self._accumulator_cache.pop(evicted)
+            # names of patterns whose ledger went with it, so the name map stays as bounded as the cache
+            for name in [name for name, ledger_key in self._ledger_names.items() if ledger_key == evicted]:
+                del self._ledger_names[name]
+        self._accumulator_cache[key] = accumulators
+
+    def background_accumulators(self, specfile, image_path, user, xyz_map, settings, use_variance=False):
+        # Accumulators of the background (empty cell, capillary, air) scan set in the settings, binned exactly like the
+        # sample so it can be subtracted bin by bin; None when no background is set
+        # The background is integrated the first time it is needed for a geometry and binning and cached after that,
+        # so subtracting it from every later sample scan costs one vector operation in finish_poisson/finish_variance
+        scan_num = int(settings.get('background_scan') or 0)
+        if scan_num <= 0:
+            return None
+        background_spec = settings.get('background_spec_file') or specfile  # same SPEC file as the sample by default
+        background_settings = dict(settings, background_scan=0)
+        key = self.accumulator_key(background_spec, scan_num, xyz_map, background_settings, use_variance)
+        record = self._background_cache.pop(key, None)
+        if record is None:
+            record = self._accumulator_cache.get(key)
+        if record is None:
+            if use_variance:
+                self.integrate_var(background_spec, scan_num, image_path, user, xyz_map, background_settings)
+            else:
+                self.integrate(background_spec, scan_num, image_path, user, xyz_map, background_settings)
+            record = self._accumulator_cache[key]
+        if len(self._background_cache) >= self.max_cached_backgrounds:
+            self._background_cache.pop(next(iter(self._background_cache)))
+        self._background_cache[key] = record
+        return record
+
+    def frame_ledger(self, name):
+        # Ledger, anomaly flags and current frame weights of the most recent integration of an output pattern
+        # Returns None when the pattern was not integrated by this engine or has left the accumulator cache
+        record = self._accumulator_cache.get(self._ledger_names.get(name))
+        if record is None or 'ledger' not in record:
+            return None
+        return record['ledger'], frame_flags(record['ledger']), record['weights'].copy()
+
+    def reweight_frames(self, name, weights):
+        # Change the weights of some frames of an integrated pattern (0 excludes a frame, 1 is the original) and
+        # return the new (x, y, e); only the changed frames' stored contributions are added or subtracted
+        # The merged accumulators are updated too, so later merges of this scan use the new weights
+        record = self._accumulator_cache.get(self._ledger_names.get(name))
+        if record is None or 'ledger' not in record:
+            raise KeyError(f"No frame ledger for {name}, integrate it again first")
+        digit_y = record['digit_y']
+        digit_norm = record['digit_norm']
+        for k, weight in dict(weights).items():
+            change = float(weight) - record['weights'][k]
+            if change == 0.0:
+                continue
+            lo, sums, norms = record['contributions'][k]
+            digit_y[lo:lo + len(sums)] += change*sums
+            digit_norm[lo:lo + len(norms)] += change*norms
+            record['weights'][k] = float(weight)
+        np.maximum(digit_norm, 0.0, out=digit_norm)  # excluding every frame of a bin can leave rounding residue
+        digit_norm[np.abs(digit_norm) < 1e-9] = 0.0
+        settings = record['settings']
+        return finish_poisson(record['bins'], digit_y, digit_norm, record['mult'], float(settings['stepsize']), settings,
+                              record.get('background'))
+
+    def merge_scans(self, specfile, scan_nums, image_path, user, xyz_map, settings, use_variance=False):
+        # Merge repeat scans into one pattern from their raw bin accumulators rather than their interpolated outputs
+        # Scans that are not in the accumulator cache yet are integrated first, the rest are never read again
+        # The merged pattern is on the scale of the summed first-frame monitors of all scans, so its Poisson esds
+        # reflect the total counts; azimuthal variances are pooled from each scan's per-bin count, mean and M2
+        scan_nums = [int(scan_num) for scan_num in scan_nums]
+        records = []
+        for scan_num in scan_nums:
+            key = self.accumulator_key(specfile, scan_num, xyz_map, settings, use_variance)
+            if key not in self._accumulator_cache:
+                if use_variance:
+                    self.integrate_var(specfile, scan_num, image_path, user, xyz_map, settings)
+                else:
+                    self.integrate(specfile, scan_num, image_path, user, xyz_map, settings)
+            records.append(self._accumulator_cache[key])
+        background = self.background_accumulators(specfile, image_path, user, xyz_map, settings, use_variance)
+        self.last_cake = None  # caked images are per scan, there is no merged cake
+        stepsize = float(settings['stepsize'])
+        bins = records[0]['bins']
+        mult = sum(record['mult'] for record in records)
+        spec_name = os.path.split(specfile)[1]
+        outname = spec_name + "_scan" + "+".join(str(scan_num) for scan_num in scan_nums) + ".xye"
+        if use_variance:
+            n = np.array([record['n'] for record in records])
+            mean = np.array([record['mean'] for record in records])
+            n_total = n.sum(axis=0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean_total = np.where(n_total > 0, (n*mean).sum(axis=0)/np.maximum(n_total, 1), 0.0)
+            M2_total = (np.array([record['M2'] for record in records]).sum(axis=0)
+                        + (n*(mean - mean_total)**2).sum(axis=0))
+            return (outname,) + finish_variance(bins, n_total, mean_total, M2_total, mult, stepsize, settings, background)
+        digit_y = np.sum([record['digit_y'] for record in records], axis=0)
+        digit_norm = np.sum([record['digit_norm'] for record in records], axis=0)
+        return (outname,) + finish_poisson(bins, digit_y, digit_norm, mult, stepsize, settings, background)
+
+    def bin_stacked(self, filenames, tth, i0, xyz_map, pix_index, settings, ledger, contributions, digit_y, digit_norm):
+        # Bin a whole scan a chunk of frames at a time instead of frame by frame: the unmasked pixels of every frame in
+        # a chunk are stacked into one (frames, pixels) array and reduced with a single bincount over a combined
+        # (frame, bin) index, so reading the files is the only per-frame Python work left
+        # Chunks hold as many frames as fit in the memory budget; the ledger totals, per-frame contributions and
+        # digit_y/digit_norm are filled in exactly as the frame loop of integrate does
+        stepsize = float(settings['stepsize'])
+        lowclip = int(settings['img_clip_low'])
+        highclip = int(settings['img_clip_high'])
+        shape = detector_shape(settings)
+        saturation = int(settings.get('saturation_level', Integration_backends.SATURATION_LEVEL))
+        nbins = int(math.ceil(180.0/stepsize))
+        width = nbins + 1  # one row of the combined index per frame, its last bin the overflow past 180 degrees
+        npix = len(pix_index)
+        corrected = correction_key(settings) is not None
+        bytes_per_pixel = STACKED_BYTES_PER_PIXEL + (8 if corrected else 0)
+        chunk = max(int(self.memory_budget*2**20)//(npix*bytes_per_pixel + 32*width), 1)
+        chunk = min(chunk, len(filenames))
+        counts = np.empty((chunk, npix), dtype=np.int32)
+        index = np.empty((chunk, npix), dtype=np.intp)
+        pixels = np.empty((chunk, width))  # pixels per bin of each frame's detector position
+        weights = np.empty((chunk, npix)) if corrected else None  # correction weights of each frame's position
+        ledger['tth'] = tth
+        ledger['i0'] = i0
+        for first in range(0, len(filenames), chunk):
+            n = min(chunk, len(filenames) - first)
+            for j in range(0, n):
+                k = first + j
+                counts[j] = read_RAW(filenames[k], lowclip, highclip, mask=False, shape=shape).ravel()[pix_index]
+                entry = self.get_bin_index(xyz_map, pix_index, tth[k], stepsize)
+                np.add(entry['bins'], j*width, out=index[j])
+                pixels[j] = self.get_bin_counts(entry, nbins)
+                if corrected:
+                    weights[j] = self.get_pixel_weights(xyz_map, pix_index, tth[k], settings, entry)
+            frames = counts[:n]
+            flat = index[:n].ravel()
+            # The detector flags dead pixels with negative counts, these are left out of both sums; they are rare, so
+            # the norms are the pixel counts of each position less a bincount of just the dead pixels
+            dead = np.flatnonzero(frames < 0)
+            live_counts = np.maximum(frames, 0)
+            ledger['total'][first:first + n] = live_counts.sum(axis=1, dtype=np.int64)
+            ledger['dead'][first:first + n] = np.bincount(dead//npix, minlength=n)
+            ledger['saturated'][first:first + n] = (frames >= saturation).sum(axis=1)
+            y_0 = np.divide(live_counts, i0[first:first + n, None])
+            if corrected:
+                y_0 *= weights[:n]
+            sums = np.bincount(flat, weights=y_0.ravel(), minlength=n*width).reshape(n, width)[:, :nbins]
+            norms = (pixels[:n] - np.bincount(flat[dead], minlength=n*width).reshape(n, width))[:, :nbins]
+            touched = norms != 0
+            hit = touched.any(axis=1)
+            lo = np.where(hit, touched.argmax(axis=1), 0)
+            hi = np.where(hit, nbins - touched[:, ::-1].argmax(axis=1), 0)
+            for j in range(0, n):
+                contributions[first + j] = (int(lo[j]), sums[j, lo[j]:hi[j]].copy(), norms[j, lo[j]:hi[j]].copy())
+            digit_y += sums.sum(axis=0)
+            digit_norm += norms.sum(axis=0)
+            if self.progress_callback:
+                self.progress_callback((first + n)/len(filenames))
+
+    def bin_frame(self, frame, xyz_map, pix_index, tth, i0, settings, backend=None, cake=None, pixel_bins=None):
+        # Bin one frame (flat raw counts) at detector position tth, returns its (intensity sums, normalizations) over
+        # every 2-theta bin and the (total counts, dead pixels, saturated pixels) of its unmasked pixels for the ledger
+        # With a compute backend the frame is streamed through its kernel a block of pixels at a time (plain binning),
+        # without one the settings' outlier rejection and pixel splitting apply and the frame is added to any cake
+        # pixel_bins is passed on to get_bin_index for bins already worked out by the caller
+        stepsize = float(settings['stepsize'])
+        nbins = int(math.ceil(180.0/stepsize))
+        saturation = int(settings.get('saturation_level', Integration_backends.SATURATION_LEVEL))
+        entry = self.get_bin_index(xyz_map, pix_index, tth, stepsize, pixel_bins)
+        x = entry['bins']  # 2-theta bin for every unmasked pixel at this detector position
+        weights = self.get_pixel_weights(xyz_map, pix_index, tth, settings, entry)
+        frame_y = np.zeros(nbins)
+        frame_norm = np.zeros(nbins)
+        if backend is not None:
+            totals = np.zeros(3, dtype=np.int64)
+            for block in self.pixel_blocks(len(pix_index), backend.bytes_per_pixel):
+                totals += backend.accumulate(frame, pix_index[block], x[block], i0, frame_y, frame_norm,
+                                             saturation=saturation,
+                                             weights=None if weights is None else weights[block])
+            return frame_y, frame_norm, tuple(int(total) for total in totals)
+        raw = frame[pix_index]
+        totals = Integration_backends.frame_summary(raw, saturation)
+        y = raw/i0    # list of all unmasked intensity values (normalized by I0)
+        if weights is not None:
+            y *= weights  # solid angle, polarization and flat field corrections
+        keep = y >= 0    # the detector flags dead pixels with negative counts, these are left out of both sums
+        keep = self.outlier_keep(settings, x, y, keep, entry)
+        y_1 = keep.astype(float)
+        y_0 = y * y_1
+        if settings.get('integration_method', 'histogram') == 'split':
+            split = self.get_split_matrix(entry, xyz_map, pix_index, tth, stepsize)
+            frame_y += (split @ y_0)[:nbins]  # each pixel shared between the bins its footprint covers
+            frame_norm += (split @ y_1)[:nbins]
+        else:
+            frame_y += np.bincount(x, weights=y_0, minlength=nbins + 1)[:nbins]  # last bin is the overflow past 180 degrees
+            frame_norm += np.bincount(x, weights=y_1, minlength=nbins + 1)[:nbins]
+        if cake is not None:
+            self.add_to_cake(cake, xyz_map, pix_index, tth, stepsize, y_0, y_1)
+        return frame_y, frame_norm, totals
+
+    def sweep(self, specfile, scan_num, image_path, user, xyz_map, configs):
+        # Integrate one scan with several settings dicts (step size, clip range, 2-theta range, binning method, ...)
+        # from a single read of its frames: each frame is fed to every configuration's accumulators in turn
+        # Configurations that bin the same way (differing only in the 2-theta output range) share one set of
+        # accumulators, and the pixel 2-theta of each frame is worked out once for the pixels of every configuration
+        # and binned once per step size, so a sweep costs about one integration plus the binning
+        # Poisson error model only, without caking or worker processes
+        # Returns [(outname, x, y, e)] in the order of configs; each result keeps a frame ledger like integrate's
+        start_time = time.time()
+        configs = [dict(config) for config in configs]
+        if not configs:
+            raise ValueError("A sweep needs at least one configuration")
+        if len(set(detector_shape(config) for config in configs)) > 1:
+            raise ValueError("Every configuration of a sweep has to use the same detector")
+        if any(config.get('error_model', 'poisson') != 'poisson' for config in configs):
+            raise ValueError("Sweeps use the poisson error model only")
+        spec_path, spec_name = os.path.split(specfile)
+        tth, i0 = SPECread(specfile, scan_num)
+        mult = float(i0[0])   # multiplier to put everything back onto a rough scale of counts/pixel
+        shape = detector_shape(configs[0])
+        self.memory_budget = float(configs[0].get('memory_budget', DEFAULT_MEMORY_BUDGET))
+        groups = {}  # accumulator key -> accumulators shared by the configurations that bin the same way
+        for config in configs:
+            key = self.accumulator_key(specfile, scan_num, xyz_map, config, False)
+            if key not in groups:
+                stepsize = float(config['stepsize'])
+                plain = (config.get('integration_method', 'histogram') == 'histogram'
+                         and config.get('outlier_rejection', 'none') == 'none')
+                groups[key] = {'settings': config, 'pix_index': self.get_pixel_index(config),
+                               'backend': Integration_backends.get_backend(config.get('backend', 'auto')) if plain else None,
+                               'bins': np.arange(0.0, 180.0, stepsize), 'mult': mult,
+                               'digit_y': np.zeros(int(math.ceil(180.0/stepsize))),
+                               'digit_norm': np.zeros(int(math.ceil(180.0/stepsize))),
+                               'ledger': np.zeros(len(tth), dtype=LEDGER_FIELDS), 'contributions': [None]*len(tth),
+                               'weights': np.ones(len(tth))}
+        union = np.unique(np.concatenate([group['pix_index'] for group in groups.values()]))
+        for group in groups.values():
+            group['in_union'] = np.searchsorted(union, group['pix_index'])
+        for k in range(0, len(tth)):        # every image is read once for all of the configurations
+            filename = image_path + "/" + user + "_" + spec_name + "_scan" + str(scan_num) + "_" + str(k).zfill(4) + ".raw"
+            frame = read_RAW(filename, 0, shape[1], mask=False, shape=shape).ravel()
+            shared = {}  # 2-theta and bins per step size of the union of every configuration's pixels, when needed
+
+            def union_bins(group, position=tth[k], shared=shared):
+                if 'tth' not in shared:
+                    shared['tth'] = np.empty(len(union))
+                    for block in self.pixel_blocks(len(union), GEOMETRY_BYTES_PER_PIXEL):
+                        shared['tth'][block] = cart2tth(rotate_operation(xyz_map[:, union[block]], position))
+                stepsize = float(group['settings']['stepsize'])
+                if stepsize not in shared:
+                    shared[stepsize] = tth_bin_index(shared['tth'], stepsize)
+                return shared[stepsize][group['in_union']]
+
+            for group in groups.values():
+                frame_y, frame_norm, totals = self.bin_frame(frame, xyz_map, group['pix_index'], tth[k], i0[k],
+                                                             group['settings'], group['backend'],
+                                                             pixel_bins=lambda group=group: union_bins(group))
+                ledger = group['ledger']
+                ledger[k]['tth'], ledger[k]['i0'] = tth[k], i0[k]
+                ledger[k]['total'], ledger[k]['dead'], ledger[k]['saturated'] = totals
+                group['contributions'][k] = frame_contribution(frame_y, frame_norm)
+                lo, sums, norms = group['contributions'][k]
+                ledger[k]['lo'], ledger[k]['hi'] = lo, lo + len(norms)
+                group['digit_y'][lo:lo + len(sums)] += sums
+                group['digit_norm'][lo:lo + len(norms)] += norms
+            if self.progress_callback:
+                self.progress_callback(k/len(tth))
+        results = []
+        for index, config in enumerate(configs):
+            key = self.accumulator_key(specfile, scan_num, xyz_map, config, False)
+            group = groups[key]
+            background = self.background_accumulators(specfile, image_path, user, xyz_map, config)
+            x, y, e = finish_poisson(group['bins'], group['digit_y'], group['digit_norm'], mult,
+                                     float(config['stepsize']), config, background)
+            outname = sweep_name(spec_name, scan_num, config)
+            if outname in [result[0] for result in results]:  # differs in a setting the name leaves out
+                outname = outname[:-len(".xye")] + f"_{index + 1}.xye"
+            record = {name: group[name] for name in ('bins', 'digit_y', 'digit_norm', 'mult', 'ledger',
+                                                     'contributions', 'settings', 'weights')}
+            record['background'] = background
+            self.store_accumulators(key, record)
+            self._ledger_names[outname] = key
+            results.append((outname, x, y, e))
+        self.last_cake = None
+        print(f"Elapsed time sweep of {len(configs)} configurations: {time.time() - start_time:.4f} seconds")
+        if self.progress_callback:
+            self.progress_callback(1.0)
+        return results
+
+    def outlier_keep(self, settings, bin_index, y, keep, entry=None):
+        # Apply the optional outlier rejection stage from the integration settings
+        method = settings.get('outlier_rejection', 'none')
+        if method == 'none':
+            return keep
+        order = self.get_bin_order(entry) if (entry is not None and method == 'mad') else None
+        return reject_outliers(bin_index, y, keep, method=method,
+                               threshold=float(settings.get('outlier_threshold', 5.0)),
+                               max_iter=int(settings.get('outlier_iterations', 3)), order=order)
         
     def integrate(self, specfile, scan_num, image_path, user, xyz_map, settings):
         start_time = time.time()
@@ -176,48 +1064,98 @@ class IntegrationEngine:
         bins = np.arange(0.0, 180.0, stepsize)  # create all of the bins from 0-180 with the specified stepsize
         digit_y = np.zeros_like(bins)   # this will hold the intensities for each bin
         digit_norm = np.zeros_like(bins)    # this will hold the normalization value (monitor counts) for each bin
-        for k in range(0, len(tth)):        # loop through images at every 2-theta value
+        nbins = int(math.ceil(180.0/stepsize))
+        shape = detector_shape(settings)
+        # binned (or taken from the cache) before this scan, so a missing background fails before any frame is read
+        background = self.background_accumulators(specfile, image_path, user, xyz_map, settings)
+        self.memory_budget = float(settings.get('memory_budget', DEFAULT_MEMORY_BUDGET))
+        pix_index = self.get_pixel_index(settings)  # only these pixels are ever read from a frame
+        cake = self.new_cake(settings)
+        split_pixels = settings.get('integration_method', 'histogram') == 'split'
+        # Plain binning (no outlier rejection, pixel splitting or caking) goes through the selected compute backend
+        fused = not split_pixels and cake is None and settings.get('outlier_rejection', 'none') == 'none'
+        backend = Integration_backends.get_backend(settings.get('backend', 'auto')) if fused else None
+        pool = None
+        if not split_pixels and cake is None:  # worker processes only do plain (optionally outlier clipped) binning
+            pool = self.get_process_pool(settings)
+        # Stacked mode bins chunks of frames in one reduction, in place of the per-frame loop and backend below
+        stacked = fused and pool is None and settings.get('stacked', False)
+        if pool is not None:
+            positions = list(dict.fromkeys(float(t) for t in tth))  # unique detector positions in scan order
+            bin_maps = [self.get_bin_index(xyz_map, pix_index, t, stepsize)['bins'] for t in positions]
+            weight_maps = None
+            if correction_key(settings) is not None:
+                weight_maps = [self.get_pixel_weights(xyz_map, pix_index, t, settings) for t in positions]
+            pool.publish_geometry((tuple(xyz_map[:, 0]), id(pix_index), stepsize, tuple(positions), correction_key(settings)),
+                                  xyz_map, pix_index, bin_maps, weight_maps)
+            pool.start_scan(nbins)
+            method = settings.get('outlier_rejection', 'none')
+            outlier = None if method == 'none' else (method, float(settings.get('outlier_threshold', 5.0)),
+                                                     int(settings.get('outlier_iterations', 3)))
+        saturation = int(settings.get('saturation_level', Integration_backends.SATURATION_LEVEL))
+        ledger = np.zeros(len(tth), dtype=LEDGER_FIELDS)  # per-frame totals, filled in the same pass as the binning
+        contributions = [None]*len(tth)  # per-frame (first bin, sums, norms) over the span of bins each frame touched
+        if stacked:
+            filenames = [image_path + user + "_" + spec_name + "_scan" + str(scan_num) + "_" + str(k).zfill(4) + ".raw"
+                         for k in range(0, len(tth))]
+            self.bin_stacked(filenames, tth, i0, xyz_map, pix_index, settings, ledger, contributions, digit_y, digit_norm)
+        for k in range(0, 0 if stacked else len(tth)):        # loop through images at every 2-theta value
             x = []
             y = []
             filename = image_path + user + "_" + spec_name + "_scan" + str(scan_num) + "_" + str(k).zfill(4) + ".raw"
-            data = read_RAW(filename, lowclip, highclip)
-            xyz_map_prime = rotate_operation(xyz_map, tth[k])
-            tth_map = cart2sphere(xyz_map_prime)
-            x = tth_map.flatten()  # flatten into a list of all 2-theta values
-            y = data.flatten()/i0[k]    # flatten into a list of all intensity values (normalized by I0)
-            y_0 = np.where(y < 0, np.zeros_like(y), y)  # create a list of intensities where any negative numbers are set to 0, this is for every pixel in the current image
-            y_1 = np.where(y < 0, np.zeros_like(y), np.ones_like(y))    # create a map of which intensities are to be used (0 if masked out, 1 if included), for every pixel in the current image
-    
-            digit_y += np.histogram(x + stepsize, weights=y_0, range=(0,180), bins=int(math.ceil(180.0/stepsize)))[0]
-            digit_norm += np.histogram(x + stepsize, weights=y_1, range=(0,180), bins=int(math.ceil(180.0/stepsize)))[0]
+            data = read_RAW(filename, lowclip, highclip, mask=False, shape=shape)
+            ledger[k]['tth'] = tth[k]
+            ledger[k]['i0'] = i0[k]
+            if pool is not None:
+                ledger[k]['total'], ledger[k]['dead'], ledger[k]['saturated'] = \
+                    Integration_backends.frame_summary(data.ravel()[pix_index], saturation)
+                pool.submit(data, positions.index(float(tth[k])), i0[k], outlier, frame=k)
+                if self.progress_callback:
+                    self.progress_callback(k/len(tth))
+                continue
+            # this frame's contribution over every bin, kept in the ledger and added to the scan totals
+            frame_y, frame_norm, totals = self.bin_frame(data.ravel(), xyz_map, pix_index, tth[k], i0[k], settings,
+                                                         backend, cake)
+            ledger[k]['total'], ledger[k]['dead'], ledger[k]['saturated'] = totals
+            contributions[k] = frame_contribution(frame_y, frame_norm)
+            lo, sums, norms = contributions[k]
+            digit_y[lo:lo + len(sums)] += sums
+            digit_norm[lo:lo + len(norms)] += norms
             
             
             # Report progress if callback exists
             if self.progress_callback:
                 self.progress_callback(k/len(tth))
             
-        nonzeros = np.nonzero(digit_norm)
-        interp = interpolate.InterpolatedUnivariateSpline(bins[nonzeros], digit_y[nonzeros]/digit_norm[nonzeros])
-        
-        interpbins = np.arange(min(bins[nonzeros]), max(bins[nonzeros]), stepsize)
-        interpbins = np.around(interpbins, decimals=3)
-        interpy = interp(interpbins)
+        if pool is not None:
+            pool_y, pool_norm = pool.finish()
+            digit_y += pool_y
+            digit_norm += pool_norm
+            contributions = [pool.contributions[k] for k in range(0, len(tth))]
+        for k, (lo, sums, norms) in enumerate(contributions):
+            ledger[k]['lo'] = lo
+            ledger[k]['hi'] = lo + len(norms)
+        x, y, e = finish_poisson(bins, digit_y, digit_norm, mult, stepsize, settings, background)
         
         outname = spec_name + "_scan" + str(scan_num) + ".xye"
-        
-        good_data = np.where(np.logical_and(interpbins>=settings['min_tth'], interpbins<=settings['max_tth']))  # only take data above a certain 2-theta value
+        key = self.accumulator_key(specfile, scan_num, xyz_map, settings, False)
+        self.store_accumulators(key, {'bins': bins, 'digit_y': digit_y, 'digit_norm': digit_norm, 'mult': mult,
+                                      'ledger': ledger, 'contributions': contributions, 'settings': dict(settings),
+                                      'weights': np.ones(len(tth)), 'background': background})
+        self._ledger_names[outname] = key
             
         end_time = time.time()  # Record the ending time
         elapsed_time = end_time - start_time
         
         
         print(f"Elapsed time Poisson: {elapsed_time:.4f} seconds")
+        self.last_cake = self.finish_cake(cake, mult)
         
         # Report progress if callback exists
         if self.progress_callback:
-            self.progress_callback(step * 100 / total_steps)
+            self.progress_callback(1.0)
         
-        return outname, interpbins[good_data], mult * interpy[good_data], np.sqrt(np.abs(mult * interpy[good_data]))
+        return outname, x, y, e
 
     def integrate_var(self, specfile, scan_num, image_path, user, xyz_map, settings):  # Integrates data using variance for esd values
         start_time = time.time()
@@ -234,46 +1172,173 @@ class IntegrationEngine:
         xmax_global = 0.0  #set this to some small number so that it gets reset with the first image
         xmin_global = 180.0
         bins = np.arange(0.0, 180.0, stepsize)  # create all of the bins from 0-180 with the specified stepsize
-        y_list = [RunningStats(index=i) for i in range(0, len(bins))]  # create a list of RunningStats for every 2-theta bin
+        # running pixel count, mean and M2 of every 2-theta bin, updated a block of pixels at a time
+        n = np.zeros(len(bins), dtype=np.int64)
+        mean = np.zeros(len(bins))
+        M2 = np.zeros(len(bins))
+        shape = detector_shape(settings)
+        background = self.background_accumulators(specfile, image_path, user, xyz_map, settings, True)
+        self.memory_budget = float(settings.get('memory_budget', DEFAULT_MEMORY_BUDGET))
+        pix_index = self.get_pixel_index(settings)  # only these pixels are ever read from a frame
+        cake = self.new_cake(settings)
+        # Frames are streamed a block of pixels at a time, each block's per-bin moments folded into the running ones;
+        # outlier rejection needs the statistics of the whole frame, so with it on each frame is one block
+        if settings.get('outlier_rejection', 'none') == 'none':
+            blocks = self.pixel_blocks(len(pix_index), GEOMETRY_BYTES_PER_PIXEL)
+        else:
+            blocks = [slice(0, len(pix_index))]
         for k in range(0, len(tth)):        # loop through images at every 2-theta value
-            x = []
-            y = []
             filename = image_path + user + "_" + spec_name + "_scan" + str(scan_num) + "_" + str(k).zfill(4) + ".raw"
-            data = read_RAW(filename, lowclip, highclip)
-            xyz_map_prime = rotate_operation(xyz_map, tth[k])
-            tth_map = cart2sphere(xyz_map_prime)
-            x = tth_map.flatten()  # flatten into a list of all 2-theta values
-            y = data.flatten()/i0[k]    # flatten into a list of all intensity values (normalized by I0)
-            bin_indices = np.digitize(x, bins)  # array of indices mapping x into the correct bins (index of bins for each x value)
-            for i in range(0, len(x)):
-                if y[i] >= 0:
-                    y_list[bin_indices[i]].add(y[i])
+            data = read_RAW(filename, lowclip, highclip, mask=False, shape=shape).ravel()
+            weights = self.get_pixel_weights(xyz_map, pix_index, tth[k], settings)
+            for block in blocks:
+                xyz_map_prime = rotate_operation(xyz_map[:, pix_index[block]], tth[k])
+                x = cart2tth(xyz_map_prime)  # list of 2-theta values for every unmasked pixel of the block
+                y = data[pix_index[block]]/i0[k]    # list of all unmasked intensity values (normalized by I0)
+                if weights is not None:
+                    y *= weights[block]  # solid angle, polarization and flat field corrections
+                bin_indices = np.digitize(x, bins)  # array of indices mapping x into the correct bins (index of bins for each x value)
+                keep = self.outlier_keep(settings, bin_indices, y, y >= 0)
+                # bin i of the moments holds pixels digitize puts at i, anything at or past the last bin edge is dropped
+                add_moments(n, mean, M2, *bin_moments(bin_indices[keep], y[keep], len(bins)))
+                if cake is not None:
+                    self.add_to_cake(cake, xyz_map, pix_index, tth[k], stepsize, np.where(keep, y, 0.0),
+                                     keep.astype(float), block)
             # Report progress if callback exists
             if self.progress_callback:
                 self.progress_callback(k/len(tth))
                     
-        digit_norm = [obj.mean for obj in y_list]
-        variance = [obj.variance() for obj in y_list]
-        y_array = np.array(digit_norm)
-        var_array = np.array(variance)
-        nonzeros = np.nonzero(digit_norm)
-        interpbins = np.arange(min(bins[nonzeros]), max(bins[nonzeros]), stepsize)
-        interpbins = np.around(interpbins, decimals=3)
+        self.store_accumulators(self.accumulator_key(specfile, scan_num, xyz_map, settings, True),
+                                {'bins': bins, 'n': n, 'mean': mean, 'M2': M2, 'mult': mult})
+        x, y, e = finish_variance(bins, n, mean, M2, mult, stepsize, settings, background)
         
         outname = spec_name + "_scan" + str(scan_num) + ".xye"
-        
-        good_data = np.where(np.logical_and(interpbins>=settings['min_tth'], interpbins<=settings['max_tth']))  # only take data above a certain 2-theta value
+        self._ledger_names.pop(outname, None)  # no ledger is kept here, one from an earlier Poisson run is stale now
         
         end_time = time.time()  # Record the ending time
         elapsed_time = end_time - start_time
         
         print(f"Elapsed time variance: {elapsed_time:.4f} seconds")
+        self.last_cake = self.finish_cake(cake, mult)
         
-        return outname, bins[good_data], mult * y_array[good_data], mult * var_array[good_data]
+        return outname, x, y, e
+
+def format_xye(x, y, e):
+    # Text of a whole .xye pattern from one str.format call over every value, the same text as formatting each
+    # line with f"{x:6.6} {y:12.9} {e:12.9} " but without a Python level loop
+    values = np.column_stack((x, y, e)).ravel().tolist()
+    return ("{:6.6} {:12.9} {:12.9} \n"*len(x)).format(*values)
+
+def _replace_atomically(outname, write):
+    # Write through a temporary file next to the target and swap it in, readers never see a half written file
+    temp_name = outname + ".tmp"
+    try:
+        write(temp_name)
+        os.replace(temp_name, outname)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
 
 def write_data(output_path, filename, x, y, e):
     outname = output_path + filename
-    outfile = open(outname, "w")
-    for i in range(0, len(x)):
-        outfile.write(f"{x[i]:{6}.{6}} {y[i]:{12}.{9}} {e[i]:{12}.{9}} \n")
-    outfile.close()
\ No newline at end of file
+    text = format_xye(x, y, e)
+
+    def write(temp_name):
+        with open(temp_name, "w", buffering=1 << 20) as outfile:  # one buffered write, not one per line
+            outfile.write(text)
+    _replace_atomically(outname, write)
+
+def write_cake(output_path, filename, cake):
+    # Save a (2-theta, chi) cake as a compressed binary image (float32 intensities, int32 pixel counts and both axes)
+    def write(temp_name):
+        with open(temp_name, "wb") as outfile:
+            np.savez_compressed(outfile, tth=cake['tth'], chi=cake['chi'],
+                                intensity=cake['intensity'], counts=cake['counts'])
+    _replace_atomically(output_path + filename, write)
+
+def calibration_terms(pix_index, tth, shape=DEFAULT_SHAPE):
+    # The parts of the 2-theta calculation that do not depend on the calibration, worked out once per refinement:
+    # row and column of every pixel in pix_index and the cosine and sine of each detector angle in tth
+    rows, cols = np.unravel_index(pix_index, shape)
+    angles = np.asarray(tth, dtype=float)*np.pi/180.0
+    return rows.astype(float), cols.astype(float), np.cos(angles), np.sin(angles)
+
+def calibrated_tth(db_x, db_y, det_R, rows, cols, cos_tth, sin_tth):
+    # 2-theta of (pixel, frame) pairs for a trial calibration, the same result as make_map, rotate_operation and
+    # cart2tth but written out so a fit can evaluate it on just the selected pixels without building any maps
+    x = rows - db_y
+    y = cols - db_x
+    y_prime = cos_tth*y + sin_tth*det_R
+    z_prime = -sin_tth*y + cos_tth*det_R
+    return np.arctan2(np.sqrt(x**2 + y_prime**2), z_prime)*180.0/np.pi
+
+def _nearest_peak(values, peaks):
+    # Closest entry of the sorted peaks array to each value
+    if len(peaks) == 1:
+        return np.full(len(values), peaks[0])
+    index = np.clip(np.searchsorted(peaks, values), 1, len(peaks) - 1)
+    lower = peaks[index - 1]
+    upper = peaks[index]
+    return np.where(values - lower <= upper - values, lower, upper)
+
+def refine_calibration(specfile, scan_num, image_path, user, db_pixel, det_R, peaks, settings,
+                       window=0.3, threshold=3.0, rounds=3, progress_callback=None):
+    # Refine the direct beam pixel and detector distance against a standard's known peak positions (2-theta, degrees)
+    # Pixels clearly above background (threshold Poisson sigmas over the frame median) within window degrees of a peak
+    # at the starting calibration are collected once from every frame of the scan. Each round assigns them to their
+    # nearest peak under the current calibration and fits (db_x, db_y, det_R) with curve_fit, weighting by counts.
+    from scipy.optimize import curve_fit
+    lowclip = int(settings['img_clip_low'])
+    highclip = int(settings['img_clip_high'])
+    mask_file = settings.get('mask_file') or None
+    shape = detector_shape(settings)
+    pix_index = np.flatnonzero(make_pixel_mask(lowclip, highclip, read_mask(mask_file, shape) if mask_file else None,
+                                               shape))
+    spec_path, spec_name = os.path.split(specfile)
+    tth, i0 = SPECread(specfile, scan_num)
+    peaks = np.sort(np.asarray(peaks, dtype=float))
+    rows, cols, cos_tth, sin_tth = calibration_terms(pix_index, tth, shape)
+    params = np.array([db_pixel[0], db_pixel[1], det_R], dtype=float)
+    selected = []  # (pixel, frame, counts) of every candidate peak pixel
+    for k in range(0, len(tth)):
+        filename = image_path + "/" + user + "_" + spec_name + "_scan" + str(scan_num) + "_" + str(k).zfill(4) + ".raw"
+        counts = read_RAW(filename, lowclip, highclip, mask=False, shape=shape).ravel()[pix_index].astype(float)
+        background = np.median(counts[counts >= 0])
+        pixel_tth = calibrated_tth(*params, rows, cols, cos_tth[k], sin_tth[k])
+        distance = np.abs(pixel_tth - _nearest_peak(pixel_tth, peaks))
+        strong = np.flatnonzero((distance < window) & (counts > background + threshold*np.sqrt(max(background, 1.0))))
+        selected.append((strong, np.full(len(strong), k), counts[strong] - background))
+        if progress_callback:
+            progress_callback(0.5*k/len(tth))
+    pixels = np.concatenate([s[0] for s in selected])
+    frames = np.concatenate([s[1] for s in selected])
+    weights = np.concatenate([s[2] for s in selected])
+    if len(pixels) < 3:
+        raise ValueError("Too few peak pixels were found near the given peak positions to refine the calibration")
+    rows, cols, cos_tth, sin_tth = rows[pixels], cols[pixels], cos_tth[frames], sin_tth[frames]
+
+    def model(_, db_x, db_y, det_R):
+        return calibrated_tth(db_x, db_y, det_R, rows, cols, cos_tth, sin_tth)
+
+    for iteration in range(0, rounds):
+        pixel_tth = model(None, *params)
+        target = _nearest_peak(pixel_tth, peaks)
+        use = np.abs(pixel_tth - target) < window
+        if use.sum() < 3:
+            raise ValueError("The calibration moved away from every peak, check the starting values and peak list")
+        rows, cols, cos_tth, sin_tth, weights = rows[use], cols[use], cos_tth[use], sin_tth[use], weights[use]
+        params, covariance = curve_fit(model, np.arange(use.sum()), target[use], p0=params, sigma=1.0/np.sqrt(weights))
+        if progress_callback:
+            progress_callback(0.5 + 0.5*(iteration + 1)/rounds)
+    residual = model(None, *params) - target[use]
+    return {'db_pixel': [float(params[0]), float(params[1])], 'det_R': float(params[2]),
+            'esd': np.sqrt(np.diag(covariance)).tolist(), 'pixels': int(len(residual)),
+            'rms': float(np.sqrt(np.mean(residual**2)))}
+
+def write_calibration(filename, db_pixel, det_R):
+    # Write a calibration file in the layout Read_Cal expects (value last on each line)
+    with open(filename, "w") as cal:
+        cal.write(f"db_x {db_pixel[0]:.4f}\n")
+        cal.write(f"db_y {db_pixel[1]:.4f}\n")
+        cal.write(f"det_R {det_R:.4f}\n")
@@ -0,0 +1,150 @@
+import os
+import re
+import time
+import argparse
+
+# Frames are written as <user>_<spec name>_scan<N>_<frame>.raw, the names IntegrationEngine.integrate reads
+FRAME_NAME = re.compile(r"^(?P<prefix>.+)_scan(?P<scan>\d+)_(?P<frame>\d+)\.raw$")
+# Step scans whose point count is the second to last argument (intervals) plus one
+STEP_SCANS = {'ascan', 'dscan', 'a2scan', 'd2scan', 'a3scan', 'd3scan', 'lup', 'dscan_ct'}
+
+
+def read_spec_scans(filename):
+    """{scan number: (points recorded, points planned or None, finished)} from one pass over a SPEC file.
+
+    Points are counted the way SPECread reads them, up to the first line after #L that is not a data line.
+    A scan is finished once a later scan has started, it has all its planned points, or SPEC noted it was aborted.
+    """
+    scans = {}
+    scan = None
+    points = planned = None
+    reading = False
+    aborted = False
+
+    def close():
+        if scan is not None:
+            scans[scan] = [points, planned, aborted or (planned is not None and points >= planned)]
+
+    with open(filename) as spec:
+        for line in spec:
+            if line.startswith("#S"):
+                close()
+                if scan is not None:
+                    scans[scan][2] = True  # a later scan has started
+                tokens = line.split()
+                scan = int(tokens[1])
+                points = 0
+                planned = None
+                reading = False
+                aborted = False
+                if len(tokens) > 3 and tokens[2] in STEP_SCANS:
+                    try:
+                        planned = int(tokens[-2]) + 1
+                    except ValueError:
+                        pass
+            elif scan is None:
+                continue
+            elif line.startswith("#L"):
+                reading = True
+            elif line.startswith("#C") and "aborted" in line:
+                aborted = True
+            elif reading:
+                tokens = line.split()
+                try:
+                    float(tokens[0])
+                    points += 1
+                except (IndexError, ValueError):
+                    reading = False
+    close()
+    return {scan: tuple(status) for scan, status in scans.items()}
+
+
+class ImageIndex:
+    """Frames of one image directory grouped by scan, kept up to date from the directory's modification time.
+
+    A refresh is one os.scandir pass over the names only (no stat of each file, which is what makes listing large
+    directories slow on network storage), it is skipped while the directory's mtime is unchanged and only names that
+    are new since the last pass are parsed.
+    """
+    settle_time = 2.0  # a directory modified this recently is rescanned next time, files written in the same mtime tick would be missed
+
+    def __init__(self, image_path):
+        self.image_path = image_path
+        self._mtime = None
+        self._names = set()
+        self._frames = {}  # (user_specname prefix, scan) -> set of frame numbers
+        self._spec_cache = {}  # SPEC file -> ((mtime, size), read_spec_scans result)
+
+    def refresh(self):
+        """Bring the index up to date, returns True when the directory had to be read again."""
+        stat = os.stat(self.image_path)
+        if stat.st_mtime_ns == self._mtime:
+            return False
+        with os.scandir(self.image_path) as entries:
+            names = {entry.name for entry in entries if entry.name.endswith(".raw")}
+        for name in names - self._names:
+            match = FRAME_NAME.match(name)
+            if match:
+                self._frames.setdefault((match['prefix'], int(match['scan'])), set()).add(int(match['frame']))
+        for name in self._names - names:
+            match = FRAME_NAME.match(name)
+            if match:
+                self._frames.get((match['prefix'], int(match['scan'])), set()).discard(int(match['frame']))
+        self._names = names
+        self._mtime = None if time.time() - stat.st_mtime < self.settle_time else stat.st_mtime_ns
+        return True
+
+    def frames(self, user, spec_name, scan_num):
+        """Sorted frame numbers on disk for one scan."""
+        return sorted(self._frames.get((f"{user}_{spec_name}", int(scan_num)), ()))
+
+    def spec_scans(self, specfile):
+        """read_spec_scans for a SPEC file, read again only when the file has changed."""
+        stat = os.stat(specfile)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self._spec_cache.get(specfile)
+        if cached is None or cached[0] != signature:
+            cached = (signature, read_spec_scans(specfile))
+            self._spec_cache[specfile] = cached
+        return cached[1]
+
+    def scan_status(self, specfile, user, output_path=None):
+        """One dict per scan of the SPEC file: scan, points, planned, frames, finished, complete and integrated.
+
+        A scan is complete when it has finished and there is an image for every one of its points; it counts as
+        integrated when output_path holds its <spec name>_scan<N>.xye pattern.
+        """
+        self.refresh()
+        spec_name = os.path.basename(specfile)
+        outputs = set()
+        if output_path and os.path.isdir(output_path):
+            with os.scandir(output_path) as entries:
+                outputs = {entry.name for entry in entries}
+        rows = []
+        for scan, (points, planned, finished) in sorted(self.spec_scans(specfile).items()):
+            frames = self._frames.get((f"{user}_{spec_name}", scan), set())
+            present = sum(1 for k in range(points) if k in frames)
+            rows.append({'scan': scan, 'points': points, 'planned': planned, 'frames': present, 'finished': finished,
+                         'complete': finished and points > 0 and present == points,
+                         'integrated': f"{spec_name}_scan{scan}.xye" in outputs})
+        return rows
+
+    def unintegrated_scans(self, specfile, user, output_path):
+        """Scan numbers that are complete on disk and not integrated into output_path yet, in scan order."""
+        return [row['scan'] for row in self.scan_status(specfile, user, output_path)
+                if row['complete'] and not row['integrated']]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List the complete scans of a SPEC file that are not integrated yet")
+    parser.add_argument('spec_file')
+    parser.add_argument('image_path')
+    parser.add_argument('user')
+    parser.add_argument('output_path', nargs='?', default=None, help="leave out scans already integrated here")
+    args = parser.parse_args()
+    index = ImageIndex(args.image_path)
+    print(" ".join(str(scan) for scan in index.unintegrated_scans(args.spec_file, args.user, args.output_path)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+import math
+import multiprocessing
+import numpy as np
+# scipy is imported inside the functions that use it, like in Integration_engine
+
+PEAK_PARAMS = ('center', 'fwhm', 'area', 'eta', 'background', 'slope')
+_GAUSS = 4.0*math.log(2.0)  # exponent of a gaussian written in terms of its FWHM
+
+
+def pseudo_voigt(x, center, fwhm, area, eta, background, slope, x0=0.0):
+    """Area normalized pseudo-Voigt peak (eta = lorentzian fraction) on a sloping background, slope about x0."""
+    u = (x - center)/fwhm
+    gauss = math.sqrt(_GAUSS/math.pi)/fwhm*np.exp(-_GAUSS*u*u)
+    lorentz = 2.0/(math.pi*fwhm)/(1.0 + 4.0*u*u)
+    return area*(eta*lorentz + (1.0 - eta)*gauss) + background + slope*(x - x0)
+
+
+def pseudo_voigt_jacobian(x, center, fwhm, area, eta, background, slope, x0=0.0):
+    """Derivatives of pseudo_voigt with respect to each of PEAK_PARAMS, one column per parameter."""
+    u = (x - center)/fwhm
+    gauss = math.sqrt(_GAUSS/math.pi)/fwhm*np.exp(-_GAUSS*u*u)
+    denominator = 1.0 + 4.0*u*u
+    lorentz = 2.0/(math.pi*fwhm)/denominator
+    d_gauss_center = gauss*2.0*_GAUSS*u/fwhm
+    d_gauss_fwhm = gauss*(2.0*_GAUSS*u*u - 1.0)/fwhm
+    d_lorentz_center = lorentz*8.0*u/(fwhm*denominator)
+    d_lorentz_fwhm = lorentz*(8.0*u*u/denominator - 1.0)/fwhm
+    jacobian = np.empty((len(x), len(PEAK_PARAMS)))
+    jacobian[:, 0] = area*(eta*d_lorentz_center + (1.0 - eta)*d_gauss_center)
+    jacobian[:, 1] = area*(eta*d_lorentz_fwhm + (1.0 - eta)*d_gauss_fwhm)
+    jacobian[:, 2] = eta*lorentz + (1.0 - eta)*gauss
+    jacobian[:, 3] = area*(lorentz - gauss)
+    jacobian[:, 4] = 1.0
+    jacobian[:, 5] = x - x0
+    return jacobian
+
+
+def estimate_peak(x, y, window):
+    """Starting parameters for a peak in a window from the data alone: tallest point over a straight background."""
+    ends = min(3, max(len(x)//4, 1))
+    left, right = y[:ends].mean(), y[-ends:].mean()
+    slope = (right - left)/max(x[-1] - x[0], 1e-12)
+    x0 = 0.5*(window[0] + window[1])
+    background = 0.5*(left + right) + slope*(x0 - 0.5*(x[0] + x[-1]))
+    net = y - (background + slope*(x - x0))
+    peak = int(np.argmax(net))
+    height = max(net[peak], 0.0)
+    step = (x[-1] - x[0])/max(len(x) - 1, 1)
+    fwhm = max(np.count_nonzero(net > 0.5*height)*step, 2.0*step)
+    return np.array([x[peak], fwhm, height*fwhm*1.0645, 0.5, background, slope])
+
+
+def fit_peak(x, y, e, window, p0=None):
+    """Fit one peak in a window, returns (parameters, esds) in PEAK_PARAMS order.
+
+    p0 (for example the same peak in the previous scan) is used as the starting point when given, the data are
+    weighted by e where it is a usable esd. Raises RuntimeError or ValueError when the fit does not converge.
+    """
+    from scipy.optimize import curve_fit
+    if len(x) < len(PEAK_PARAMS) + 1:
+        raise ValueError("Too few points in the window")
+    x0 = 0.5*(window[0] + window[1])
+    step = (x[-1] - x[0])/max(len(x) - 1, 1)
+    lower = np.array([window[0], 0.5*step, 0.0, 0.0, -np.inf, -np.inf])
+    upper = np.array([window[1], window[1] - window[0], np.inf, 1.0, np.inf, np.inf])
+    p0 = estimate_peak(x, y, window) if p0 is None else np.asarray(p0, dtype=float)
+    # trf needs a start strictly inside the bounds
+    margin = 1e-9*(window[1] - window[0])
+    p0[[0, 1]] = np.clip(p0[[0, 1]], lower[[0, 1]] + margin, upper[[0, 1]] - margin)
+    p0[2] = max(p0[2], 1e-12)
+    p0[3] = min(max(p0[3], 1e-6), 1.0 - 1e-6)
+    usable = np.isfinite(e) & (e > 0)
+    sigma = np.where(usable, e, np.median(e[usable]) if usable.any() else 1.0)
+    params, covariance = curve_fit(
+        lambda x, *p: pseudo_voigt(x, *p, x0=x0), x, y, p0=p0, sigma=sigma, bounds=(lower, upper), method='trf',
+        jac=lambda x, *p: pseudo_voigt_jacobian(x, *p, x0=x0))
+    with np.errstate(invalid='ignore'):
+        return params, np.sqrt(np.diag(covariance))
+
+
+def window_data(x, y, e, window):
+    """The points of a pattern inside a 2-theta window."""
+    lo, hi = np.searchsorted(x, window[0]), np.searchsorted(x, window[1], side='right')
+    return x[lo:hi], y[lo:hi], e[lo:hi]
+
+
+def _fit_row(scan, name, w, window, x, y, e, p0):
+    # Fit one (scan, window), warm started from p0 when there is one and from the data alone if that fails
+    row = {'scan': scan, 'name': name, 'window': w, 'ok': False, 'message': ""}
+    params = None
+    for start in ([p0, None] if p0 is not None else [None]):
+        try:
+            params, esds = fit_peak(x, y, e, window, start)
+            break
+        except (RuntimeError, ValueError) as error:
+            row['message'] = str(error)
+    if params is None:
+        params = esds = np.full(len(PEAK_PARAMS), np.nan)
+    else:
+        row['ok'] = True
+        row['message'] = ""
+    for param, value, esd in zip(PEAK_PARAMS, params, esds):
+        row[param] = float(value)
+        row[param + '_esd'] = float(esd)
+    return row, (params if row['ok'] else None)
+
+
+def _track_chunk(task, row_callback=None):
+    # Fit one window through a run of consecutive scans, each fit warm started from the one before
+    w, window, scans = task
+    rows = []
+    p0 = None
+    for scan, name, x, y, e in scans:
+        row, params = _fit_row(scan, name, w, window, x, y, e, p0)
+        p0 = params if params is not None else p0
+        rows.append(row)
+        if row_callback:
+            row_callback(row)
+    return rows
+
+
+def track_peaks(patterns, windows, processes=1, chunk=25, result_callback=None, progress_callback=None):
+    """Fit the same 2-theta windows in every pattern of a scan series and return one row dict per (window, scan).
+
+    patterns is a list of (name, x, y, e) in scan order and windows a list of (low, high) 2-theta ranges.
+    Along each window the fits are warm started from the neighbouring scan, so peaks that move or broaden slowly
+    converge in a few iterations. With more than one process the windows and runs of chunk scans are fitted in
+    parallel in a spawn pool, each run warm starting from its own first scan. Rows carry the scan index, pattern
+    name, window index, every parameter in PEAK_PARAMS with its esd, and ok/message for fits that failed.
+    result_callback(rows) is called with each batch of finished rows as they arrive, in any order.
+    """
+    windows = [(float(lo), float(hi)) for lo, hi in windows]
+    tasks = []
+    for w, window in enumerate(windows):
+        scans = []
+        for scan, (name, x, y, e) in enumerate(patterns):
+            x, y, e = (np.asarray(a, dtype=float) for a in (x, y, e))
+            scans.append((scan, name) + window_data(x, y, e, window))
+        size = len(scans) if processes <= 1 else max(int(chunk), 1)
+        tasks.extend((w, window, scans[start:start + size]) for start in range(0, len(scans), size))
+    rows = []
+    total = max(len(windows)*len(patterns), 1)
+
+    def finished(batch):
+        rows.extend(batch)
+        if result_callback:
+            result_callback(batch)
+        if progress_callback:
+            progress_callback(len(rows)/total)
+
+    if processes <= 1:
+        for task in tasks:  # reported a row at a time so a live display can follow along
+            _track_chunk(task, lambda row: finished([row]))
+    else:
+        # spawn rather than fork, the GUI process is multithreaded (see Integration_shared)
+        with multiprocessing.get_context('spawn').Pool(min(processes, len(tasks) or 1)) as pool:
+            for batch in pool.imap_unordered(_track_chunk, tasks):
+                finished(batch)
+    rows.sort(key=lambda row: (row['window'], row['scan']))
+    return rows
+
+
+def read_xye(filename):
+    """Read an .xye pattern written by Integration_engine.write_data (or any whitespace separated x y e file)."""
+    data = np.loadtxt(filename, usecols=(0, 1, 2), ndmin=2, comments='#')
+    return data[:, 0], data[:, 1], data[:, 2]
+
+
+def write_peak_table(filename, rows):
+    """Save tracked peaks as a tab separated table, one line per (window, scan)."""
+    columns = ['window', 'scan', 'name'] + [name + suffix for name in PEAK_PARAMS for suffix in ('', '_esd')] + ['ok']
+    with open(filename, "w") as table:
+        table.write("\t".join(columns) + "\n")
+        for row in rows:
+            table.write("\t".join(str(row[column]) for column in columns) + "\n")
@@ -0,0 +1,401 @@
+import argparse
+import base64
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+import numpy as np
+import Integration_engine as engine
+
+DEFAULT_PORT = 8765
+PROGRESS_STEP = 0.01  # progress events are only streamed when the fraction done moves this much
+KEEP_JOBS = 1000  # finished job records kept in the queue directory, older ones are pruned
+KEEP_DAYS = 7.0  # finished jobs older than this are pruned whatever their number
+FINISHED = ('done', 'failed')
+
+
+def encode_array(array):
+    """JSON friendly form of an array, the raw bytes in base64 with dtype and shape."""
+    array = np.ascontiguousarray(array)
+    return {'dtype': array.dtype.str, 'shape': list(array.shape), 'data': base64.b64encode(array.tobytes()).decode('ascii')}
+
+
+def decode_array(encoded):
+    return np.frombuffer(base64.b64decode(encoded['data']), dtype=encoded['dtype']).reshape(encoded['shape'])
+
+
+def _write_json(filename, record):
+    # Written next to the target and swapped in, a crash never leaves a half written job record
+    with open(filename + ".tmp", 'w') as f:
+        json.dump(record, f)
+    os.replace(filename + ".tmp", filename)
+
+
+class JobStore:
+    """Job records and results kept in a directory, so queued work survives a server restart.
+
+    Each job is <id>.json (request and status), finished jobs also have <id>.npz holding x, y, e and any cake arrays
+    until a client has fetched it. Finished jobs beyond the newest keep_jobs, or finished more than keep_days ago,
+    are pruned when the store is opened and after every job.
+    """
+
+    def __init__(self, directory, keep_jobs=KEEP_JOBS, keep_days=KEEP_DAYS):
+        self.directory = directory
+        self.keep_jobs = keep_jobs
+        self.keep_days = keep_days
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith('.json'):
+                with open(os.path.join(directory, filename)) as f:
+                    record = json.load(f)
+                self.jobs[record['id']] = record
+        self._next = max([int(job) for job in self.jobs], default=0) + 1
+        self.prune()
+
+    def path(self, job, extension):
+        return os.path.join(self.directory, job + extension)
+
+    def _remove(self, job, extensions):
+        for extension in extensions:
+            try:
+                os.remove(self.path(job, extension))
+            except FileNotFoundError:
+                pass
+
+    def prune(self):
+        """Delete the records and results of finished jobs past the retention limits, returns how many went."""
+        with self.lock:
+            finished = sorted((job for job, record in self.jobs.items() if record['status'] in FINISHED), reverse=True)
+            cutoff = time.time() - self.keep_days*86400.0
+            expired = finished[self.keep_jobs:] + [job for job in finished[:self.keep_jobs]
+                                                   if self.jobs[job].get('finished', 0.0) < cutoff]
+            for job in expired:
+                self._remove(job, ('.npz', '.json'))
+                del self.jobs[job]
+        return len(expired)
+
+    def delete(self, job):
+        """Delete a finished job's record and result."""
+        with self.lock:
+            record = self.jobs.get(job)
+            if record is None:
+                raise KeyError(f"Unknown job {job}")
+            if record['status'] not in FINISHED:
+                raise ValueError(f"Job {job} is still {record['status']}")
+            self._remove(job, ('.npz', '.json'))
+            del self.jobs[job]
+
+    def add(self, request):
+        with self.lock:
+            job = f"{self._next:08d}"
+            self._next += 1
+            record = {'id': job, 'status': 'queued', 'request': request, 'submitted': time.time(),
+                      'name': None, 'error': None}
+            self.jobs[job] = record
+            _write_json(self.path(job, '.json'), record)
+        return record
+
+    def update(self, job, **fields):
+        with self.lock:
+            record = self.jobs[job]
+            record.update(fields)
+            _write_json(self.path(job, '.json'), record)
+        return dict(record)
+
+    def get(self, job):
+        with self.lock:
+            record = self.jobs.get(job)
+            return dict(record) if record is not None else None
+
+    def unfinished(self):
+        """Jobs that were queued or running when the store was last closed, oldest first."""
+        with self.lock:
+            return [job for job in sorted(self.jobs) if self.jobs[job]['status'] in ('queued', 'running')]
+
+    def save_result(self, job, x, y, e, cake=None):
+        arrays = {'x': x, 'y': y, 'e': e}
+        for key, value in (cake or {}).items():
+            arrays['cake_' + key] = value
+        with open(self.path(job, '.npz.tmp'), 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(self.path(job, '.npz.tmp'), self.path(job, '.npz'))
+
+    def discard_result(self, job):
+        """Delete a delivered result, the job record stays (marked fetched) until it is pruned."""
+        self._remove(job, ('.npz',))
+        self.update(job, fetched=True)
+
+    def load_result(self, job):
+        if self.get(job).get('fetched'):
+            raise FileNotFoundError(f"The result of job {job} was already fetched")
+        with np.load(self.path(job, '.npz')) as arrays:
+            result = {key: arrays[key] for key in arrays.files}
+        cake = {key[5:]: result.pop(key) for key in list(result) if key.startswith('cake_')}
+        return result, cake or None
+
+
+class IntegrationServer(socketserver.ThreadingTCPServer):
+    """Integration service shared by several GUIs and scripts on one machine.
+
+    Jobs are queued in a JobStore and run by a pool of worker threads, each keeping its own warm IntegrationEngine
+    (bin maps, masks, shared memory pool) between jobs. Detector maps are built once per calibration and shared.
+    Clients talk to it with one JSON object per line, see IntegrationClient.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, queue_dir, workers=1, keep_jobs=KEEP_JOBS, keep_days=KEEP_DAYS):
+        super().__init__(address, _RequestHandler)
+        self.store = JobStore(queue_dir, keep_jobs, keep_days)
+        self.changed = threading.Condition()  # notified whenever any job gets a new event
+        self.events = {}  # job id -> progress events of a running job
+        self._maps = {}
+        self._maps_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for job in self.store.unfinished():  # resume whatever was left over from the last run
+            self.store.update(job, status='queued')
+            self._queue.put(job)
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def submit(self, request):
+        record = self.store.add(request)
+        self._queue.put(record['id'])
+        return record
+
+    def get_map(self, db_pixel, det_R, shape=engine.DEFAULT_SHAPE):
+        key = (tuple(float(p) for p in db_pixel), float(det_R), tuple(shape))
+        with self._maps_lock:
+            if key not in self._maps:
+                self._maps[key] = engine.make_map(list(key[0]), key[1], key[2])
+            return self._maps[key]
+
+    def _notify(self, job, event=None):
+        with self.changed:
+            if event is not None:
+                self.events.setdefault(job, []).append(event)
+            self.changed.notify_all()
+
+    def _work(self):
+        # Worker thread: run queued jobs one at a time on this thread's own engine
+        integrator = engine.IntegrationEngine()
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            request = self.store.get(job)['request']
+            self.store.update(job, status='running', started=time.time())
+            self._notify(job)
+            last = [0.0]
+
+            def progress(fraction, job=job):
+                if fraction - last[0] >= PROGRESS_STEP or fraction >= 1.0:
+                    last[0] = fraction
+                    self._notify(job, {'event': 'progress', 'fraction': fraction})
+
+            integrator.set_progress_callback(progress)
+            try:
+                xyz_map = self.get_map(request['db_pixel'], request['det_R'], engine.detector_shape(request['settings']))
+                integrate = integrator.integrate_var if request.get('use_variance') else integrator.integrate
+                name, x, y, e = integrate(request['spec_path'], request['scan_num'], request['image_path'],
+                                          request['user'], xyz_map, request['settings'])
+                self.store.save_result(job, x, y, e, integrator.last_cake)
+                self.store.update(job, status='done', name=name, finished=time.time())
+            except Exception as e:
+                self.store.update(job, status='failed', error=str(e), finished=time.time())
+            with self.changed:
+                self.events.pop(job, None)  # the finished record and result file are all a watcher needs now
+                self.changed.notify_all()
+            self.store.prune()
+        integrator.close()
+
+    def watch(self, job):
+        """Yield event dicts for a job until it finishes, ending with its 'result' or 'error' event."""
+        sent = 0
+        while True:
+            with self.changed:
+                record = self.store.get(job)
+                events = self.events.get(job, [])
+                if record is not None and sent >= len(events) and record['status'] in ('queued', 'running'):
+                    self.changed.wait(1.0)
+                    record = self.store.get(job)
+                    events = self.events.get(job, [])
+                new = events[sent:]
+            if record is None:
+                yield {'event': 'error', 'job': job, 'message': f"Unknown job {job}"}
+                return
+            sent += len(new)
+            yield from new
+            if record['status'] == 'done':
+                try:
+                    result, cake = self.store.load_result(job)
+                except FileNotFoundError as e:
+                    yield {'event': 'error', 'job': job, 'message': str(e)}
+                    return
+                event = {'event': 'result', 'job': job, 'name': record['name']}
+                event.update({key: encode_array(result[key]) for key in ('x', 'y', 'e')})
+                event['cake'] = {key: encode_array(value) for key, value in cake.items()} if cake else None
+                yield event
+                # only resumed once the event has been sent, a client that dropped the connection can watch again
+                self.store.discard_result(job)
+                return
+            if record['status'] == 'failed':
+                yield {'event': 'error', 'job': job, 'message': record['error']}
+                return
+            if new or record['status'] == 'running':
+                continue
+            yield {'event': 'status', 'job': job, 'status': record['status']}  # still queued, keeps the line alive
+
+    def stop(self):
+        """Stop accepting connections and let the workers finish their current job."""
+        self.shutdown()
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self.server_close()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    # One JSON request per connection, answered by one or more JSON lines
+
+    def send(self, message):
+        self.wfile.write(json.dumps(message).encode() + b"\n")
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            op = request.get('op')
+            if op == 'submit':
+                record = self.server.submit(request['job'])
+                self.send({'job': record['id'], 'status': record['status']})
+            elif op == 'status':
+                record = self.server.store.get(request['job'])
+                self.send(record if record is not None else {'error': f"Unknown job {request['job']}"})
+            elif op == 'jobs':
+                self.send({'jobs': [self.server.store.get(job) for job in sorted(self.server.store.jobs)]})
+            elif op == 'watch':
+                for event in self.server.watch(request['job']):
+                    self.send(event)
+            elif op == 'delete':
+                self.server.store.delete(request['job'])
+                self.send({'job': request['job'], 'deleted': True})
+            elif op == 'ping':
+                self.send({'ok': True})
+            else:
+                self.send({'error': f"Unknown operation {op}"})
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client went away, any job it submitted carries on
+        except Exception as e:
+            self.send({'error': str(e)})
+
+
+class IntegrationClient:
+    """Submit scans to an IntegrationServer and stream back progress and results."""
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    @classmethod
+    def from_address(cls, address, timeout=None):
+        """Client for a 'host:port' (or bare 'host') string."""
+        host, _, port = address.strip().partition(':')
+        return cls(host or '127.0.0.1', int(port) if port else DEFAULT_PORT, timeout)
+
+    def _request(self, message):
+        # Send one request and yield each reply line
+        with socket.create_connection((self.host, self.port), timeout=self.timeout) as sock:
+            sock.sendall(json.dumps(message).encode() + b"\n")
+            with sock.makefile('rb') as replies:
+                for line in replies:
+                    reply = json.loads(line)
+                    if 'error' in reply and 'event' not in reply:
+                        raise RuntimeError(reply['error'])
+                    yield reply
+
+    def _call(self, message):
+        return next(self._request(message))
+
+    def ping(self):
+        return self._call({'op': 'ping'}).get('ok', False)
+
+    def submit(self, spec_path, scan_num, image_path, user, db_pixel, det_R, settings, use_variance=False):
+        """Queue one scan and return its job id."""
+        job = {'spec_path': spec_path, 'scan_num': int(scan_num), 'image_path': image_path, 'user': user,
+               'db_pixel': [float(p) for p in db_pixel], 'det_R': float(det_R),
+               'settings': dict(settings), 'use_variance': bool(use_variance)}
+        return self._call({'op': 'submit', 'job': job})['job']
+
+    def status(self, job):
+        return self._call({'op': 'status', 'job': job})
+
+    def jobs(self):
+        return self._call({'op': 'jobs'})['jobs']
+
+    def delete(self, job):
+        """Remove a finished job from the server's queue directory."""
+        return self._call({'op': 'delete', 'job': job})
+
+    def watch(self, job):
+        """Yield a job's events as they happen: 'progress' (fraction), 'status', then 'result' or 'error'.
+
+        Arrays in the result event (x, y, e and the cake, if any) are decoded to numpy arrays.
+        """
+        for event in self._request({'op': 'watch', 'job': job}):
+            if event['event'] == 'result':
+                for key in ('x', 'y', 'e'):
+                    event[key] = decode_array(event[key])
+                if event['cake']:
+                    event['cake'] = {key: decode_array(value) for key, value in event['cake'].items()}
+            yield event
+
+    def integrate(self, spec_path, scan_num, image_path, user, db_pixel, det_R, settings, use_variance=False,
+                  progress_callback=None):
+        """Submit a scan and wait for it, returning (outname, x, y, e) like IntegrationEngine.integrate."""
+        job = self.submit(spec_path, scan_num, image_path, user, db_pixel, det_R, settings, use_variance)
+        for event in self.watch(job):
+            if event['event'] == 'progress' and progress_callback:
+                progress_callback(event['fraction'])
+            elif event['event'] == 'result':
+                return event['name'], event['x'], event['y'], event['e']
+            elif event['event'] == 'error':
+                raise RuntimeError(event['message'])
+        raise RuntimeError(f"Connection to the integration server closed before job {job} finished")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local integration server shared by GUIs and scripts.")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on (default: localhost only)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=1, help="scans integrated at the same time")
+    parser.add_argument('--queue-dir', default=os.path.join(os.path.expanduser('~'), '.pilatus_integration_jobs'),
+                        help="directory holding the persistent job queue and results")
+    parser.add_argument('--keep-jobs', type=int, default=KEEP_JOBS, help="finished jobs kept in the queue directory")
+    parser.add_argument('--keep-days', type=float, default=KEEP_DAYS, help="days a finished job is kept")
+    args = parser.parse_args()
+    server = IntegrationServer((args.host, args.port), args.queue_dir, args.workers, args.keep_jobs, args.keep_days)
+    print(f"Integration server listening on {args.host}:{server.port} with {args.workers} worker(s), "
+          f"jobs in {args.queue_dir}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
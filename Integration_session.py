@@ -0,0 +1,81 @@
+import json
+import os
+import threading
+import zipfile
+from collections.abc import Mapping
+import numpy as np
+
+SESSION_VERSION = 1
+_archive_lock = threading.Lock()  # patterns are read from both the GUI and the plot worker thread
+
+
+class LazyPattern(Mapping):
+    """One pattern of a restored session, its x/y/e arrays are only read from the archive when first used."""
+
+    def __init__(self, archive, index):
+        self.archive = archive
+        self.index = index
+        self._data = None
+
+    def load(self):
+        if self._data is None:
+            with _archive_lock:
+                if self._data is None:
+                    self._data = {key: self.archive[f"{key}_{self.index}"] for key in ('x', 'y', 'e')}
+        return self._data
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __iter__(self):
+        return iter(('x', 'y', 'e'))
+
+    def __len__(self):
+        return 3
+
+
+def save_session(filename, plot_data, names, selected, plot_settings, integration_settings, paths=None, dates=None):
+    """Write every pattern plus list order, selection and settings to one compressed NPZ file.
+
+    plot_settings may hold a QColor under 'line_color', it is stored as its hex name.
+    """
+    arrays = {}
+    for index, name in enumerate(names):
+        data = plot_data[name]
+        for key in ('x', 'y', 'e'):
+            arrays[f"{key}_{index}"] = np.asarray(data[key])
+    plot_settings = dict(plot_settings)
+    if hasattr(plot_settings.get('line_color'), 'name'):
+        plot_settings['line_color'] = plot_settings['line_color'].name()
+    session = {'version': SESSION_VERSION,
+               'names': list(names),
+               'selected': list(selected),
+               'plot_settings': plot_settings,
+               'integration_settings': integration_settings,
+               'paths': paths or {},
+               'dates': {name: dates[name] for name in names if name in dates} if dates else {}}
+    arrays['session'] = np.array(json.dumps(session))
+    # Same layout as np.savez_compressed (np.load reads it) but at the fastest deflate level, float patterns barely
+    # compress further at higher levels and saving thousands of them would take minutes.
+    # Written next to the target and swapped in, so an interrupted save never leaves a half written session.
+    temp_name = filename + ".tmp"
+    with zipfile.ZipFile(temp_name, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1, allowZip64=True) as archive:
+        for key, array in arrays.items():
+            with archive.open(key + '.npy', 'w', force_zip64=True) as member:
+                np.lib.format.write_array(member, array, allow_pickle=False)
+    os.replace(temp_name, filename)
+
+
+def load_session(filename):
+    """Open a session file and return (archive, session dict, {name: LazyPattern}).
+
+    Only the small session record is read here, the archive stays open so patterns can be read on demand;
+    close it with archive.close() once the session is replaced.
+    """
+    archive = np.load(filename)
+    session = json.loads(str(archive['session']))
+    if session.get('version', 0) > SESSION_VERSION:
+        archive.close()
+        raise ValueError(f"Session file version {session['version']} is newer than this program supports")
+    plot_data = {name: LazyPattern(archive, index) for index, name in enumerate(session['names'])}
+    return archive, session, plot_data
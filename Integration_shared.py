@@ -0,0 +1,214 @@
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import Integration_engine as engine
+
+
+def _open_block(name):
+    # Attach to an existing block by name, keeping it out of this process's resource tracker where Python allows it
+    # The publishing process owns the block and is the only one that should ever unlink it
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedArrays:
+    """Numpy arrays stored in named shared memory blocks so worker processes can map them without copying."""
+
+    def __init__(self, owner=True):
+        self.owner = owner  # only the publishing process unlinks the blocks
+        self.arrays = {}
+        self._blocks = {}
+
+    def create(self, name, shape, dtype):
+        """Create a zeroed shared array, replacing any earlier array published under the same name."""
+        self.release(name)
+        dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape))*dtype.itemsize, 1)
+        self._blocks[name] = shared_memory.SharedMemory(create=True, size=size)
+        self.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=self._blocks[name].buf)
+        self.arrays[name][...] = 0
+        return self.arrays[name]
+
+    def publish(self, name, array):
+        """Copy an array into shared memory once and return the shared view."""
+        array = np.asarray(array)
+        view = self.create(name, array.shape, array.dtype)
+        view[...] = array
+        return view
+
+    def descriptor(self):
+        """Small picklable description of every array, this is all that is sent to a worker process."""
+        return {name: (self._blocks[name].name, self.arrays[name].shape, self.arrays[name].dtype.str)
+                for name in self.arrays}
+
+    @classmethod
+    def attach(cls, descriptor):
+        """Map every array in a descriptor from another process, zero copies."""
+        shared = cls(owner=False)
+        for name, (block, shape, dtype) in descriptor.items():
+            shared._blocks[name] = _open_block(block)
+            shared.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shared._blocks[name].buf)
+        return shared
+
+    def release(self, name):
+        """Unmap one array, and free its block if this process published it."""
+        if name not in self._blocks:
+            return
+        self.arrays.pop(name, None)
+        block = self._blocks.pop(name)
+        try:
+            block.close()
+        except BufferError:
+            pass  # a caller still holds a view, the mapping goes away with it
+        if self.owner:
+            block.unlink()
+
+    def close(self):
+        """Unmap (and for the owner, free) every array."""
+        for name in list(self._blocks):
+            self.release(name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FrameRing:
+    """Ring of shared frame buffers, the reading process fills a free slot and hands only its index to a worker."""
+
+    def __init__(self, shared, nslots, frame_size, dtype='int32'):
+        self.frames = shared.create('frames', (nslots, frame_size), dtype)
+        self.free = collections.deque(range(0, nslots))
+
+    def put(self, data):
+        slot = self.free.popleft()
+        self.frames[slot] = data.ravel()
+        return slot
+
+    def release(self, slot):
+        self.free.append(slot)
+
+
+# Arrays this worker process has attached to, keyed on block name so each block is only mapped once
+_attached = {}
+
+
+def _worker_view(descriptor, name):
+    block, shape, dtype = descriptor[name]
+    if block not in _attached:
+        current = set(entry[0] for entry in descriptor.values())
+        for stale in [b for b in _attached if b not in current]:  # geometry was republished, drop the old mapping
+            shm, view = _attached.pop(stale)
+            del view
+            try:
+                shm.close()
+            except BufferError:
+                pass
+        shm = _open_block(block)
+        _attached[block] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    return _attached[block][1]
+
+
+def _bin_slot(descriptor, slot, position, i0, nbins, outlier):
+    # Runs in a worker process: bin one frame from the ring and return only the span of bins it touched
+    frame = _worker_view(descriptor, 'frames')[slot]
+    pix_index = _worker_view(descriptor, 'pix_index')
+    bins = _worker_view(descriptor, 'bins')[position]
+    y = frame[pix_index]/i0
+    if 'weights' in descriptor:  # intensity corrections are on
+        y *= _worker_view(descriptor, 'weights')[position]
+    keep = y >= 0
+    if outlier is not None:
+        method, threshold, max_iter = outlier
+        keep = engine.reject_outliers(bins, y, keep, method=method, threshold=threshold, max_iter=max_iter)
+    y_1 = keep.astype(float)
+    lo = int(bins.min())
+    span = max(min(int(bins.max()) + 1, nbins) - lo, 0)
+    local = bins - lo
+    sums = np.bincount(local, weights=y*y_1, minlength=span)[:span]
+    norms = np.bincount(local, weights=y_1, minlength=span)[:span]
+    return lo, sums, norms
+
+
+class SharedIntegrationPool:
+    """Process pool that bins frames against geometry and frame buffers published once in shared memory."""
+
+    def __init__(self, processes, nslots=None, frame_size=engine.DEFAULT_SHAPE[0]*engine.DEFAULT_SHAPE[1]):
+        self.processes = processes
+        self.nslots = nslots or 2*processes
+        self.frame_size = frame_size  # pixels in one detector frame
+        self.shared = SharedArrays()
+        self.ring = FrameRing(self.shared, self.nslots, frame_size)
+        # spawn rather than fork, the GUI process is multithreaded and frozen builds only support spawn on Windows
+        self.pool = multiprocessing.get_context('spawn').Pool(processes)
+        self._geometry_key = None
+        self._pending = collections.deque()
+        self.digit_y = None
+        self.digit_norm = None
+        self.contributions = {}  # frame number -> (first bin, sums, norms) of each retired frame, for the ledger
+
+    def publish_geometry(self, key, xyz_map, pix_index, bin_maps, weight_maps=None):
+        """Publish the geometry map, pixel index, cached bin maps and any correction weights for a scan's positions,
+        unless already shared."""
+        if key == self._geometry_key:
+            return
+        self.shared.publish('xyz_map', xyz_map)
+        self.shared.publish('pix_index', pix_index)
+        self.shared.publish('bins', np.array(bin_maps, dtype=np.int32))
+        if weight_maps is not None:
+            self.shared.publish('weights', np.array(weight_maps))
+        else:
+            self.shared.release('weights')
+        self._geometry_key = key
+
+    def start_scan(self, nbins):
+        # Frames still queued from a scan that was abandoned part way (a stopped worker) are waited for and dropped
+        while self._pending:
+            slot, result, _ = self._pending.popleft()
+            result.wait()
+            self.ring.release(slot)
+        self.digit_y = np.zeros(nbins)
+        self.digit_norm = np.zeros(nbins)
+        self.contributions = {}
+
+    def submit(self, data, position, i0, outlier=None, frame=None):
+        """Copy a frame into a free ring slot and queue it for binning, waiting on the oldest frame if the ring is full.
+
+        When a frame number is given its binned span is kept in contributions.
+        """
+        if not self.ring.free:
+            self._retire()
+        slot = self.ring.put(data)
+        result = self.pool.apply_async(_bin_slot, (self.shared.descriptor(), slot, position, float(i0),
+                                                   len(self.digit_y), outlier))
+        self._pending.append((slot, result, frame))
+
+    def _retire(self):
+        slot, result, frame = self._pending.popleft()
+        try:
+            lo, sums, norms = result.get()
+        finally:
+            self.ring.release(slot)  # the worker is done with the slot whether or not it raised
+        if frame is not None:
+            self.contributions[frame] = (lo, sums, norms)
+        self.digit_y[lo:lo + len(sums)] += sums
+        self.digit_norm[lo:lo + len(norms)] += norms
+
+    def finish(self):
+        """Wait for every queued frame and return the scan's (digit_y, digit_norm) accumulators."""
+        while self._pending:
+            self._retire()
+        return self.digit_y, self.digit_norm
+
+    def close(self):
+        """Stop the worker processes and free every shared block."""
+        self.pool.terminate()
+        self.pool.join()
+        self._pending.clear()
+        self.ring = None
+        self.shared.close()
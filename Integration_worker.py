@@ -1,18 +1,50 @@
+import os
+import queue
+import time
 from PyQt5.QtCore import QThread, pyqtSignal
 import numpy as np
 import Integration_engine as engine
+import Integration_peaks as peaks
 
-class IntegrationWorker(QThread):
+
+class Cancelled(Exception):
+    """Raised from a stopped worker's progress callback to leave the engine call it is in."""
+
+
+class StoppableWorker(QThread):
+    """Background thread that stops at its next progress report once stop() is called.
+
+    Workers share the GUI's engine (and its worker processes), so they are never terminated: the progress callback
+    raises Cancelled between frames instead, which leaves the engine's caches as they were before the call.
+    """
+    progress_percent = pyqtSignal(int)  # percentage done
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._stop = False
+
+    def stop(self):
+        """Ask the thread to stop, wait() for it to end."""
+        self._stop = True
+
+    def stopped(self):
+        return self._stop
+
+    def report_progress(self, fraction):
+        if self._stop:
+            raise Cancelled()
+        self.progress_percent.emit(int(100 * fraction))
+
+
+class IntegrationWorker(StoppableWorker):
     # Signals to communicate with the GUI thread
-    #progress_updated = pyqtSignal(str)  # Status text
-    #progress_value = pyqtSignal(int)    # Progress percentage (0-100)
-    #progress_updated = pyqtSignal(str)          # Status messages (e.g., "Processing Scan 1...")
-    #result_ready = pyqtSignal(str, np.ndarray, np.ndarray, np.ndarray)  # scan_name, x, y, e
-    #error_occurred = pyqtSignal(str)            # Error messages
-    # Add progress signal
-    progress_percent = pyqtSignal(int)  # New signal for percentage
-
-    def __init__(self, spec_path, scan_num, image_path, user, xyz_map, settings, use_variance=False):
+    progress_updated = pyqtSignal(str)          # Status messages (e.g., "Processing Scan 1...")
+    result_ready = pyqtSignal(str, np.ndarray, np.ndarray, np.ndarray)  # scan_name, x, y, e
+    error_occurred = pyqtSignal(str)            # Error messages
+    cake_ready = pyqtSignal(str, object)        # scan_name, (2-theta, chi) cake dict when caked integration is on
+
+    def __init__(self, spec_path, scan_num, image_path, user, xyz_map, settings, use_variance=False, integrator=None,
+                 calibration=None):
         super().__init__()
         self.spec_path = spec_path
         self.scan_num = scan_num
@@ -21,25 +53,283 @@ class IntegrationWorker(QThread):
         self.xyz_map = xyz_map
         self.settings = settings
         self.use_variance = use_variance
+        # Reuse the GUI's engine when given so that masks and other per-session caches survive from scan to scan
+        self.integrator = integrator if integrator is not None else engine.IntegrationEngine()
+        self.calibration = calibration  # (db_pixel, det_R), sent instead of the map when a server does the work
 
     def run(self):
         """Runs in the background thread."""
         try:
             self.progress_updated.emit(f"Starting integration for Scan {self.scan_num}...")
+            self.integrator.set_progress_callback(self.report_progress)
             
-            if self.use_variance:
-                scan_name, x, y, e = integrate_var(
+            merge = isinstance(self.scan_num, (list, tuple))  # repeat scans merged into one pattern
+            if self.settings.get('server') and not merge:  # merging needs this engine's cached accumulators
+                self.run_on_server()
+                return
+            if merge:
+                scan_name, x, y, e = self.integrator.merge_scans(
+                    self.spec_path, self.scan_num, self.image_path,
+                    self.user, self.xyz_map, self.settings, use_variance=self.use_variance
+                )
+            elif self.use_variance:
+                scan_name, x, y, e = self.integrator.integrate_var(
                     self.spec_path, self.scan_num, self.image_path, 
                     self.user, self.xyz_map, self.settings
                 )
             else:
-                scan_name, x, y, e = integrate(
+                scan_name, x, y, e = self.integrator.integrate(
                     self.spec_path, self.scan_num, self.image_path, 
                     self.user, self.xyz_map, self.settings
                 )
             
+            cake = self.integrator.last_cake
+            if cake is not None:
+                self.cake_ready.emit(scan_name, cake)
             self.result_ready.emit(scan_name, x, y, e)
             self.progress_updated.emit(f"Scan {self.scan_num} completed!")
         
+        except Cancelled:
+            self.progress_updated.emit(f"Scan {self.scan_num} stopped")
+        except Exception as e:
+            self.error_occurred.emit(f"Error in Scan {self.scan_num}: {str(e)}")
+
+    def run_on_server(self):
+        """Integrate the scan on an integration server (settings['server'] is its host:port) and stream the results."""
+        import Integration_server
+        if self.calibration is None:
+            raise ValueError("Integrating on a server needs the calibration (direct beam pixel and detector distance)")
+        client = Integration_server.IntegrationClient.from_address(self.settings['server'])
+        db_pixel, det_R = self.calibration
+        job = client.submit(self.spec_path, self.scan_num, self.image_path, self.user, db_pixel, det_R,
+                            self.settings, self.use_variance)
+        self.progress_updated.emit(f"Scan {self.scan_num} queued on {self.settings['server']} as job {job}")
+        for event in client.watch(job):
+            if event['event'] == 'progress':
+                self.report_progress(event['fraction'])  # stops following the job, the server finishes it
+            elif event['event'] == 'result':
+                if event['cake'] is not None:
+                    self.cake_ready.emit(event['name'], event['cake'])
+                self.result_ready.emit(event['name'], event['x'], event['y'], event['e'])
+                self.progress_updated.emit(f"Scan {self.scan_num} completed!")
+                return
+            elif event['event'] == 'error':
+                raise RuntimeError(event['message'])
+        raise RuntimeError(f"Lost the connection to {self.settings['server']}")
+
+
+class CalibrationWorker(StoppableWorker):
+    """Refines the direct beam pixel and detector distance of a standard's scan in the background."""
+    result_ready = pyqtSignal(object)   # dict from engine.refine_calibration
+    error_occurred = pyqtSignal(str)
+
+    def __init__(self, spec_path, scan_num, image_path, user, db_pixel, det_R, peaks, settings, window=0.3):
+        super().__init__()
+        self.spec_path = spec_path
+        self.scan_num = scan_num
+        self.image_path = image_path
+        self.user = user
+        self.db_pixel = db_pixel
+        self.det_R = det_R
+        self.peaks = peaks
+        self.settings = settings
+        self.window = window
+
+    def run(self):
+        """Runs in the background thread."""
+        try:
+            result = engine.refine_calibration(self.spec_path, self.scan_num, self.image_path, self.user,
+                                               self.db_pixel, self.det_R, self.peaks, self.settings,
+                                               window=self.window,
+                                               progress_callback=self.report_progress)
+            self.result_ready.emit(result)
+        except Cancelled:
+            pass
         except Exception as e:
-            self.error_occurred.emit(f"Error in Scan {self.scan_num}: {str(e)}")
\ No newline at end of file
+            self.error_occurred.emit(f"Calibration refinement failed: {str(e)}")
+
+
+class SweepWorker(StoppableWorker):
+    """Integrates one scan with several settings configurations from a single pass over its frames."""
+    results_ready = pyqtSignal(object)  # [(name, x, y, e)] in the order of the configurations
+    error_occurred = pyqtSignal(str)
+
+    def __init__(self, spec_path, scan_num, image_path, user, xyz_map, configs, integrator=None):
+        super().__init__()
+        self.spec_path = spec_path
+        self.scan_num = scan_num
+        self.image_path = image_path
+        self.user = user
+        self.xyz_map = xyz_map
+        self.configs = configs
+        self.integrator = integrator if integrator is not None else engine.IntegrationEngine()
+
+    def run(self):
+        """Runs in the background thread."""
+        try:
+            self.integrator.set_progress_callback(self.report_progress)
+            results = self.integrator.sweep(self.spec_path, self.scan_num, self.image_path, self.user,
+                                            self.xyz_map, self.configs)
+            self.results_ready.emit(results)
+        except Cancelled:
+            pass
+        except Exception as e:
+            self.error_occurred.emit(f"Settings sweep of Scan {self.scan_num} failed: {str(e)}")
+
+
+class PeakTrackWorker(StoppableWorker):
+    """Fits 2-theta windows through a series of patterns with Integration_peaks.track_peaks."""
+    rows_ready = pyqtSignal(object)     # list of finished row dicts, in the order they complete
+    finished_rows = pyqtSignal(object)  # every row, sorted by window then scan
+    error_occurred = pyqtSignal(str)
+
+    def __init__(self, patterns, windows, processes=1):
+        super().__init__()
+        self.patterns = patterns
+        self.windows = windows
+        self.processes = processes
+
+    def run(self):
+        """Runs in the background thread."""
+        try:
+            rows = peaks.track_peaks(self.patterns, self.windows, processes=self.processes,
+                                     result_callback=self.rows_ready.emit,
+                                     progress_callback=self.report_progress)
+            self.finished_rows.emit(rows)
+        except Cancelled:
+            pass
+        except Exception as e:
+            self.error_occurred.emit(f"Peak tracking failed: {str(e)}")
+
+
+class RoiMonitorWorker(QThread):
+    """Follows a running scan (and the scans after it) frame by frame, binning only the pixels inside 2-theta windows.
+
+    Frames are picked up as soon as their SPEC point and complete image file exist, so the ROI intensities keep up
+    with the detector. Each frame emits a dict with the scan, frame, 2-theta position, the integrated intensity of
+    every window (NaN where the frame does not reach it) and the scan's local pattern so far.
+    """
+    frame_ready = pyqtSignal(object)
+    status = pyqtSignal(str)
+    error_occurred = pyqtSignal(str)
+    poll_interval = 0.2  # seconds between looks at the SPEC file while waiting for the next point
+
+    def __init__(self, spec_path, scan_num, image_path, user, xyz_map, settings, windows, follow=True, integrator=None):
+        super().__init__()
+        self.spec_path = spec_path
+        self.scan_num = scan_num
+        self.image_path = image_path
+        self.user = user
+        self.xyz_map = xyz_map
+        self.settings = dict(settings)
+        self.windows = [(float(lo), float(hi)) for lo, hi in windows]
+        self.follow = follow
+        self.integrator = integrator if integrator is not None else engine.IntegrationEngine()
+        self._stop = False
+
+    def stop(self):
+        self._stop = True
+
+    def run(self):
+        """Runs in the background thread."""
+        try:
+            self.monitor()
+        except Exception as e:
+            self.error_occurred.emit(f"ROI monitoring of Scan {self.scan_num} failed: {str(e)}")
+
+    def wait_for_frame(self, filename, size):
+        # True once the image file is completely written, False if monitoring was stopped first
+        while not self._stop:
+            try:
+                if os.stat(filename).st_size >= size:
+                    return True
+            except OSError:
+                pass
+            time.sleep(0.01)
+        return False
+
+    def monitor(self):
+        stepsize = float(self.settings['stepsize'])
+        shape = engine.detector_shape(self.settings)
+        pix_index = self.integrator.get_pixel_index(self.settings)
+        local_bins, slices = engine.roi_layout(self.windows, stepsize)
+        x = np.arange(0.0, 180.0, stepsize)[local_bins]
+        spec_name = os.path.basename(self.spec_path)
+        scan_num = self.scan_num
+        while not self._stop:
+            tth, i0 = engine.SPECread(self.spec_path, scan_num)
+            sums = np.zeros(len(local_bins))
+            norms = np.zeros(len(local_bins))
+            k = 0
+            self.status.emit(f"Waiting for scan {scan_num}...")
+            while not self._stop:
+                if k >= len(tth):
+                    tth, i0 = engine.SPECread(self.spec_path, scan_num)  # points are appended while the scan runs
+                    if k >= len(tth):
+                        if len(engine.SPECread(self.spec_path, scan_num + 1)[0]):  # the next scan has started
+                            break
+                        time.sleep(self.poll_interval)
+                        continue
+                filename = os.path.join(self.image_path, f"{self.user}_{spec_name}_scan{scan_num}_{str(k).zfill(4)}.raw")
+                if not self.wait_for_frame(filename, 4*shape[0]*shape[1]):
+                    break
+                frame = engine.read_RAW(filename, 0, shape[1], mask=False, shape=shape).ravel()
+                frame_y, frame_norm = self.integrator.roi_frame(frame, self.xyz_map, pix_index, tth[k], i0[k],
+                                                                self.settings, self.windows, len(local_bins))
+                sums += frame_y
+                norms += frame_norm
+                mult = float(i0[0])
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    frame_mean = mult*frame_y/frame_norm
+                    pattern = mult*sums/norms
+                intensity = [float(np.nansum(frame_mean[window])*stepsize) if np.any(frame_norm[window]) else np.nan
+                             for window in slices]
+                self.frame_ready.emit({'scan': scan_num, 'frame': k, 'tth': float(tth[k]), 'time': time.time(),
+                                       'intensity': intensity, 'x': x, 'y': pattern})
+                k += 1
+            if not self.follow:
+                break
+            scan_num += 1
+        self.status.emit("ROI monitoring stopped")
+
+
+class OutputWriter(QThread):
+    """Writes integrated patterns and caked images in the background so slow storage never holds up the GUI or the next scan.
+
+    Files are written in the order they were queued, each one atomically (temporary file, then rename).
+    """
+    file_written = pyqtSignal(str)     # full path of a finished file
+    error_occurred = pyqtSignal(str)   # Error messages
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._queue = queue.Queue()
+
+    def write_data(self, output_path, filename, x, y, e):
+        """Queue a pattern for engine.write_data."""
+        self._queue.put((engine.write_data, output_path, filename, (x, y, e)))
+
+    def write_cake(self, output_path, filename, cake):
+        """Queue a caked image for engine.write_cake."""
+        self._queue.put((engine.write_cake, output_path, filename, (cake,)))
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def stop(self):
+        """Write everything still queued, then end the thread."""
+        self._queue.put(None)
+        self.wait()
+
+    def run(self):
+        """Runs in the background thread."""
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            write, output_path, filename, args = job
+            try:
+                write(output_path, filename, *args)
+                self.file_written.emit(output_path + filename)
+            except Exception as e:
+                self.error_occurred.emit(f"Error writing {filename}: {str(e)}")
@@ -1,25 +1,37 @@
+import time
+_startup_marks = [("start", time.perf_counter())]  # (stage, time) pairs for the startup timing report
 import sys
 import os
-import time
+import re
 import traceback
+import multiprocessing
 import numpy as np
-from scipy import interpolate
-import matplotlib
-import matplotlib.cm as cm  # Import colormap module
-matplotlib.use('Qt5Agg')  # Use the Qt5Agg backend for matplotlib
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas, NavigationToolbar2QT
+# scipy and matplotlib are slow to import and not needed to show the window, they are imported where first used
+# (see PilatusIntegrationGUI.init_plot_canvas, which builds the plot once the window is on screen)
 from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, 
-                             QLineEdit, QPushButton, QFileDialog, QMessageBox, QSizePolicy, QListWidget,
+                             QLineEdit, QPushButton, QFileDialog, QMessageBox, QSizePolicy, QListView,
                              QCheckBox, QStatusBar, QMenuBar, QAction, QDialog, QFormLayout, QSpinBox,
                              QDoubleSpinBox, QColorDialog, QComboBox, QGroupBox, QRadioButton, QAbstractItemView,
-                             QListWidgetItem, QSlider, QStyleFactory, QProgressBar)
+                             QSlider, QStyleFactory, QProgressBar, QTableWidget, QTableWidgetItem)
 from PyQt5.QtGui import QPixmap, QIcon, QDesktopServices
-from PyQt5.QtCore import Qt, QUrl
+from PyQt5.QtCore import Qt, QUrl, QTimer, QAbstractListModel, QModelIndex, QSortFilterProxyModel
 from PyQt5.QtGui import QColor
 from PyQt5.QtCore import QThread, pyqtSignal
 import Integration_engine as engine
 import Integration_worker
+import Integration_session
+import Integration_peaks
+import Integration_index
+import Plot_worker
+_startup_marks.append(("imports", time.perf_counter()))
+
+def startup_report():
+    """Time spent in each startup stage, printed when the program is started with --startup-timing."""
+    lines = []
+    for (_, previous), (stage, now) in zip(_startup_marks, _startup_marks[1:]):
+        lines.append(f"{stage:>14}: {now - previous:.3f} s")
+    lines.append(f"{'total':>14}: {_startup_marks[-1][1] - _startup_marks[0][1]:.3f} s")
+    return "\n".join(lines)
 
 # This is only needed when using pyinstaller to create an executable
 def resource_path(relative_path):
@@ -30,6 +42,20 @@ def resource_path(relative_path):
 
     return os.path.join(base_path, relative_path)
 
+def parse_windows(text):
+    """[(low, high)] 2-theta windows from text like '10.2-10.8; 14.1-14.6', raises ValueError when it does not parse."""
+    windows = []
+    for part in re.split(r"[;,]", text):
+        if not part.strip():
+            continue
+        match = re.fullmatch(r"\s*([0-9.]+)\s*-\s*([0-9.]+)\s*", part)
+        if not match or float(match.group(1)) >= float(match.group(2)):
+            raise ValueError(f"'{part.strip()}' is not a low-high 2-theta range")
+        windows.append((float(match.group(1)), float(match.group(2))))
+    if not windows:
+        raise ValueError("Enter at least one 2-theta window")
+    return windows
+
 class AboutDialog(QDialog):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -103,6 +129,41 @@ class IntegSettingsDialog(QDialog):
         self.error_model_combobox.setCurrentText(self.settings["error_model"])
         layout.addRow("Error Model:", self.error_model_combobox)
         
+        # Binning method, 'split' shares each pixel between the bins it covers (poisson error model only)
+        self.integration_method_combobox = QComboBox()
+        self.integration_method_combobox.addItems(['histogram', 'split'])
+        self.integration_method_combobox.setCurrentText(self.settings.get("integration_method", "histogram"))
+        layout.addRow("Integration Method:", self.integration_method_combobox)
+        
+        # Frame kernel backend, 'auto' uses the numba JIT kernel when numba is installed and numpy otherwise
+        self.backend_combobox = QComboBox()
+        self.backend_combobox.addItems(['auto', 'numpy', 'numba'])
+        self.backend_combobox.setCurrentText(self.settings.get("backend", "auto"))
+        layout.addRow("Compute Backend:", self.backend_combobox)
+        
+        # Stacked binning, chunks of frames reduced together (histogram binning without outlier rejection or caking)
+        self.stacked_checkbox = QCheckBox("Bin frames in stacked chunks")
+        self.stacked_checkbox.setChecked(self.settings.get("stacked", False))
+        layout.addRow(self.stacked_checkbox)
+        
+        # Detector format, sets the frame size (other formats can be typed as 'rows x columns')
+        self.detector_combobox = QComboBox()
+        self.detector_combobox.setEditable(True)
+        self.detector_combobox.addItems(list(engine.DETECTORS))
+        self.detector_combobox.setCurrentText(self.settings.get("detector", engine.DEFAULT_DETECTOR))
+        layout.addRow("Detector:", self.detector_combobox)
+        
+        # Working memory for per-pixel temporaries, larger detectors are processed in blocks of pixels that fit
+        self.memory_budget_spinbox = QSpinBox()
+        self.memory_budget_spinbox.setRange(16, 65536)
+        self.memory_budget_spinbox.setSingleStep(64)
+        self.memory_budget_spinbox.setSuffix(" MB")
+        self.memory_budget_spinbox.setValue(int(self.settings.get("memory_budget", engine.DEFAULT_MEMORY_BUDGET)))
+        self.memory_budget_spinbox.setToolTip("Frames are processed in blocks of pixels whose temporaries fit in this "
+                                              "much memory. Outlier rejection needs whole-frame statistics, so with "
+                                              "it on each frame is processed in one piece.")
+        layout.addRow("Memory Budget:", self.memory_budget_spinbox)
+        
         # Image clip range
         self.img_clip_low_spinbox = QSpinBox()
         self.img_clip_low_spinbox.setRange(0, 487)  # Set the range of allowable values
@@ -115,6 +176,137 @@ class IntegSettingsDialog(QDialog):
         self.img_clip_high_spinbox.setSingleStep(1)  # Set the step size
         self.img_clip_high_spinbox.setValue(self.settings["img_clip_high"])
         layout.addRow("Upper clipping range for images:", self.img_clip_high_spinbox)
+        self.update_clip_range(self.detector_combobox.currentText())
+        self.detector_combobox.currentTextChanged.connect(self.update_clip_range)
+        
+        # Static detector mask (bad pixels, module gaps, beamstop)
+        self.mask_file_input = QLineEdit(self)
+        self.mask_file_input.setText(self.settings.get("mask_file", ""))
+        self.mask_file_button = QPushButton("Browse", self)
+        self.mask_file_button.clicked.connect(self.browse_mask_file)
+        mask_layout = QHBoxLayout()
+        mask_layout.addWidget(self.mask_file_input)
+        mask_layout.addWidget(self.mask_file_button)
+        layout.addRow("Mask File:", mask_layout)
+        
+        # Per-pixel intensity corrections, each one costs nothing while it is switched off
+        self.solid_angle_checkbox = QCheckBox("Solid angle correction")
+        self.solid_angle_checkbox.setChecked(self.settings.get("solid_angle_correction", False))
+        layout.addRow(self.solid_angle_checkbox)
+        
+        self.polarization_checkbox = QCheckBox("Polarization correction")
+        self.polarization_checkbox.setChecked(self.settings.get("polarization_correction", False))
+        layout.addRow(self.polarization_checkbox)
+        
+        self.polarization_fraction_spinbox = QDoubleSpinBox()
+        self.polarization_fraction_spinbox.setDecimals(3)
+        self.polarization_fraction_spinbox.setRange(0.0, 1.0)
+        self.polarization_fraction_spinbox.setSingleStep(0.01)
+        self.polarization_fraction_spinbox.setValue(
+            self.settings.get("polarization_fraction", engine.DEFAULT_POLARIZATION_FRACTION))
+        layout.addRow("Polarization Fraction:", self.polarization_fraction_spinbox)
+        
+        self.flat_field_input = QLineEdit(self)
+        self.flat_field_input.setText(self.settings.get("flat_field_file", ""))
+        self.flat_field_input.setPlaceholderText("blank for no flat field")
+        self.flat_field_button = QPushButton("Browse", self)
+        self.flat_field_button.clicked.connect(self.browse_flat_field)
+        flat_field_layout = QHBoxLayout()
+        flat_field_layout.addWidget(self.flat_field_input)
+        flat_field_layout.addWidget(self.flat_field_button)
+        layout.addRow("Flat Field File:", flat_field_layout)
+        
+        # Outlier (zinger/hot pixel) rejection
+        self.outlier_combobox = QComboBox()
+        self.outlier_combobox.addItems(['none', 'sigma', 'mad'])
+        self.outlier_combobox.setCurrentText(self.settings.get("outlier_rejection", "none"))
+        layout.addRow("Outlier Rejection:", self.outlier_combobox)
+        
+        self.outlier_threshold_spinbox = QDoubleSpinBox()
+        self.outlier_threshold_spinbox.setRange(1.0, 50.0)
+        self.outlier_threshold_spinbox.setSingleStep(0.5)
+        self.outlier_threshold_spinbox.setValue(self.settings.get("outlier_threshold", 5.0))
+        layout.addRow("Outlier Threshold (sigma):", self.outlier_threshold_spinbox)
+        
+        self.outlier_iterations_spinbox = QSpinBox()
+        self.outlier_iterations_spinbox.setRange(1, 10)
+        self.outlier_iterations_spinbox.setValue(self.settings.get("outlier_iterations", 3))
+        layout.addRow("Outlier Iterations:", self.outlier_iterations_spinbox)
+        
+        # Background (empty cell, capillary, air) scan subtracted from every integrated scan, 0 = none
+        self.background_scan_spinbox = QSpinBox()
+        self.background_scan_spinbox.setRange(0, 100000)
+        self.background_scan_spinbox.setSpecialValueText("None")
+        self.background_scan_spinbox.setValue(int(self.settings.get("background_scan", 0) or 0))
+        layout.addRow("Background Scan:", self.background_scan_spinbox)
+        
+        self.background_spec_input = QLineEdit(self)
+        self.background_spec_input.setText(self.settings.get("background_spec_file", ""))
+        self.background_spec_input.setPlaceholderText("blank for the sample's spec file")
+        self.background_spec_button = QPushButton("Browse", self)
+        self.background_spec_button.clicked.connect(self.browse_background_spec)
+        background_spec_layout = QHBoxLayout()
+        background_spec_layout.addWidget(self.background_spec_input)
+        background_spec_layout.addWidget(self.background_spec_button)
+        layout.addRow("Background Spec File:", background_spec_layout)
+        
+        # 'monitor' subtracts the background times the factor, 'fitted' fits the factor inside the fit range
+        self.background_scale_combobox = QComboBox()
+        self.background_scale_combobox.addItems(['monitor', 'fitted'])
+        self.background_scale_combobox.setCurrentText(self.settings.get("background_scale", "monitor"))
+        layout.addRow("Background Scaling:", self.background_scale_combobox)
+        
+        self.background_factor_spinbox = QDoubleSpinBox()
+        self.background_factor_spinbox.setDecimals(4)
+        self.background_factor_spinbox.setRange(0.0, 100.0)
+        self.background_factor_spinbox.setSingleStep(0.01)
+        self.background_factor_spinbox.setValue(self.settings.get("background_factor", 1.0))
+        layout.addRow("Background Factor:", self.background_factor_spinbox)
+        
+        # Fit range of the 'fitted' scale, 0 (shown as "Output range") leaves that end at the output 2-theta range
+        self.background_fit_min_spinbox = QDoubleSpinBox()
+        self.background_fit_min_spinbox.setRange(0.0, 180.0)
+        self.background_fit_min_spinbox.setSingleStep(0.1)
+        self.background_fit_min_spinbox.setSpecialValueText("Output range")
+        self.background_fit_min_spinbox.setValue(self.settings.get("background_fit_min") or 0.0)
+        layout.addRow("Background Fit Min 2-theta:", self.background_fit_min_spinbox)
+        
+        self.background_fit_max_spinbox = QDoubleSpinBox()
+        self.background_fit_max_spinbox.setRange(0.0, 180.0)
+        self.background_fit_max_spinbox.setSingleStep(0.1)
+        self.background_fit_max_spinbox.setSpecialValueText("Output range")
+        self.background_fit_max_spinbox.setValue(self.settings.get("background_fit_max") or 0.0)
+        layout.addRow("Background Fit Max 2-theta:", self.background_fit_max_spinbox)
+        
+        # Worker processes for binning (1 = bin in the integration thread)
+        self.processes_spinbox = QSpinBox()
+        self.processes_spinbox.setRange(1, os.cpu_count() or 1)
+        self.processes_spinbox.setValue(self.settings.get("processes", 1))
+        layout.addRow("Worker Processes:", self.processes_spinbox)
+
+        # Integration server (host:port), blank integrates in this program
+        self.server_input = QLineEdit(self)
+        self.server_input.setText(self.settings.get("server", ""))
+        self.server_input.setPlaceholderText("host:port, blank for local")
+        layout.addRow("Integration Server:", self.server_input)
+        
+        # Caked (2-theta x chi) output
+        self.caked_checkbox = QCheckBox("Save caked (2-theta x chi) image")
+        self.caked_checkbox.setChecked(self.settings.get("caked", False))
+        layout.addRow(self.caked_checkbox)
+        
+        self.cake_tth_step_spinbox = QDoubleSpinBox()
+        self.cake_tth_step_spinbox.setDecimals(3)
+        self.cake_tth_step_spinbox.setRange(0.005, 1.0)
+        self.cake_tth_step_spinbox.setSingleStep(0.005)
+        self.cake_tth_step_spinbox.setValue(self.settings.get("cake_tth_step", 0.05))
+        layout.addRow("Cake 2-theta Step:", self.cake_tth_step_spinbox)
+        
+        self.chi_step_spinbox = QDoubleSpinBox()
+        self.chi_step_spinbox.setRange(0.1, 45.0)
+        self.chi_step_spinbox.setSingleStep(0.5)
+        self.chi_step_spinbox.setValue(self.settings.get("chi_step", 1.0))
+        layout.addRow("Cake Chi Step:", self.chi_step_spinbox)
         
         # Accept and Cancel Buttons
         buttons = QHBoxLayout()
@@ -126,6 +318,33 @@ class IntegSettingsDialog(QDialog):
         buttons.addWidget(cancel_button)
         layout.addRow(buttons)
         
+    def update_clip_range(self, detector):
+        """Limit the clip range spinboxes to the columns of the selected detector."""
+        try:
+            cols = engine.detector_shape({'detector': detector})[1]
+        except ValueError:
+            return  # still being typed
+        self.img_clip_low_spinbox.setMaximum(cols)
+        self.img_clip_high_spinbox.setMaximum(cols)
+        
+    def browse_mask_file(self):
+        options = QFileDialog.Options()
+        file_path, _ = QFileDialog.getOpenFileName(self, "Select Mask File", "",
+                                                  "Mask Files (*.npy *.raw *.txt);;All Files (*)", options=options)
+        if file_path:
+            self.mask_file_input.setText(file_path)
+        
+    def browse_flat_field(self):
+        file_path, _ = QFileDialog.getOpenFileName(self, "Select Flat Field File", "",
+                                                  "Flat Field Files (*.npy *.raw *.txt);;All Files (*)")
+        if file_path:
+            self.flat_field_input.setText(file_path)
+        
+    def browse_background_spec(self):
+        file_path, _ = QFileDialog.getOpenFileName(self, "Select Background Spec File", "", "All Files (*)")
+        if file_path:
+            self.background_spec_input.setText(file_path)
+        
     def reset_tth_range(self):
         self.full_tth = True
         self.min_tth_spinbox.setValue(0.5)  # Default min X
@@ -135,6 +354,15 @@ class IntegSettingsDialog(QDialog):
         self.full_tth = False
         self.min_tth_spinbox.setEnabled(True)
         self.max_tth_spinbox.setEnabled(True)
+        try:
+            engine.detector_shape({'detector': self.detector_combobox.currentText()})
+        except ValueError as e:
+            QMessageBox.warning(self, 'Detector Error', str(e))
+            return
+        if (self.background_scale_combobox.currentText() == 'fitted' and self.background_fit_max_spinbox.value() > 0
+                and self.background_fit_min_spinbox.value() >= self.background_fit_max_spinbox.value()):
+            QMessageBox.warning(self, 'Background Error', "The background fit range has to run from low to high 2-theta.")
+            return
         if self.img_clip_low_spinbox.value() >= self.img_clip_high_spinbox.value():
             QMessageBox.warning(self, 'Image Clipping Error',
                                     "Lower clipping range cannot be greater than upper clipping range, resetting to defaults.")
@@ -149,11 +377,592 @@ class IntegSettingsDialog(QDialog):
             'full_tth': self.full_tth,
             'stepsize': self.stepsize_input.text(),
             'error_model': self.error_model_combobox.currentText(),
+            'integration_method': self.integration_method_combobox.currentText(),
+            'backend': self.backend_combobox.currentText(),
+            'stacked': self.stacked_checkbox.isChecked(),
+            'detector': self.detector_combobox.currentText().strip(),
+            'memory_budget': self.memory_budget_spinbox.value(),
             'img_clip_low': self.img_clip_low_spinbox.value(),
-            'img_clip_high': self.img_clip_high_spinbox.value()
-            
+            'img_clip_high': self.img_clip_high_spinbox.value(),
+            'mask_file': self.mask_file_input.text().strip(),
+            'solid_angle_correction': self.solid_angle_checkbox.isChecked(),
+            'polarization_correction': self.polarization_checkbox.isChecked(),
+            'polarization_fraction': self.polarization_fraction_spinbox.value(),
+            'flat_field_file': self.flat_field_input.text().strip(),
+            'outlier_rejection': self.outlier_combobox.currentText(),
+            'outlier_threshold': self.outlier_threshold_spinbox.value(),
+            'outlier_iterations': self.outlier_iterations_spinbox.value(),
+            'background_scan': self.background_scan_spinbox.value(),
+            'background_spec_file': self.background_spec_input.text().strip(),
+            'background_scale': self.background_scale_combobox.currentText(),
+            'background_factor': self.background_factor_spinbox.value(),
+            'background_fit_min': self.background_fit_min_spinbox.value() or None,  # None fits over the output range
+            'background_fit_max': self.background_fit_max_spinbox.value() or None,
+            'processes': self.processes_spinbox.value(),
+            'server': self.server_input.text().strip(),
+            'caked': self.caked_checkbox.isChecked(),
+            'cake_tth_step': self.cake_tth_step_spinbox.value(),
+            'chi_step': self.chi_step_spinbox.value()
+        }
+
+class CalibrationDialog(QDialog):
+    def __init__(self, scan_num=1, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Refine Calibration")
+        self.scan_num = scan_num
+        self.init_ui()
+
+    def init_ui(self):
+        layout = QFormLayout(self)
+
+        # Scan of the calibration standard
+        self.scan_spinbox = QSpinBox()
+        self.scan_spinbox.setRange(1, 100000)
+        self.scan_spinbox.setValue(self.scan_num)
+        layout.addRow("Standard Scan:", self.scan_spinbox)
+
+        # Known peak positions of the standard at this wavelength
+        self.peaks_input = QLineEdit(self)
+        self.peaks_input.setPlaceholderText("2-theta values, separated by commas or spaces")
+        layout.addRow("Peak Positions:", self.peaks_input)
+
+        # How far from a peak (at the current calibration) pixels are still used
+        self.window_spinbox = QDoubleSpinBox()
+        self.window_spinbox.setRange(0.01, 5.0)
+        self.window_spinbox.setSingleStep(0.05)
+        self.window_spinbox.setValue(0.3)
+        layout.addRow("Peak Window (deg):", self.window_spinbox)
+
+        # Refined calibration file
+        output_layout = QHBoxLayout()
+        self.output_input = QLineEdit(self)
+        output_button = QPushButton("Browse", self)
+        output_button.clicked.connect(self.browse_output_file)
+        output_layout.addWidget(self.output_input)
+        output_layout.addWidget(output_button)
+        layout.addRow("Save As:", output_layout)
+
+        # Accept and Cancel Buttons
+        buttons = QHBoxLayout()
+        accept_button = QPushButton("Refine")
+        accept_button.clicked.connect(self.accept)
+        cancel_button = QPushButton("Cancel")
+        cancel_button.clicked.connect(self.reject)
+        buttons.addWidget(accept_button)
+        buttons.addWidget(cancel_button)
+        layout.addRow(buttons)
+
+    def browse_output_file(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, "Save Calibration File", "",
+                                                   "Calibration Files (*.cal);;All Files (*)")
+        if file_path:
+            self.output_input.setText(file_path)
+
+    def peaks(self):
+        return [float(value) for value in re.split(r"[,\s]+", self.peaks_input.text().strip()) if value]
+
+    def accept(self):
+        try:
+            peaks = self.peaks()
+        except ValueError:
+            peaks = []
+        if not peaks or not self.output_input.text().strip():
+            QMessageBox.warning(self, "Refine Calibration", "Enter the standard's peak positions and a file to save to.")
+            return
+        super().accept()
+
+    def get_settings(self):
+        return {
+            'scan_num': self.scan_spinbox.value(),
+            'peaks': self.peaks(),
+            'window': self.window_spinbox.value(),
+            'output_file': self.output_input.text().strip()
         }
 
+class SweepDialog(QDialog):
+    """Table of settings configurations to integrate one scan with in a single pass over its frames."""
+    COLUMNS = ["Step Size", "Clip Low", "Clip High", "Min 2-theta", "Max 2-theta"]
+
+    def __init__(self, settings, scan_num=1, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Settings Sweep")
+        self.settings = settings
+        self.scan_num = scan_num
+        self.init_ui()
+
+    def init_ui(self):
+        layout = QVBoxLayout(self)
+        form = QFormLayout()
+        self.scan_spinbox = QSpinBox()
+        self.scan_spinbox.setRange(1, 100000)
+        self.scan_spinbox.setValue(self.scan_num)
+        form.addRow("Scan:", self.scan_spinbox)
+        layout.addLayout(form)
+
+        # One row per configuration, starting from the current integration settings
+        self.table = QTableWidget(0, len(self.COLUMNS), self)
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.add_row([self.settings['stepsize'], self.settings['img_clip_low'], self.settings['img_clip_high'],
+                      self.settings['min_tth'], self.settings['max_tth']])
+        layout.addWidget(self.table)
+
+        # Add Row, Remove Row, Run and Cancel Buttons
+        buttons = QHBoxLayout()
+        add_button = QPushButton("Add Row")
+        add_button.clicked.connect(lambda: self.add_row(self.row_values(self.table.rowCount() - 1)))
+        remove_button = QPushButton("Remove Row")
+        remove_button.clicked.connect(self.remove_row)
+        accept_button = QPushButton("Run")
+        accept_button.clicked.connect(self.accept)
+        cancel_button = QPushButton("Cancel")
+        cancel_button.clicked.connect(self.reject)
+        for button in (add_button, remove_button, accept_button, cancel_button):
+            buttons.addWidget(button)
+        layout.addLayout(buttons)
+        self.resize(560, 300)
+
+    def add_row(self, values):
+        """Append a configuration row (a copy of the last one when added from the button)."""
+        row = self.table.rowCount()
+        self.table.insertRow(row)
+        for column, value in enumerate(values):
+            self.table.setItem(row, column, QTableWidgetItem(str(value)))
+
+    def remove_row(self):
+        if self.table.rowCount() > 1:
+            self.table.removeRow(self.table.currentRow() if self.table.currentRow() >= 0 else self.table.rowCount() - 1)
+
+    def row_values(self, row):
+        return [self.table.item(row, column).text().strip() if self.table.item(row, column) else ""
+                for column in range(0, len(self.COLUMNS))]
+
+    def get_configs(self):
+        """Integration settings for every row, raises ValueError for a row that does not parse."""
+        configs = []
+        for row in range(0, self.table.rowCount()):
+            stepsize, low, high, min_tth, max_tth = self.row_values(row)
+            float(stepsize)  # kept as text like the integration settings, but it has to be a number
+            config = dict(self.settings, stepsize=stepsize, img_clip_low=int(low), img_clip_high=int(high),
+                          min_tth=float(min_tth), max_tth=float(max_tth), full_tth=False)
+            if config['img_clip_low'] >= config['img_clip_high']:
+                raise ValueError(f"Row {row + 1}: lower clipping range has to be below the upper one")
+            configs.append(config)
+        return configs
+
+    def accept(self):
+        try:
+            self.get_configs()
+        except ValueError as e:
+            QMessageBox.warning(self, "Settings Sweep", f"Invalid configuration: {e}")
+            return
+        super().accept()
+
+class ScanIndexDialog(QDialog):
+    """Scans of the SPEC file with their frames on disk, complete scans not integrated yet are checked for queuing."""
+    COLUMNS = ["Queue", "Scan", "Points", "Frames", "Status"]
+
+    def __init__(self, rows, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Complete Scans")
+        self.rows = rows
+        self.init_ui()
+
+    def init_ui(self):
+        layout = QVBoxLayout(self)
+        self.table = QTableWidget(len(self.rows), len(self.COLUMNS), self)
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        for k, row in enumerate(self.rows):
+            queue = QTableWidgetItem()
+            queue.setFlags(Qt.ItemIsUserCheckable | Qt.ItemIsEnabled)
+            queue.setCheckState(Qt.Checked if row['complete'] and not row['integrated'] else Qt.Unchecked)
+            self.table.setItem(k, 0, queue)
+            if row['integrated']:
+                status = "integrated"
+            elif row['complete']:
+                status = "complete"
+            elif not row['finished']:
+                status = "running"
+            else:
+                status = "missing frames"
+            points = str(row['points']) if row['planned'] is None else f"{row['points']}/{row['planned']}"
+            for column, value in enumerate([str(row['scan']), points, str(row['frames']), status], start=1):
+                self.table.setItem(k, column, QTableWidgetItem(value))
+        self.table.resizeColumnsToContents()
+        layout.addWidget(self.table)
+
+        # Queue and Cancel Buttons
+        buttons = QHBoxLayout()
+        accept_button = QPushButton("Queue Checked")
+        accept_button.clicked.connect(self.accept)
+        cancel_button = QPushButton("Cancel")
+        cancel_button.clicked.connect(self.reject)
+        buttons.addWidget(accept_button)
+        buttons.addWidget(cancel_button)
+        layout.addLayout(buttons)
+        self.resize(460, 400)
+
+    def checked_scans(self):
+        return [row['scan'] for k, row in enumerate(self.rows) if self.table.item(k, 0).checkState() == Qt.Checked]
+
+class FrameLedgerDialog(QDialog):
+    """Per-frame totals and anomaly flags of an integrated scan, frames can be left out without integrating again."""
+    COLUMNS = ["Use", "Frame", "2-theta", "I0", "Counts", "Dead", "Saturated", "Flags"]
+
+    def __init__(self, name, ledger, flags, weights, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle(f"Frames of {name}")
+        self.ledger = ledger
+        self.flags = flags
+        self.weights = weights
+        self.init_ui()
+
+    def init_ui(self):
+        layout = QVBoxLayout(self)
+        self.table = QTableWidget(len(self.ledger), len(self.COLUMNS), self)
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        for k, frame in enumerate(self.ledger):
+            use = QTableWidgetItem()
+            use.setFlags(Qt.ItemIsUserCheckable | Qt.ItemIsEnabled)
+            use.setCheckState(Qt.Checked if self.weights[k] > 0 else Qt.Unchecked)
+            self.table.setItem(k, 0, use)
+            values = [str(k), f"{frame['tth']:.4f}", f"{frame['i0']:.0f}", str(frame['total']),
+                      str(frame['dead']), str(frame['saturated']), ", ".join(self.flags[k])]
+            for column, value in enumerate(values, start=1):
+                item = QTableWidgetItem(value)
+                if self.flags[k]:
+                    item.setBackground(QColor(255, 220, 200))
+                self.table.setItem(k, column, item)
+        self.table.resizeColumnsToContents()
+        layout.addWidget(self.table)
+
+        # Exclude Flagged, Apply and Cancel Buttons
+        buttons = QHBoxLayout()
+        exclude_button = QPushButton("Exclude Flagged")
+        exclude_button.clicked.connect(self.exclude_flagged)
+        accept_button = QPushButton("Apply")
+        accept_button.clicked.connect(self.accept)
+        cancel_button = QPushButton("Cancel")
+        cancel_button.clicked.connect(self.reject)
+        buttons.addWidget(exclude_button)
+        buttons.addWidget(accept_button)
+        buttons.addWidget(cancel_button)
+        layout.addLayout(buttons)
+        self.resize(640, 400)
+
+    def exclude_flagged(self):
+        for k in range(0, self.table.rowCount()):
+            if self.flags[k]:
+                self.table.item(k, 0).setCheckState(Qt.Unchecked)
+
+    def get_weights(self):
+        """{frame: weight} for every frame, 0 for unchecked frames and 1 for the rest."""
+        return {k: 1.0 if self.table.item(k, 0).checkState() == Qt.Checked else 0.0
+                for k in range(0, self.table.rowCount())}
+
+class PeakTrackDialog(QDialog):
+    """2-theta windows to fit through a series of patterns, either the selected ones or .xye files."""
+
+    def __init__(self, selected_names, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Track Peaks")
+        self.selected_names = selected_names
+        self.files = []
+        self.init_ui()
+
+    def init_ui(self):
+        layout = QFormLayout(self)
+        self.windows_input = QLineEdit()
+        self.windows_input.setPlaceholderText("e.g. 10.2-10.8; 14.1-14.6")
+        layout.addRow("2-theta Windows:", self.windows_input)
+
+        # Patterns to fit, in scan order
+        self.selected_radio = QRadioButton(f"Selected patterns ({len(self.selected_names)})")
+        self.files_radio = QRadioButton("Integrated files")
+        self.selected_radio.setChecked(bool(self.selected_names))
+        self.files_radio.setChecked(not self.selected_names)
+        files_layout = QHBoxLayout()
+        self.files_label = QLabel("No files")
+        files_button = QPushButton("Files...")
+        files_button.clicked.connect(self.browse_files)
+        files_layout.addWidget(self.files_radio)
+        files_layout.addWidget(self.files_label)
+        files_layout.addWidget(files_button)
+        layout.addRow(self.selected_radio)
+        layout.addRow(files_layout)
+
+        # Run and Cancel Buttons
+        buttons = QHBoxLayout()
+        accept_button = QPushButton("Run")
+        accept_button.clicked.connect(self.accept)
+        cancel_button = QPushButton("Cancel")
+        cancel_button.clicked.connect(self.reject)
+        buttons.addWidget(accept_button)
+        buttons.addWidget(cancel_button)
+        layout.addRow(buttons)
+
+    def browse_files(self):
+        files, _ = QFileDialog.getOpenFileNames(self, "Select Integrated Patterns", "", "XYE Files (*.xye);;All Files (*)")
+        if files:
+            self.files = sorted(files)
+            self.files_label.setText(f"{len(self.files)} files")
+            self.files_radio.setChecked(True)
+
+    def windows(self):
+        """[(low, high)] from the windows field, raises ValueError when it does not parse."""
+        return parse_windows(self.windows_input.text())
+
+    def accept(self):
+        try:
+            self.windows()
+        except ValueError as e:
+            QMessageBox.warning(self, "Track Peaks", str(e))
+            return
+        if self.files_radio.isChecked() and not self.files:
+            QMessageBox.warning(self, "Track Peaks", "Select the integrated files to fit.")
+            return
+        if self.selected_radio.isChecked() and not self.selected_names:
+            QMessageBox.warning(self, "Track Peaks", "Select the patterns to fit first.")
+            return
+        super().accept()
+
+class PeakTrackWindow(QWidget):
+    """Live table and plot of fitted peak position, FWHM and area against scan, filled in as fits finish."""
+    COLUMNS = ["Window", "Scan", "Name", "Position", "esd", "FWHM", "esd", "Area", "esd"]
+    PLOTTED = [('center', "Position"), ('fwhm', "FWHM"), ('area', "Area")]
+
+    def __init__(self, windows, parent=None):
+        super().__init__(parent, Qt.Window)
+        self.setWindowTitle("Peak Tracking")
+        self.windows = windows
+        self.rows = []
+        self.redraw_timer = QTimer(self)  # rows can arrive faster than the plot redraws
+        self.redraw_timer.setSingleShot(True)
+        self.redraw_timer.setInterval(250)
+        self.redraw_timer.timeout.connect(self.redraw)
+        self.init_ui()
+
+    def init_ui(self):
+        import matplotlib
+        matplotlib.use('Qt5Agg')
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+        layout = QVBoxLayout(self)
+        self.fig = Figure(figsize=(5, 6), dpi=100)
+        self.canvas = FigureCanvas(self.fig)
+        self.axes = self.fig.subplots(len(self.PLOTTED), 1, sharex=True)
+        layout.addWidget(self.canvas, 2)
+
+        self.table = QTableWidget(0, len(self.COLUMNS), self)
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        layout.addWidget(self.table, 1)
+
+        # Save Table and Close Buttons
+        buttons = QHBoxLayout()
+        self.status_label = QLabel("")
+        self.save_button = QPushButton("Save Table")
+        self.save_button.clicked.connect(self.save_table)
+        close_button = QPushButton("Close")
+        close_button.clicked.connect(self.close)
+        buttons.addWidget(self.status_label, 1)
+        buttons.addWidget(self.save_button)
+        buttons.addWidget(close_button)
+        layout.addLayout(buttons)
+        self.resize(700, 800)
+
+    def add_rows(self, rows):
+        """Append finished fits to the table and schedule a redraw."""
+        for row in rows:
+            self.rows.append(row)
+            self.append_table_row(row)
+        self.status_label.setText(f"{len(self.rows)} fits")
+        if not self.redraw_timer.isActive():
+            self.redraw_timer.start()
+
+    def append_table_row(self, row):
+        k = self.table.rowCount()
+        self.table.insertRow(k)
+        low, high = self.windows[row['window']]
+        values = [f"{low:g}-{high:g}", str(row['scan'] + 1), row['name']]
+        for param, _ in self.PLOTTED:
+            values += [f"{row[param]:.5g}", f"{row[param + '_esd']:.2g}"]
+        for column, value in enumerate(values):
+            item = QTableWidgetItem(value)
+            if not row['ok']:
+                item.setBackground(QColor(255, 220, 200))
+                item.setToolTip(row['message'])
+            self.table.setItem(k, column, item)
+
+    def set_rows(self, rows):
+        """Show the final, sorted rows once every fit has finished."""
+        self.rows = list(rows)
+        self.table.setRowCount(0)
+        for row in self.rows:
+            self.append_table_row(row)
+        self.table.resizeColumnsToContents()
+        failed = sum(1 for row in self.rows if not row['ok'])
+        self.status_label.setText(f"{len(self.rows)} fits" + (f", {failed} failed" if failed else ""))
+        self.redraw()
+
+    def redraw(self):
+        for ax, (param, label) in zip(self.axes, self.PLOTTED):
+            ax.clear()
+            ax.set_ylabel(label)
+            for w, (low, high) in enumerate(self.windows):
+                fitted = sorted((row['scan'] + 1, row[param], row[param + '_esd']) for row in self.rows
+                                if row['window'] == w and row['ok'])
+                if fitted:
+                    scans, values, esds = zip(*fitted)
+                    ax.errorbar(scans, values, yerr=esds, marker='o', markersize=3, capsize=0,
+                                label=f"{low:g}-{high:g}")
+        self.axes[-1].set_xlabel("Scan")
+        if self.rows:
+            self.axes[0].legend(fontsize='small')
+        self.fig.tight_layout()
+        self.canvas.draw_idle()
+
+    def save_table(self):
+        file_path, _ = QFileDialog.getSaveFileName(self, "Save Peak Table", "peaks.tsv", "Tab Separated (*.tsv);;All Files (*)")
+        if file_path:
+            try:
+                Integration_peaks.write_peak_table(file_path, self.rows)
+            except OSError as e:
+                QMessageBox.critical(self, "Error", f"Could not save {file_path}: {e}")
+
+class RoiMonitorWindow(QWidget):
+    """Strip chart of the intensity in a few 2-theta windows, frame by frame as a scan is collected.
+
+    Only the pixels inside the windows are binned (see IntegrationEngine.roi_frame), so it keeps up with the detector.
+    The lower plot is the local pattern of the windows summed over the current scan so far.
+    """
+    history = 2000  # frames kept on the strip chart
+
+    def __init__(self, gui, scan_num=1):
+        super().__init__(gui, Qt.Window)
+        self.setWindowTitle("ROI Monitor")
+        self.gui = gui
+        self.worker = None
+        self.counter = 0
+        self.frames = []  # (frame counter, [intensity of each window]) for the strip chart
+        self.pattern = None  # latest frame dict, for the local pattern
+        self.redraw_timer = QTimer(self)  # frames can arrive much faster than the plot redraws
+        self.redraw_timer.setSingleShot(True)
+        self.redraw_timer.setInterval(100)
+        self.redraw_timer.timeout.connect(self.redraw)
+        self.init_ui(scan_num)
+
+    def init_ui(self, scan_num):
+        import matplotlib
+        matplotlib.use('Qt5Agg')
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+        layout = QVBoxLayout(self)
+        form = QFormLayout()
+        self.windows_input = QLineEdit()
+        self.windows_input.setPlaceholderText("e.g. 10.2-10.8; 14.1-14.6")
+        form.addRow("2-theta Windows:", self.windows_input)
+        self.scan_spinbox = QSpinBox()
+        self.scan_spinbox.setRange(1, 100000)
+        self.scan_spinbox.setValue(scan_num)
+        form.addRow("Scan:", self.scan_spinbox)
+        self.follow_checkbox = QCheckBox("Follow the scans after it")
+        self.follow_checkbox.setChecked(True)
+        form.addRow(self.follow_checkbox)
+        layout.addLayout(form)
+
+        self.fig = Figure(figsize=(5, 5), dpi=100)
+        self.canvas = FigureCanvas(self.fig)
+        self.strip_ax, self.pattern_ax = self.fig.subplots(2, 1)
+        layout.addWidget(self.canvas)
+
+        # Start and Stop Buttons
+        buttons = QHBoxLayout()
+        self.status_label = QLabel("")
+        self.start_button = QPushButton("Start")
+        self.start_button.clicked.connect(self.start)
+        self.stop_button = QPushButton("Stop")
+        self.stop_button.clicked.connect(self.stop)
+        self.stop_button.setEnabled(False)
+        buttons.addWidget(self.status_label, 1)
+        buttons.addWidget(self.start_button)
+        buttons.addWidget(self.stop_button)
+        layout.addLayout(buttons)
+        self.resize(700, 700)
+
+    def start(self):
+        gui = self.gui
+        if gui.xyz_map is None or not gui.spec_path or not gui.image_path or not gui.user:
+            QMessageBox.warning(self, "ROI Monitor", "Select a calibration file, spec file and image directory first.")
+            return
+        try:
+            self.windows = parse_windows(self.windows_input.text())
+            engine.roi_layout(self.windows, float(gui.integration_settings['stepsize']))
+        except ValueError as e:
+            QMessageBox.warning(self, "ROI Monitor", str(e))
+            return
+        self.counter = 0
+        self.frames = []
+        self.pattern = None
+        # its own engine, so the caches of an integration running at the same time are never touched from two threads
+        self.worker = Integration_worker.RoiMonitorWorker(
+            gui.spec_path, self.scan_spinbox.value(), gui.image_path, gui.user, gui.xyz_map, gui.integration_settings,
+            self.windows, follow=self.follow_checkbox.isChecked())
+        self.worker.frame_ready.connect(self.add_frame)
+        self.worker.status.connect(self.status_label.setText)
+        self.worker.error_occurred.connect(gui.show_error)
+        self.worker.finished.connect(self.monitor_finished)
+        self.start_button.setEnabled(False)
+        self.stop_button.setEnabled(True)
+        self.worker.start()
+
+    def stop(self):
+        if self.worker is not None and self.worker.isRunning():
+            self.worker.stop()
+            self.worker.wait()
+
+    def monitor_finished(self):
+        self.start_button.setEnabled(True)
+        self.stop_button.setEnabled(False)
+
+    def add_frame(self, result):
+        """Take one frame's ROI intensities and the scan's local pattern, the plots catch up on the next redraw."""
+        self.counter += 1
+        self.frames.append((self.counter, result['intensity']))
+        if len(self.frames) > self.history:
+            del self.frames[:len(self.frames) - self.history]
+        self.pattern = result
+        self.status_label.setText(f"Scan {result['scan']}, frame {result['frame']} at {result['tth']:.3f} deg")
+        if not self.redraw_timer.isActive():
+            self.redraw_timer.start()
+
+    def redraw(self):
+        self.strip_ax.clear()
+        self.pattern_ax.clear()
+        if self.frames:
+            counters = np.array([counter for counter, _ in self.frames])
+            intensity = np.array([values for _, values in self.frames])
+            for w, (low, high) in enumerate(self.windows):
+                self.strip_ax.plot(counters, intensity[:, w], marker='.', markersize=3, label=f"{low:g}-{high:g}")
+            self.strip_ax.legend(fontsize='small')
+        self.strip_ax.set_xlabel("Frame")
+        self.strip_ax.set_ylabel("ROI Intensity")
+        if self.pattern is not None:
+            self.pattern_ax.plot(self.pattern['x'], self.pattern['y'], '.')
+            self.pattern_ax.set_title(f"Scan {self.pattern['scan']} so far", fontsize='small')
+        self.pattern_ax.set_xlabel("2-theta")
+        self.pattern_ax.set_ylabel("Intensity")
+        self.fig.tight_layout()
+        self.canvas.draw_idle()
+
+    def closeEvent(self, event):
+        self.stop()
+        event.accept()
+
 class PlotSettingsDialog(QDialog):
     def __init__(self, settings, parent=None):
         super().__init__(parent)
@@ -185,7 +994,8 @@ class PlotSettingsDialog(QDialog):
         
         # Colormap Setting
         self.colormap_combobox = QComboBox()
-        self.colormap_combobox.addItems(plt.colormaps())  # Add all matplotlib colormaps
+        import matplotlib
+        self.colormap_combobox.addItems(sorted(matplotlib.colormaps))  # Add all matplotlib colormaps (registry lookup, no pyplot needed)
         self.colormap_combobox.setCurrentText(self.settings['colormap'])
         layout.addRow("Colormap:", self.colormap_combobox)
 
@@ -273,6 +1083,117 @@ class PlotSettingsDialog(QDialog):
             'sqrt_scale': self.sqrt_scale_button.isChecked()
         }
 
+class PatternListModel(QAbstractListModel):
+    """Names of every loaded pattern and their selection state, the data behind the virtualized pattern list.
+
+    Selection is kept here rather than in the view so that looking it up is a set lookup, and it is drawn
+    through the background/foreground roles.
+    """
+    ScanNumberRole = Qt.UserRole + 1
+    DateRole = Qt.UserRole + 2
+    NameRole = Qt.UserRole + 3
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.names = []     # list (insertion) order
+        self.rows = {}      # name -> row in self.names
+        self.dates = {}     # name -> time the pattern was written or imported
+        self.selected = {}  # names currently selected, a dict so it keeps the order they were selected in
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.names)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        name = self.names[index.row()]
+        if role == Qt.DisplayRole or role == self.NameRole:
+            return name
+        if role == self.ScanNumberRole:
+            match = re.search(r"_scan(\d+)", name)
+            return int(match.group(1)) if match else -1
+        if role == self.DateRole:
+            return self.dates.get(name, 0.0)
+        if name in self.selected:
+            if role == Qt.BackgroundRole:
+                return QApplication.palette().highlight()
+            if role == Qt.ForegroundRole:
+                return QApplication.palette().highlightedText()
+        return None
+
+    def add_patterns(self, names, dates=None):
+        """Append any new names with a single insert, so the view only updates once per batch."""
+        new_names = [name for name in dict.fromkeys(names) if name not in self.rows]
+        if not new_names:
+            return
+        start = len(self.names)
+        self.beginInsertRows(QModelIndex(), start, start + len(new_names) - 1)
+        for offset, name in enumerate(new_names):
+            self.rows[name] = start + offset
+            self.names.append(name)
+            self.dates[name] = (dates or {}).get(name, time.time())
+        self.endInsertRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.names = []
+        self.rows = {}
+        self.dates = {}
+        self.selected = {}
+        self.endResetModel()
+
+    def is_selected(self, name):
+        return name in self.selected
+
+    def selected_names(self):
+        """Selected names in list order."""
+        return sorted(self.selected, key=self.rows.get)
+
+    def set_selected(self, names, selected=True):
+        changed = []
+        for name in names:
+            if name in self.rows and (name in self.selected) != selected:
+                if selected:
+                    self.selected[name] = None
+                else:
+                    del self.selected[name]
+                changed.append(self.rows[name])
+        self._rows_changed(changed)
+
+    def toggle(self, name):
+        self.set_selected([name], not self.is_selected(name))
+
+    def select_only(self, name):
+        changed = [self.rows[n] for n in self.selected if n != name]
+        self.selected = {name: None} if name in self.rows else {}
+        self._rows_changed(changed + ([self.rows[name]] if name in self.rows else []))
+
+    def _rows_changed(self, rows):
+        # One dataChanged signal covering every changed row
+        if rows:
+            self.dataChanged.emit(self.index(min(rows)), self.index(max(rows)),
+                                  [Qt.BackgroundRole, Qt.ForegroundRole])
+
+
+class PatternFilterProxy(QSortFilterProxyModel):
+    """Filters the pattern list on a name substring and sorts it by scan number, name or date."""
+    SORT_ROLES = {'Added': None, 'Scan Number': PatternListModel.ScanNumberRole,
+                  'Name': PatternListModel.NameRole, 'Date': PatternListModel.DateRole}
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        self.setDynamicSortFilter(True)
+
+    def sort_by(self, key):
+        role = self.SORT_ROLES[key]
+        if role is None:
+            self.sort(-1)  # back to the order patterns were added in
+        else:
+            self.setSortRole(role)
+            self.sort(0, Qt.AscendingOrder)
+
+
 class PilatusIntegrationGUI(QWidget):
     def __init__(self):
         super().__init__()
@@ -285,8 +1206,16 @@ class PilatusIntegrationGUI(QWidget):
         self.det_R = None
         self.xyz_map = None
         self.plot_data = {}  # Dictionary to store already integrated data
+        self.session_archive = None  # open session file that restored patterns are read from on demand
+        self.pending_patterns = []  # (name, selected) results waiting to be added to the list in one batch
+        self.plot_generation = 0  # newest plot request, older prepared plots are dropped
+        self.plot_worker = Plot_worker.PlotPrepWorker()
+        self.plot_worker.plot_ready.connect(self.draw_prepared)
+        self.plot_worker.start()
         self.overlay_plots = False  # Flag to control plot overlaying, default to single plots only
         self.contour_plot = False   # Flag to control contour plot
+        self.waterfall_plot = False  # Flag to control waterfall plot
+        self.waterfall = None  # the drawn waterfall LineCollection and its unshifted segments
         self.plot_settings = {  # Default plot settings
             'line_width': 1.0,
             'line_style': 'solid',
@@ -305,11 +1234,47 @@ class PilatusIntegrationGUI(QWidget):
             'full_tth': True,
             'stepsize': '0.005',
             'error_model': 'poisson',
+            'integration_method': 'histogram',
+            'backend': 'auto',
+            'stacked': False,
+            'detector': engine.DEFAULT_DETECTOR,
+            'memory_budget': engine.DEFAULT_MEMORY_BUDGET,
             'img_clip_low': 20,
-            'img_clip_high': 467
+            'img_clip_high': 467,
+            'mask_file': '',
+            'solid_angle_correction': False,
+            'polarization_correction': False,
+            'polarization_fraction': engine.DEFAULT_POLARIZATION_FRACTION,
+            'flat_field_file': '',
+            'outlier_rejection': 'none',
+            'outlier_threshold': 5.0,
+            'outlier_iterations': 3,
+            'background_scan': 0,
+            'background_spec_file': '',
+            'background_scale': 'monitor',
+            'background_factor': 1.0,
+            'background_fit_min': None,
+            'background_fit_max': None,
+            'processes': 1,
+            'server': '',
+            'caked': False,
+            'cake_tth_step': 0.05,
+            'chi_step': 1.0
         }
+        self.integrator = engine.IntegrationEngine()  # Shared by every worker so per-session caches (masks, geometry) are kept
         self.init_ui()
         self.worker = None  # Track the active worker thread
+        self.calibration_worker = None  # background calibration refinement, if one has been started
+        self.sweep_worker = None  # background settings sweep, if one has been started
+        self.peak_worker = None  # background peak tracking, if it has been started
+        self.peak_window = None
+        self.roi_window = None  # ROI monitor, runs its own worker thread
+        self.image_index = None  # frames of the image directory by scan, refreshed from the directory mtime
+        self.scan_queue = []  # scans still to integrate one after another
+        self.output_writer = Integration_worker.OutputWriter()  # files are written off the GUI thread
+        self.output_writer.file_written.connect(self.handle_file_written)
+        self.output_writer.error_occurred.connect(self.show_error)
+        self.output_writer.start()
         
         # Add a progress bar
         self.progress_bar = QProgressBar()
@@ -338,6 +1303,20 @@ class PilatusIntegrationGUI(QWidget):
         import_data_action.triggered.connect(self.import_integrated_data)
         file_menu.addAction(import_data_action)
         
+        # Complete Scans Action
+        complete_scans_action = QAction("Find Complete Scans", self)
+        complete_scans_action.triggered.connect(self.open_complete_scans)
+        file_menu.addAction(complete_scans_action)
+        
+        # Session Actions
+        save_session_action = QAction("Save Session", self)
+        save_session_action.triggered.connect(self.save_session)
+        file_menu.addAction(save_session_action)
+        
+        load_session_action = QAction("Load Session", self)
+        load_session_action.triggered.connect(self.load_session)
+        file_menu.addAction(load_session_action)
+        
         # Clear Data Action
         clear_data_action = QAction("Clear Data", self)
         clear_data_action.triggered.connect(self.clear_data)
@@ -357,6 +1336,26 @@ class PilatusIntegrationGUI(QWidget):
         integration_settings_action = QAction("Integration Settings", self)
         integration_settings_action.triggered.connect(self.open_integration_settings)  # Connect to open_integration_settings
         settings_menu.addAction(integration_settings_action)
+
+        # Calibration Refinement Action
+        refine_calibration_action = QAction("Refine Calibration", self)
+        refine_calibration_action.triggered.connect(self.open_calibration_refinement)
+        settings_menu.addAction(refine_calibration_action)
+
+        # Settings Sweep Action
+        sweep_action = QAction("Settings Sweep", self)
+        sweep_action.triggered.connect(self.open_settings_sweep)
+        settings_menu.addAction(sweep_action)
+
+        # Peak Tracking Action
+        track_peaks_action = QAction("Track Peaks", self)
+        track_peaks_action.triggered.connect(self.open_peak_tracking)
+        settings_menu.addAction(track_peaks_action)
+
+        # ROI Monitor Action
+        roi_monitor_action = QAction("ROI Monitor", self)
+        roi_monitor_action.triggered.connect(self.open_roi_monitor)
+        settings_menu.addAction(roi_monitor_action)
         
         # Open Manual Action
         manual_action = QAction("Open Manual PDF", self)
@@ -431,6 +1430,8 @@ class PilatusIntegrationGUI(QWidget):
         dash_label.setAlignment(Qt.AlignCenter)
         scan_range_layout.addWidget(dash_label)
         scan_range_layout.addWidget(self.scan_end_input)
+        self.merge_toggle = QCheckBox("Merge", self)  # sum the range into one pattern instead of one per scan
+        scan_range_layout.addWidget(self.merge_toggle)
 
         # Create a container widget for the scan range layout
         self.scan_range_container = QWidget()
@@ -443,6 +1444,28 @@ class PilatusIntegrationGUI(QWidget):
         self.contour_plot_toggle = QCheckBox("Contour Plot", self)
         self.contour_plot_toggle.stateChanged.connect(self.toggle_contour_plot)
         self.contour_plot_toggle.setEnabled(False)
+
+        self.waterfall_plot_toggle = QCheckBox("Waterfall Plot", self)
+        self.waterfall_plot_toggle.stateChanged.connect(self.toggle_waterfall_plot)
+        self.waterfall_plot_toggle.setEnabled(False)
+
+        # Waterfall spacing (% of the median pattern height) and vertical scale (%), applied to the drawn lines in place
+        self.waterfall_offset_slider = QSlider(Qt.Horizontal, self)
+        self.waterfall_offset_slider.setRange(0, 200)
+        self.waterfall_offset_slider.setValue(50)
+        self.waterfall_offset_slider.valueChanged.connect(self.update_waterfall)
+        self.waterfall_scale_slider = QSlider(Qt.Horizontal, self)
+        self.waterfall_scale_slider.setRange(10, 500)
+        self.waterfall_scale_slider.setValue(100)
+        self.waterfall_scale_slider.valueChanged.connect(self.update_waterfall)
+        waterfall_layout = QHBoxLayout()
+        waterfall_layout.addWidget(QLabel("Offset:"))
+        waterfall_layout.addWidget(self.waterfall_offset_slider)
+        waterfall_layout.addWidget(QLabel("Scale:"))
+        waterfall_layout.addWidget(self.waterfall_scale_slider)
+        self.waterfall_controls = QWidget()
+        self.waterfall_controls.setLayout(waterfall_layout)
+        self.waterfall_controls.setVisible(False)
 	
         # Initial Visibility
         self.scan_number_label.setVisible(True)
@@ -454,11 +1477,27 @@ class PilatusIntegrationGUI(QWidget):
         integrate_button = QPushButton("Integrate", self)
         integrate_button.clicked.connect(self.plot_integrated_data)
         
-        # Plot List Widget
-        self.plot_list = QListWidget(self)
-        self.plot_list.setSelectionMode(QAbstractItemView.MultiSelection)
-        self.plot_list.itemClicked.connect(self.toggle_highlight)  # Connect itemClicked signal to toggle_highlight
+        # Plot List, a model/view pair so only the visible rows are ever drawn
+        self.plot_model = PatternListModel(self)
+        self.plot_proxy = PatternFilterProxy(self)
+        self.plot_proxy.setSourceModel(self.plot_model)
+        self.plot_list = QListView(self)
+        self.plot_list.setModel(self.plot_proxy)
+        self.plot_list.setUniformItemSizes(True)  # lets the view skip measuring every row
+        self.plot_list.setSelectionMode(QAbstractItemView.NoSelection)  # selection lives in the model
+        self.plot_list.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.plot_list.clicked.connect(self.toggle_highlight)  # Connect clicked signal to toggle_highlight
         self.plot_list_label = QLabel("Integrated Data:")
+        
+        self.plot_filter_input = QLineEdit(self)
+        self.plot_filter_input.setPlaceholderText("Filter...")
+        self.plot_filter_input.textChanged.connect(self.plot_proxy.setFilterFixedString)
+        self.plot_sort_combobox = QComboBox(self)
+        self.plot_sort_combobox.addItems(list(PatternFilterProxy.SORT_ROLES))
+        self.plot_sort_combobox.currentTextChanged.connect(self.plot_proxy.sort_by)
+        plot_filter_layout = QHBoxLayout()
+        plot_filter_layout.addWidget(self.plot_filter_input)
+        plot_filter_layout.addWidget(self.plot_sort_combobox)
 
         # Add input fields to the left layout
         left_layout.addWidget(self.calib_path_label)
@@ -481,8 +1520,14 @@ class PilatusIntegrationGUI(QWidget):
         left_layout.addWidget(integrate_button)
         left_layout.addWidget(self.overlay_toggle)  # Add the toggle to the layout
         left_layout.addWidget(self.contour_plot_toggle)
+        left_layout.addWidget(self.waterfall_plot_toggle)
+        left_layout.addWidget(self.waterfall_controls)
         left_layout.addWidget(self.plot_list_label)
+        left_layout.addLayout(plot_filter_layout)
         left_layout.addWidget(self.plot_list)
+        frames_button = QPushButton("Frames...", self)
+        frames_button.clicked.connect(self.open_frame_ledger)
+        left_layout.addWidget(frames_button)
         
         # Add left and right to input layout
         input_layout.addLayout(left_layout, 1)
@@ -491,25 +1536,24 @@ class PilatusIntegrationGUI(QWidget):
         # Status Bar
         self.status_bar = QStatusBar()
         
-        # Matplotlib Plot
-        self.fig = plt.Figure(figsize=(5, 4), dpi=100)
-        self.canvas = FigureCanvas(self.fig)
-        self.ax = self.fig.add_subplot(111)
-
-        # Set Size Policy for expanding
-        self.canvas.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        # Matplotlib Plot, a placeholder until init_plot_canvas runs just after the window is shown
+        self.fig = None
+        self.canvas = None
+        self.ax = None
+        self.toolbar = None
+        self.plot_layout = right_layout
+        self.plot_placeholder = QLabel("Loading plot...")
+        self.plot_placeholder.setAlignment(Qt.AlignCenter)
+        self.plot_placeholder.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         
         # Add menu bar, central layout, and status bar to the main layout
         main_layout.addWidget(menu_bar)
 
-        # Add Navigation Toolbar
-        self.toolbar = NavigationToolbar2QT(self.canvas, self)
         right_layout.addWidget(QLabel("Integration Plot:"))
-        right_layout.addWidget(self.canvas)
+        right_layout.addWidget(self.plot_placeholder)
 
         # Add widgets to layout
         main_layout.addLayout(input_layout)
-        right_layout.addWidget(self.toolbar) # Add the toolbar to the right layout
         
         # Add central layout and status bar to the main layout
         main_layout.addWidget(self.status_bar)
@@ -520,7 +1564,31 @@ class PilatusIntegrationGUI(QWidget):
         self.setWindowIcon(QIcon(resource_path("icon.png"))) # Sets the window icon
         self.setGeometry(100, 100, 1000, 600)
         
-        self.status_bar.showMessage("Ready", 3000)  # Initial message
+        _startup_marks.append(("window built", time.perf_counter()))
+        self.status_bar.showMessage(f"Ready (started in {_startup_marks[-1][1] - _startup_marks[0][1]:.2f} s)", 3000)  # Initial message
+        QTimer.singleShot(0, self.init_plot_canvas)  # first thing the event loop does after the window appears
+
+    def init_plot_canvas(self):
+        """Build the matplotlib figure, canvas and toolbar (deferred from startup, safe to call repeatedly)."""
+        if self.canvas is not None:
+            return
+        import matplotlib
+        matplotlib.use('Qt5Agg')  # Use the Qt5Agg backend for matplotlib
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas, NavigationToolbar2QT
+        self.fig = Figure(figsize=(5, 4), dpi=100)
+        self.canvas = FigureCanvas(self.fig)
+        self.ax = self.fig.add_subplot(111)
+
+        # Set Size Policy for expanding
+        self.canvas.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+
+        # Swap the placeholder for the canvas and add the Navigation Toolbar under it
+        self.toolbar = NavigationToolbar2QT(self.canvas, self)
+        self.plot_layout.replaceWidget(self.plot_placeholder, self.canvas)
+        self.plot_placeholder.deleteLater()
+        self.plot_layout.addWidget(self.toolbar)
+        _startup_marks.append(("plot canvas", time.perf_counter()))
 
     def browse_calib_file(self):
         options = QFileDialog.Options()
@@ -580,16 +1648,88 @@ class PilatusIntegrationGUI(QWidget):
         file_paths, _ = QFileDialog.getOpenFileNames(self, "Import Integrated Data", "",
                                                   "XYE Files (*.xye);;Text Files (*.txt);;All Files (*)", options=options)
         if file_paths:
+            imported = {}
             for file_path in file_paths:
                 try:
                     x, y, e = self.read_integrated_data(file_path)
                     file_path_only, plot_name = os.path.split(file_path)
                     self.plot_data[plot_name] = {'x': x, 'y': y, 'e': e}
-                    self.plot_list.addItem(plot_name)  # Add item to list
+                    imported[plot_name] = os.path.getmtime(file_path)
                     self.status_bar.showMessage(f"Imported data from {file_path}", 5000)
                 except Exception as e:
                     QMessageBox.warning(self, "Import Error", f"Error importing {file_path}: {e}")
                     self.status_bar.showMessage(f"Error importing {file_path}: {e}", 5000)
+            self.plot_model.add_patterns(list(imported), imported)  # Add items to list in one batch
+
+    def save_session(self):
+        """Save every loaded pattern, the list order and selection, and all settings to one session file."""
+        options = QFileDialog.Options()
+        file_path, _ = QFileDialog.getSaveFileName(self, "Save Session", "",
+                                                   "Session Files (*.npz);;All Files (*)", options=options)
+        if not file_path:
+            return
+        if not file_path.endswith('.npz'):
+            file_path += '.npz'
+        names = list(self.plot_model.names)
+        selected = self.plot_model.selected_names()
+        paths = {'calib_path': self.calib_path, 'spec_path': self.spec_path,
+                 'image_path': self.image_path, 'output_path': self.output_path}
+        try:
+            if self.session_archive is not None:
+                # Restored patterns not yet read still live in the open session file, which may be the one being replaced
+                for data in self.plot_data.values():
+                    if isinstance(data, Integration_session.LazyPattern):
+                        data.load()
+            Integration_session.save_session(file_path, self.plot_data, names, selected,
+                                             self.plot_settings, self.integration_settings, paths,
+                                             dates=self.plot_model.dates)
+            self.status_bar.showMessage(f"Saved session with {len(names)} patterns to {file_path}", 5000)
+        except Exception as e:
+            QMessageBox.warning(self, "Session Error", f"Error saving session {file_path}: {e}")
+
+    def load_session(self):
+        """Replace the current patterns and settings with a saved session, pattern arrays are read when first plotted."""
+        options = QFileDialog.Options()
+        file_path, _ = QFileDialog.getOpenFileName(self, "Load Session", "",
+                                                   "Session Files (*.npz);;All Files (*)", options=options)
+        if not file_path:
+            return
+        try:
+            archive, session, plot_data = Integration_session.load_session(file_path)
+        except Exception as e:
+            QMessageBox.warning(self, "Session Error", f"Error loading session {file_path}: {e}")
+            return
+        if self.session_archive is not None:
+            self.session_archive.close()
+        self.session_archive = archive
+        self.plot_data = plot_data
+        self.plot_worker.invalidate()
+
+        plot_settings = dict(session['plot_settings'])
+        plot_settings['line_color'] = QColor(plot_settings.get('line_color', '#0000ff'))
+        self.plot_settings.update(plot_settings)
+        self.integration_settings.update(session['integration_settings'])
+        self.stepsize_input.setText(self.integration_settings['stepsize'])
+
+        paths = session.get('paths', {})
+        self.calib_path = paths.get('calib_path')
+        self.spec_path = paths.get('spec_path')
+        self.image_path = paths.get('image_path')
+        self.output_path = paths.get('output_path')
+        self.calib_path_input.setText(self.calib_path or "")
+        self.spec_path_input.setText(self.spec_path or "")
+        self.image_path_input.setText(self.image_path or "")
+        self.output_path_input.setText((self.output_path or "").rstrip("/"))
+        if self.calib_path and os.path.exists(self.calib_path):
+            self.read_calibration_parameters(self.calib_path)
+        if self.spec_path and os.path.exists(self.spec_path):
+            self.read_user_from_spec(self.spec_path)
+
+        self.plot_model.clear()
+        self.plot_model.add_patterns(session['names'], session.get('dates'))
+        self.plot_model.set_selected(session['selected'])
+        self.replot_selected()
+        self.status_bar.showMessage(f"Loaded session with {len(session['names'])} patterns from {file_path}", 5000)
 
     def read_integrated_data(self, file_path):
         """Read x and y data from the given file."""
@@ -619,14 +1759,14 @@ class PilatusIntegrationGUI(QWidget):
         try:
             f = open(calib_file)
             line = f.readline()
-            db_x = int(line.split()[-1])
+            db_x = float(line.split()[-1])
             line = f.readline()
-            db_y = int(line.split()[-1])
+            db_y = float(line.split()[-1])
             line = f.readline()
             self.det_R = float(line.split()[-1])
             f.close()
             self.db_pixel = [db_x, db_y]
-            self.xyz_map = engine.make_map(self.db_pixel, self.det_R)
+            self.xyz_map = engine.make_map(self.db_pixel, self.det_R, engine.detector_shape(self.integration_settings))
         except Exception as e:
             QMessageBox.warning(self, "Error", f"Error reading parameters from calibration file: {e}")
     
@@ -637,24 +1777,36 @@ class PilatusIntegrationGUI(QWidget):
                 # Multi-scan mode (process one after another)
                 start = int(self.scan_start_input.text())
                 end = int(self.scan_end_input.text())
-                self.process_scans_sequentially(start, end)
+                if self.merge_toggle.isChecked():
+                    self.scan_queue = []  # one merged result, nothing to chain after it
+                    self.start_integration_thread(list(range(start, end + 1)))
+                else:
+                    self.process_scans_sequentially(start, end)
             else:
                 # Single-scan mode
                 scan_num = int(self.scan_number_input.text())
+                self.scan_queue = []
                 self.start_integration_thread(scan_num)
         except ValueError as e:
             QMessageBox.warning(self, "Input Error", f"Invalid scan number: {e}")
             
     def process_scans_sequentially(self, start, end):
         """Process scans one-by-one in the background."""
-        self.current_scan = start
-        self.end_scan = end
-        self.start_integration_thread(self.current_scan)
+        self.process_scan_list(list(range(start, end + 1)))
+
+    def process_scan_list(self, scans):
+        """Integrate a list of scans one after another in the background."""
+        if not scans:
+            return
+        self.scan_queue = list(scans[1:])
+        self.start_integration_thread(scans[0])
         
     def start_integration_thread(self, scan_num):
-        """Start a worker thread for integration."""
-        if self.worker and self.worker.isRunning():
-            self.worker.terminate()  # Stop any existing thread
+        """Start a worker thread for integration, a list of scan numbers is merged into one pattern."""
+        if self.sweep_worker and self.sweep_worker.isRunning():  # it is using the shared engine
+            self.status_bar.showMessage("Wait for the settings sweep to finish", 3000)
+            return
+        self.stop_worker(self.worker)  # Stop any existing thread
 
         # Create a new worker
         self.worker = Integration_worker.IntegrationWorker(
@@ -664,56 +1816,154 @@ class PilatusIntegrationGUI(QWidget):
             user=self.user,
             xyz_map=self.xyz_map,
             settings=self.integration_settings,
-            use_variance=(self.integration_settings["error_model"] == "azimuthal")
+            use_variance=(self.integration_settings["error_model"] == "azimuthal"),
+            integrator=self.integrator,
+            calibration=(self.db_pixel, self.det_R) if self.xyz_map is not None else None
         )
 
         # Connect signals
         self.worker.progress_updated.connect(self.update_status_bar)
+        self.worker.progress_percent.connect(self.progress_bar.setValue)
         self.worker.result_ready.connect(self.handle_integration_result)
+        self.worker.cake_ready.connect(self.handle_cake_result)
         self.worker.error_occurred.connect(self.show_error)
+        self.worker.finished.connect(lambda worker=self.worker: self.integration_finished(worker))
 
         # Start the thread
         self.worker.start()
         
+    def integration_finished(self, worker):
+        """Start the next queued scan once the worker thread has ended, without waiting for its file to be written."""
+        if worker is not self.worker or worker.stopped():  # replaced or stopped, its queue went with it
+            return
+        if self.scan_queue:
+            self.start_integration_thread(self.scan_queue.pop(0))
+
+    def stop_worker(self, worker):
+        """Stop a background worker at its next progress report and wait for it to end.
+
+        Workers share the engine and its worker processes, so they are never terminated.
+        """
+        if worker is not None and worker.isRunning():
+            worker.stop()
+            worker.wait()
+
     def update_status_bar(self, message):
         """Update the GUI status bar (thread-safe)."""
         self.status_bar.showMessage(message)
         
     def handle_integration_result(self, scan_name, x, y, e):
         """Process results when integration finishes."""
-        # Save data to file
-        engine.write_data(self.output_path, scan_name, x, y, e)
+        # Save data to file in the background
+        self.output_writer.write_data(self.output_path, scan_name, x, y, e)
         
         # Update plot data
         self.plot_data[scan_name] = {'x': x, 'y': y, 'e': e}
         
-        # Add to plot list
-        item = QListWidgetItem(scan_name)
-        self.plot_list.addItem(item)
-        item.setSelected(True)
-        
-        # Plot the data
+        # Add to plot list and plot it, batched with any other results that arrive before the GUI is next idle
+        self.queue_pattern(scan_name, selected=True)
+
+    def queue_pattern(self, name, selected=False):
+        """Queue a new pattern for the list, every pattern queued before the event loop is next idle goes in at once."""
+        if not self.pending_patterns:
+            QTimer.singleShot(0, self.flush_pending_patterns)
+        self.pending_patterns.append((name, selected))
+
+    def flush_pending_patterns(self):
+        """Insert the queued patterns in one batch and replot once."""
+        pending, self.pending_patterns = self.pending_patterns, []
+        self.plot_model.add_patterns([name for name, _ in pending])
+        to_select = [name for name, selected in pending if selected]
+        if to_select:
+            if self.overlay_plots:
+                self.plot_model.set_selected(to_select)
+            else:
+                self.plot_model.select_only(to_select[-1])  # single plot mode shows the newest result
         self.replot_selected()
-        
-        # Process next scan in multi-scan mode
-        if hasattr(self, 'current_scan') and self.current_scan < self.end_scan:
-            self.current_scan += 1
-            self.start_integration_thread(self.current_scan)
+
+    def handle_cake_result(self, scan_name, cake):
+        """Save the caked (2-theta x chi) image next to the integrated pattern."""
+        cake_name = os.path.splitext(scan_name)[0] + "_cake.npz"
+        self.output_writer.write_cake(self.output_path, cake_name, cake)
+
+    def open_frame_ledger(self):
+        """Show the frame ledger of the first selected pattern and apply any frames left out or put back."""
+        selected = self.plot_model.selected_names()
+        if not selected:
+            self.status_bar.showMessage("Select an integrated pattern first", 3000)
+            return
+        if (self.worker and self.worker.isRunning()) or (self.sweep_worker and self.sweep_worker.isRunning()):
+            self.status_bar.showMessage("Wait for the running integration to finish", 3000)  # it is using the shared engine
+            return
+        name = selected[0]
+        found = self.integrator.frame_ledger(name)
+        if found is None:
+            QMessageBox.information(self, "Frames", f"No frame ledger is kept for {name}, integrate it again first.")
+            return
+        ledger, flags, weights = found
+        dialog = FrameLedgerDialog(name, ledger, flags, weights, self)
+        if dialog.exec_() != QDialog.Accepted:
+            return
+        x, y, e = self.integrator.reweight_frames(name, dialog.get_weights())
+        excluded = sum(1 for weight in dialog.get_weights().values() if weight == 0)
+        self.output_writer.write_data(self.output_path, name, x, y, e)
+        self.plot_data[name] = {'x': x, 'y': y, 'e': e}
+        self.plot_worker.invalidate([name])
+        self.replot_selected()
+        self.status_bar.showMessage(f"{name}: {excluded} frame(s) excluded", 5000)
+
+    def handle_file_written(self, path):
+        """Report a file the output writer has finished."""
+        self.status_bar.showMessage(f"Saved {os.path.basename(path)}", 3000)
 
     def show_error(self, error_msg):
         """Show error messages in a dialog (thread-safe)."""
         QMessageBox.critical(self, "Error", error_msg)
         
     def closeEvent(self, event):
-        if self.worker and self.worker.isRunning():
-            self.worker.terminate()
-            self.worker.wait()
+        self.scan_queue = []
+        for worker in (self.worker, self.sweep_worker, self.peak_worker, self.calibration_worker):
+            self.stop_worker(worker)
+        if self.roi_window is not None:
+            self.roi_window.stop()
+        self.integrator.close()  # stop worker processes and free shared memory
+        self.output_writer.stop()  # finish writing anything still queued
+        self.plot_worker.stop()
         event.accept()
 
     def replot_selected(self):
-        """Replots selected items, handling both single, overlay, and contour plot modes."""
-        selected_items = self.plot_list.selectedItems()
+        """Replots selected items, handling both single, overlay, and contour plot modes.
+
+        The data work (scaling, contour grids) is handed to the plot worker thread, draw_prepared updates the artists.
+        """
+        selected_items = self.plot_model.selected_names()
         num_selected = len(selected_items)
+        if self.contour_plot and num_selected > 4:
+            mode = 'contour'
+            self.status_bar.showMessage("Generating Contour Plot...", 3000)
+        elif self.waterfall_plot:
+            mode = 'waterfall'
+            self.status_bar.showMessage("Generating Waterfall Plot...", 3000)
+        elif self.overlay_plots:
+            mode = 'overlay'
+            self.status_bar.showMessage("Generating Overlay Plot...", 3000)
+        else:
+            mode = 'single'
+            selected_items = selected_items[:1]
+            self.status_bar.showMessage("Generating Single Plot...", 3000)
+        datasets = {name: self.plot_data[name] for name in selected_items if name in self.plot_data}
+        self.plot_generation = self.plot_worker.request(mode, selected_items, datasets,
+                                                        Plot_worker.scale_mode(self.plot_settings),
+                                                        (self.plot_settings['min_x'], self.plot_settings['max_x']))
+
+    def draw_prepared(self, generation, prepared):
+        """Draw plot data prepared by the plot worker, unless a newer request has been made since."""
+        if generation != self.plot_generation:
+            return
+        self.init_plot_canvas()
+        if prepared['mode'] == 'error':
+            self.status_bar.showMessage(f"Plot error: {prepared['error']}", 5000)
+            return
     
         # Check if a colorbar exists and remove it
         if hasattr(self, 'colorbar') and self.colorbar:
@@ -721,139 +1971,117 @@ class PilatusIntegrationGUI(QWidget):
             self.colorbar = None
     
         self.ax.clear()  # Clear the plot before replotting
+        self.waterfall = None
     
-        if self.contour_plot and num_selected > 4:
+        if prepared['mode'] == 'contour':
             # Contour plot mode:
-            self.status_bar.showMessage("Generating Contour Plot...", 3000)
-            tth_values = []
-            intensity_values = []
-    
-            # Collect x and y data from all selected plots
-            for item in selected_items:
-                plot_name = item.text()
-                if plot_name in self.plot_data:
-                    data = self.plot_data[plot_name]
-                    x, y, e = data['x'], data['y'], data['e']
-                    tth_values.append(x)
-                    # Apply y-axis scaling
-                    if self.plot_settings['sqrt_scale']:
-                        intensity_values.append(np.sqrt(y))
-                    elif self.plot_settings['log_scale']:
-                        intensity_values.append(np.log(y))
-                    else:
-                        intensity_values.append(y)
-    
-            # Create a grid of 2theta and scan number values
-            tth = np.unique(np.concatenate(tth_values))
-            scans = np.arange(1, num_selected + 1) # use scan number as a proxy for scan name
-            tth_grid, scan_grid = np.meshgrid(tth, scans)
-    
-            # Interpolate the intensity values onto the grid
-            intensity_grid = np.zeros_like(tth_grid)
-            for i, (tth_data, intensity_data) in enumerate(zip(tth_values, intensity_values)):
-                interp_func = interpolate.interp1d(tth_data, intensity_data, kind='linear', fill_value="extrapolate")
-                intensity_grid[i, :] = interp_func(tth)
-    
-            # Create the contour plot
+            tth_grid, scan_grid, intensity_grid = prepared['grid']
             contour = self.ax.contourf(tth_grid, scan_grid, intensity_grid, cmap=self.plot_settings['colormap'], levels=20) # change back to viridis when fixed
             self.colorbar = self.fig.colorbar(contour, ax=self.ax, label="Intensity") # save colorbar object
             self.ax.set_xlim(self.plot_settings['min_x'], self.plot_settings['max_x'])
-            #self.fig.colorbar(contour, ax=self.ax, label="Intensity")
     
             self.ax.set_xlabel("2-theta")
             self.ax.set_ylabel("Scan Number")
-            #self.ax.set_title("Contour Plot of Integrated Intensity")
-    
-        elif self.overlay_plots:
-            # Overlay mode: plot all selected items
-            self.status_bar.showMessage("Generating Overlay Plot...", 3000)
-            if selected_items:
-                for item in selected_items:
-                    plot_name = item.text()
-                    if plot_name in self.plot_data:
-                        data = self.plot_data[plot_name]
-                        x, y, e = data['x'], data['y'], data['e']
-    
-                        # Apply y-axis scaling
-                        if self.plot_settings['sqrt_scale']:
-                            y = np.sqrt(y)
-                        elif self.plot_settings['log_scale']:
-                            y = np.log(y)
     
-                        self.ax.plot(x, y, linewidth=self.plot_settings['line_width'],
-                                    linestyle=self.plot_settings['line_style'],
-                                    marker=self.plot_settings['marker'],
-                                    label=plot_name)  # Add label for each plot
+        elif prepared['mode'] == 'waterfall':
+            self.draw_waterfall(prepared)
+
+        elif prepared['lines']:
+            # Overlay mode plots every selected item with a legend, single plot mode only the first one
+            overlay = prepared['mode'] == 'overlay'
+            for plot_name, x, y in prepared['lines']:
+                self.ax.plot(x, y, linewidth=self.plot_settings['line_width'],
+                            linestyle=self.plot_settings['line_style'],
+                            marker=self.plot_settings['marker'],
+                            label=plot_name if overlay else None)  # Add label for each plot
     
-                self.ax.set_xlim(self.plot_settings['min_x'], self.plot_settings['max_x'])
-                self.ax.set_xlabel("2-theta")
+            self.ax.set_xlim(self.plot_settings['min_x'], self.plot_settings['max_x'])
+            self.ax.set_xlabel("2-theta")
     
-                if self.plot_settings['sqrt_scale']:
-                    self.ax.set_ylabel("SQRT(Integrated Intensity)")
-                elif self.plot_settings['log_scale']:
-                    self.ax.set_ylabel("log(Integrated Intensity)")
-                else:
-                    self.ax.set_ylabel("Integrated Intensity")
+            if prepared['scale'] == 'sqrt':
+                self.ax.set_ylabel("SQRT(Integrated Intensity)")
+            elif prepared['scale'] == 'log':
+                self.ax.set_ylabel("log(Integrated Intensity)")
+            else:
+                self.ax.set_ylabel("Integrated Intensity")
     
+            if overlay:
                 self.ax.legend()  # Show legend to distinguish plots
     
-        else:
-            # Single plot mode: plot only the first selected item
-            self.status_bar.showMessage("Generating Single Plot...", 3000)
-            if selected_items:
-                item = selected_items[0]  # Get the first selected item
-                plot_name = item.text()
-                if plot_name in self.plot_data:
-                    data = self.plot_data[plot_name]
-                    x, y, e = data['x'], data['y'], data['e']
-    
-                    # Apply y-axis scaling
-                    if self.plot_settings['sqrt_scale']:
-                        y = np.sqrt(y)
-                    elif self.plot_settings['log_scale']:
-                        y = np.log(y)
-    
-                    self.ax.plot(x, y, linewidth=self.plot_settings['line_width'],
-                                linestyle=self.plot_settings['line_style'],
-                                marker=self.plot_settings['marker'])
-    
-                    self.ax.set_xlim(self.plot_settings['min_x'], self.plot_settings['max_x'])
-                    self.ax.set_xlabel("2-theta")
-    
-                    if self.plot_settings['sqrt_scale']:
-                        self.ax.set_ylabel("SQRT(Integrated Intensity)")
-                    elif self.plot_settings['log_scale']:
-                        self.ax.set_ylabel("log(Integrated Intensity)")
-                    else:
-                        self.ax.set_ylabel("Integrated Intensity")
-    
-        self.canvas.draw()
+        self.canvas.draw_idle()
         
-    def toggle_highlight(self, item):
+    def draw_waterfall(self, prepared):
+        """Draw every prepared waterfall line as one LineCollection, colored along the colormap."""
+        import matplotlib
+        from matplotlib.collections import LineCollection
+        vertices = prepared['vertices']
+        heights = prepared['heights'][prepared['heights'] > 0]
+        colors = matplotlib.colormaps[self.plot_settings['colormap']](np.linspace(0, 1, max(len(vertices), 1)))
+        collection = LineCollection(vertices, colors=colors[:len(vertices)],
+                                    linewidths=self.plot_settings['line_width'],
+                                    linestyles=self.plot_settings['line_style'])
+        self.ax.add_collection(collection)
+        # The sliders rewrite the y column of one vertex buffer from the unshifted y values and hand it back
+        # to the same collection, nothing is rebuilt
+        self.waterfall = {'collection': collection, 'vertices': vertices.copy(),
+                          'y': np.ascontiguousarray(vertices[:, :, 1]),
+                          'height': float(np.median(heights)) if len(heights) else 1.0}
+        self.ax.set_xlim(self.plot_settings['min_x'], self.plot_settings['max_x'])
+        self.ax.set_xlabel("2-theta")
+        self.ax.set_ylabel("Intensity (offset per pattern)")
+        self.ax.set_yticks([])
+        self.update_waterfall()
+        self.status_bar.showMessage(f"Waterfall of {len(vertices)} patterns, first at the bottom", 3000)
+
+    def update_waterfall(self, *args):
+        """Apply the offset and scale sliders to the drawn waterfall without rebuilding it."""
+        if self.waterfall is None:
+            return
+        height = self.waterfall['height']
+        offset = height*self.waterfall_offset_slider.value()/100
+        scale = self.waterfall_scale_slider.value()/100
+        vertices = self.waterfall['vertices']
+        np.multiply(self.waterfall['y'], scale, out=vertices[:, :, 1])
+        vertices[:, :, 1] += offset*np.arange(len(vertices))[:, None]
+        self.waterfall['collection'].set_segments(vertices)
+        margin = 0.05*height*scale
+        self.ax.set_ylim(-margin, offset*max(len(vertices) - 1, 0) + height*scale + margin)
+        self.canvas.draw_idle()
+
+    def toggle_highlight(self, index):
         """Toggle highlight state of the clicked item."""
+        name = self.plot_proxy.data(index, PatternListModel.NameRole)
         if self.overlay_plots:
-            item.setSelected(item.isSelected())  # Toggle selection
-            self.replot_selected()  # Replot to show changes
+            self.plot_model.toggle(name)  # Toggle selection
         else:
-            for index in range(self.plot_list.count()):
-                it = self.plot_list.item(index)
-                if it != item:
-                    it.setSelected(False)  # unselect it
-                else:
-                    it.setSelected(True)  # select this item
-            self.replot_selected()
+            self.plot_model.select_only(name)  # select this item and unselect every other
+        self.replot_selected()  # Replot to show changes
                 
     def toggle_overlay(self, state):
         """Toggle the overlay plots flag."""
         self.overlay_plots = (state == Qt.Checked)
         self.contour_plot_toggle.setEnabled(self.overlay_plots)
         self.contour_plot_toggle.setCheckState(False) # Uncheck contour plot when overlay plot is unchecked
+        self.waterfall_plot_toggle.setEnabled(self.overlay_plots)
+        self.waterfall_plot_toggle.setCheckState(False)
         
     def toggle_contour_plot(self, state):
         """Toggle the contour plots flag."""
         self.contour_plot = (state == Qt.Checked)
+        if self.contour_plot:
+            self.waterfall_plot_toggle.setCheckState(False)  # contour and waterfall are alternative views
         self.status_bar.showMessage(f"Contour plot {'enabled' if self.contour_plot else 'disabled'}", 5000)
 
+    def toggle_waterfall_plot(self, state):
+        """Toggle the waterfall plot flag and redraw the selection."""
+        self.waterfall_plot = (state == Qt.Checked)
+        self.waterfall_controls.setVisible(self.waterfall_plot)
+        if self.waterfall_plot:
+            self.contour_plot_toggle.setCheckState(False)
+        self.status_bar.showMessage(f"Waterfall plot {'enabled' if self.waterfall_plot else 'disabled'}", 5000)
+        if self.plot_model.selected_names():
+            self.replot_selected()
+
     def toggle_scan_input(self, state):
         """Toggle visibility of scan input fields based on checkbox state."""
         use_scan_range = (state == Qt.Checked)
@@ -877,10 +2105,160 @@ class PilatusIntegrationGUI(QWidget):
         dialog = IntegSettingsDialog(self.integration_settings)
         result = dialog.exec_()
         if result == QDialog.Accepted:
+            shape = engine.detector_shape(self.integration_settings)
             self.integration_settings = dialog.get_settings()
             self.stepsize_input.setText(self.integration_settings['stepsize'])
+            if self.xyz_map is not None and engine.detector_shape(self.integration_settings) != shape:
+                self.xyz_map = engine.make_map(self.db_pixel, self.det_R, engine.detector_shape(self.integration_settings))
             self.status_bar.showMessage("Integration settings applied", 3000)
             
+    def open_calibration_refinement(self):
+        """Refine the calibration against a standard's scan, then save and load the refined calibration file."""
+        if self.calibration_worker and self.calibration_worker.isRunning():
+            QMessageBox.warning(self, "Refine Calibration", "Wait for the running refinement to finish first.")
+            return
+        if self.xyz_map is None or not self.spec_path or not self.image_path or not self.user:
+            QMessageBox.warning(self, "Refine Calibration",
+                                "Select a starting calibration file, spec file and image directory first.")
+            return
+        try:
+            scan_num = int(self.scan_number_input.text())
+        except ValueError:
+            scan_num = 1
+        dialog = CalibrationDialog(scan_num, self)
+        if dialog.exec_() != QDialog.Accepted:
+            return
+        refinement = dialog.get_settings()
+        self.calibration_worker = Integration_worker.CalibrationWorker(
+            self.spec_path, refinement['scan_num'], self.image_path, self.user, self.db_pixel, self.det_R,
+            refinement['peaks'], self.integration_settings, window=refinement['window'])
+        self.calibration_worker.progress_percent.connect(self.progress_bar.setValue)
+        self.calibration_worker.result_ready.connect(
+            lambda result: self.handle_calibration_result(result, refinement['output_file']))
+        self.calibration_worker.error_occurred.connect(self.show_error)
+        self.status_bar.showMessage(f"Refining calibration on scan {refinement['scan_num']}...")
+        self.calibration_worker.start()
+
+    def open_settings_sweep(self):
+        """Integrate one scan with several settings from a single pass over its frames and overlay the results."""
+        if self.xyz_map is None or not self.spec_path or not self.image_path or not self.user:
+            QMessageBox.warning(self, "Settings Sweep", "Select a calibration file, spec file and image directory first.")
+            return
+        if (self.worker and self.worker.isRunning()) or (self.sweep_worker and self.sweep_worker.isRunning()):
+            QMessageBox.warning(self, "Settings Sweep", "Wait for the running integration to finish first.")
+            return
+        try:
+            scan_num = int(self.scan_number_input.text())
+        except ValueError:
+            scan_num = 1
+        dialog = SweepDialog(self.integration_settings, scan_num, self)
+        if dialog.exec_() != QDialog.Accepted:
+            return
+        configs = dialog.get_configs()
+        self.sweep_worker = Integration_worker.SweepWorker(
+            self.spec_path, dialog.scan_spinbox.value(), self.image_path, self.user, self.xyz_map, configs,
+            integrator=self.integrator)
+        self.sweep_worker.progress_percent.connect(self.progress_bar.setValue)
+        self.sweep_worker.results_ready.connect(self.handle_sweep_results)
+        self.sweep_worker.error_occurred.connect(self.show_error)
+        self.status_bar.showMessage(f"Sweeping {len(configs)} configurations on scan {dialog.scan_spinbox.value()}...")
+        self.sweep_worker.start()
+
+    def handle_sweep_results(self, results):
+        """Save every configuration's pattern and overlay just these for comparison."""
+        self.plot_model.set_selected(self.plot_model.selected_names(), False)
+        if not self.overlay_plots:
+            self.overlay_toggle.setChecked(True)
+        for name, x, y, e in results:
+            self.output_writer.write_data(self.output_path, name, x, y, e)
+            self.plot_data[name] = {'x': x, 'y': y, 'e': e}
+            self.plot_worker.invalidate([name])
+            self.queue_pattern(name, selected=True)
+        self.status_bar.showMessage(f"Settings sweep finished, {len(results)} patterns", 5000)
+
+    def open_peak_tracking(self):
+        """Fit 2-theta windows through the selected patterns (or integrated files) and show the results live."""
+        if self.peak_worker and self.peak_worker.isRunning():
+            QMessageBox.warning(self, "Track Peaks", "Wait for the running peak tracking to finish first.")
+            return
+        selected = [name for name in self.plot_model.selected_names() if name in self.plot_data]
+        dialog = PeakTrackDialog(selected, self)
+        if dialog.exec_() != QDialog.Accepted:
+            return
+        windows = dialog.windows()
+        if dialog.files_radio.isChecked():
+            try:
+                patterns = [(os.path.basename(path),) + Integration_peaks.read_xye(path) for path in dialog.files]
+            except (OSError, ValueError) as e:
+                QMessageBox.critical(self, "Error", f"Could not read the integrated files: {e}")
+                return
+        else:
+            patterns = [(name, self.plot_data[name]['x'], self.plot_data[name]['y'], self.plot_data[name]['e'])
+                        for name in selected]
+        if self.peak_window is not None:
+            self.peak_window.close()
+        self.peak_window = PeakTrackWindow(windows, self)
+        self.peak_window.show()
+        self.peak_worker = Integration_worker.PeakTrackWorker(patterns, windows,
+                                                              self.integration_settings.get('processes', 1))
+        self.peak_worker.rows_ready.connect(self.peak_window.add_rows)
+        self.peak_worker.finished_rows.connect(self.peak_window.set_rows)
+        self.peak_worker.progress_percent.connect(self.progress_bar.setValue)
+        self.peak_worker.error_occurred.connect(self.show_error)
+        self.status_bar.showMessage(f"Tracking {len(windows)} peaks through {len(patterns)} patterns...")
+        self.peak_worker.start()
+
+    def open_roi_monitor(self):
+        """Show the ROI monitor window (one per session, it keeps its windows and strip chart between uses)."""
+        if self.roi_window is None:
+            try:
+                scan_num = int(self.scan_number_input.text())
+            except ValueError:
+                scan_num = 1
+            self.roi_window = RoiMonitorWindow(self, scan_num)
+        self.roi_window.show()
+        self.roi_window.raise_()
+
+    def open_complete_scans(self):
+        """List the scans of the SPEC file against the frames on disk and queue the complete, unintegrated ones."""
+        if self.xyz_map is None or not self.spec_path or not self.image_path or not self.user:
+            QMessageBox.warning(self, "Complete Scans", "Select a calibration file, spec file and image directory first.")
+            return
+        if self.image_index is None or self.image_index.image_path != self.image_path:
+            self.image_index = Integration_index.ImageIndex(self.image_path)
+        try:
+            rows = self.image_index.scan_status(self.spec_path, self.user, self.output_path)
+        except OSError as e:
+            QMessageBox.critical(self, "Error", f"Could not index the image directory: {e}")
+            return
+        dialog = ScanIndexDialog(rows, self)
+        if dialog.exec_() != QDialog.Accepted:
+            return
+        scans = dialog.checked_scans()
+        if scans:
+            self.status_bar.showMessage(f"Integrating {len(scans)} scans...")
+            self.process_scan_list(scans)
+
+    def handle_calibration_result(self, result, output_file):
+        """Write the refined calibration and switch to it."""
+        try:
+            engine.write_calibration(output_file, result['db_pixel'], result['det_R'])
+            engine.Read_Cal(output_file)  # make sure it reads back before leaving the current calibration
+        except (OSError, ValueError) as e:
+            self.show_error(f"Could not save the refined calibration to {output_file}: {e}")
+            return
+        self.calib_path_input.setText(output_file)
+        self.calib_path = output_file
+        self.read_calibration_parameters(output_file)
+        esd = result['esd']
+        self.status_bar.showMessage("Calibration refined", 5000)
+        QMessageBox.information(self, "Refine Calibration",
+                                f"db_x = {result['db_pixel'][0]:.3f} ({esd[0]:.3f})\n"
+                                f"db_y = {result['db_pixel'][1]:.3f} ({esd[1]:.3f})\n"
+                                f"det_R = {result['det_R']:.2f} ({esd[2]:.2f})\n"
+                                f"{result['pixels']} peak pixels, rms residual {result['rms']:.4f} deg\n"
+                                f"Saved to {output_file}")
+
     def show_about_dialog(self):
         """Show the about dialog with program description and icon."""
         dialog = AboutDialog(self)
@@ -903,6 +2281,7 @@ class PilatusIntegrationGUI(QWidget):
     
         if reply == QMessageBox.Yes:
             # Clear the plot
+            self.init_plot_canvas()
             self.ax.clear()
             self.canvas.draw()
     
@@ -924,15 +2303,26 @@ class PilatusIntegrationGUI(QWidget):
             self.scan_range_container.setVisible(False)
     
             # Clear plot data
-            self.plot_list.clear() # clear items from plot list
+            self.plot_model.clear() # clear items from plot list
+            self.pending_patterns = []
             self.plot_data = {}    # clear stored plot data
+            self.plot_worker.invalidate()
+            if self.session_archive is not None:
+                self.session_archive.close()
+                self.session_archive = None
     
             # Status bar message
             self.status_bar.showMessage("Data cleared, ready for a fresh start!", 5000)
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # lets the frozen executable start binning worker processes
     app = QApplication(sys.argv)
     app.setStyle(QStyleFactory.create('Fusion')) # Set Fusion style
     ex = PilatusIntegrationGUI()
     ex.show()
+    if '--startup-timing' in sys.argv:
+        def report_startup():
+            _startup_marks.append(("idle", time.perf_counter()))
+            print(startup_report())
+        QTimer.singleShot(0, report_startup)  # queued behind init_plot_canvas, so this runs once everything is built
     sys.exit(app.exec_())
\ No newline at end of file
@@ -1,16 +1,28 @@
 # -*- mode: python ; coding: utf-8 -*-
 
+# Startup-optimized build: a one-folder bundle (nothing is unpacked to a temp directory on every launch),
+# no UPX (compressed binaries have to be decompressed at load time) and only the Qt/matplotlib pieces the GUI uses.
 
 a = Analysis(
     ['Pilatus_Integration_GUI.py'],
     pathex=[],
     binaries=[],
     datas=[('icon.png', '.'), ('icon_100x100.png', '.')],
-    hiddenimports=[],
+    hiddenimports=['Integration_shared', 'Integration_server'],  # imported lazily (worker processes, integration server)
     hookspath=[],
-    hooksconfig={},
+    hooksconfig={
+        'matplotlib': {'backends': ['Qt5Agg']},  # bundle only the backend the GUI uses
+    },
     runtime_hooks=[],
-    excludes=[],
+    excludes=[
+        'tkinter', '_tkinter',
+        'IPython', 'jupyter', 'notebook', 'pytest',
+        'PyQt5.QtWebEngine', 'PyQt5.QtWebEngineCore', 'PyQt5.QtWebEngineWidgets',
+        'PyQt5.QtQml', 'PyQt5.QtQuick', 'PyQt5.QtQuickWidgets', 'PyQt5.QtMultimedia',
+        'PyQt5.QtMultimediaWidgets', 'PyQt5.QtBluetooth', 'PyQt5.QtLocation', 'PyQt5.QtPositioning',
+        'PyQt5.QtSensors', 'PyQt5.QtSerialPort', 'PyQt5.QtSql', 'PyQt5.QtTest', 'PyQt5.Qt3DCore',
+        'PyQt5.QtDesigner', 'PyQt5.QtXmlPatterns',
+    ],
     noarchive=False,
     optimize=0,
 )
@@ -19,16 +31,13 @@ pyz = PYZ(a.pure)
 exe = EXE(
     pyz,
     a.scripts,
-    a.binaries,
-    a.datas,
     [],
+    exclude_binaries=True,
     name='Pilatus_Integration_GUI',
     debug=False,
     bootloader_ignore_signals=False,
     strip=False,
-    upx=True,
-    upx_exclude=[],
-    runtime_tmpdir=None,
+    upx=False,
     console=False,
     disable_windowed_traceback=False,
     argv_emulation=False,
@@ -37,3 +46,13 @@ exe = EXE(
     entitlements_file=None,
     icon=['icon.jpg'],
 )
+
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=False,
+    upx_exclude=[],
+    name='Pilatus_Integration_GUI',
+)
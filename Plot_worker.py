@@ -0,0 +1,179 @@
+import queue
+import numpy as np
+from PyQt5.QtCore import QThread, pyqtSignal
+
+
+class PlotCancelled(Exception):
+    """Raised inside the worker when a newer plot request has replaced the one being prepared."""
+
+
+def scale_mode(plot_settings):
+    """Name of the y-axis scaling selected in the plot settings ('sqrt', 'log' or 'linear')."""
+    if plot_settings['sqrt_scale']:
+        return 'sqrt'
+    if plot_settings['log_scale']:
+        return 'log'
+    return 'linear'
+
+
+def scale_intensity(y, mode):
+    """Apply the y-axis scaling for a scale mode."""
+    if mode == 'sqrt':
+        return np.sqrt(y)
+    if mode == 'log':
+        return np.log(y)
+    return y
+
+
+def decimate(x, y, max_points):
+    """Reduce a pattern to at most max_points vertices, keeping the minimum and maximum of every bucket so peaks survive."""
+    n = len(x)
+    if n <= max_points:
+        return x, y
+    buckets = max(max_points//2, 1)
+    size = -(-n//buckets)
+    padded = np.concatenate([y, np.full(buckets*size - n, y[-1])]).reshape(buckets, size)
+    base = np.arange(buckets)*size
+    imin = np.minimum(base + np.argmin(padded, axis=1), n - 1)
+    imax = np.minimum(base + np.argmax(padded, axis=1), n - 1)
+    # min and max of a bucket are drawn in the order they occur
+    index = np.column_stack((np.minimum(imin, imax), np.maximum(imin, imax))).ravel()
+    return x[index], y[index]
+
+
+class PlotPrepWorker(QThread):
+    """Prepares plot data (scaling, contour grids, waterfall lines) away from the GUI thread.
+
+    Only the newest request is worked on, anything queued behind it or superseded while it runs is dropped.
+    Scaled arrays are cached per (pattern, scale mode) until the pattern is invalidated, and only for the patterns,
+    scale and x-range of the last plot prepared, so the cache never holds more than what is on screen.
+    """
+    plot_ready = pyqtSignal(int, object)  # generation, prepared plot dict
+    waterfall_points = 2000  # vertices per waterfall line, about one per screen pixel column
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._requests = queue.Queue()
+        self._generation = 0
+        self._cache = {}  # (name, scale mode[, 'waterfall', xlim]) -> (source data mapping, arrays...)
+        self._used = set()  # cache keys read by the plot being prepared
+
+    def request(self, mode, names, datasets, scale, xlim=None):
+        """Queue a plot for the given selected names and return its generation number.
+
+        datasets maps each name to its {'x', 'y', 'e'} mapping, only this snapshot is read by the worker.
+        xlim is the visible 2-theta range, waterfall lines are cropped to it before decimating.
+        """
+        self._generation += 1
+        self._requests.put((self._generation, mode, list(names), dict(datasets), scale, xlim))
+        return self._generation
+
+    def invalidate(self, names=None):
+        """Forget cached arrays for some patterns (or all of them) after their data changes."""
+        if names is None:
+            self._cache = {}
+            return
+        names = set(names)
+        self._cache = {key: value for key, value in self._cache.items() if key[0] not in names}
+
+    def stop(self):
+        self._requests.put(None)
+        self.wait()
+
+    def run(self):
+        """Runs in the background thread."""
+        while True:
+            request = self._requests.get()
+            try:
+                while True:  # skip straight to the newest request
+                    newer = self._requests.get_nowait()
+                    if newer is None:
+                        return
+                    request = newer
+            except queue.Empty:
+                pass
+            if request is None:
+                return
+            generation = request[0]
+            self._used = set()
+            try:
+                prepared = self.prepare(*request)
+            except PlotCancelled:
+                continue
+            except Exception as e:
+                prepared = {'mode': 'error', 'error': str(e)}
+            else:
+                # drop what this plot did not use: deselected patterns, other scale modes and old x-ranges
+                self._cache = {key: value for key, value in self._cache.items() if key in self._used}
+            self.plot_ready.emit(generation, prepared)
+
+    def _check(self, generation):
+        if generation != self._generation:
+            raise PlotCancelled()
+
+    def scaled(self, generation, name, data, scale):
+        """Cached (x, scaled y) for one pattern."""
+        self._check(generation)
+        key = (name, scale)
+        self._used.add(key)
+        cached = self._cache.get(key)
+        if cached is None or cached[0] is not data:  # a re-integrated pattern comes with a new data mapping
+            cached = (data, np.asarray(data['x']), scale_intensity(np.asarray(data['y']), scale))
+            self._cache[key] = cached
+        return cached[1:]
+
+    def decimated(self, generation, name, data, scale, xlim):
+        """Cached (segment, height) for one waterfall line.
+
+        The segment is an (n, 2) vertex array cropped to xlim, decimated and shifted so its minimum sits at zero.
+        """
+        key = (name, scale, 'waterfall', xlim)
+        self._used.add(key)
+        cached = self._cache.get(key)
+        if cached is None or cached[0] is not data:
+            x, y = self.scaled(generation, name, data, scale)
+            if xlim is not None:
+                i0 = max(np.searchsorted(x, xlim[0]) - 1, 0)
+                i1 = np.searchsorted(x, xlim[1], side='right') + 1
+                x, y = x[i0:i1], y[i0:i1]
+            y = np.where(np.isfinite(y), y, np.nan)  # log(0) leaves a gap rather than an infinite vertex
+            if len(x):
+                x, y = decimate(x, y, self.waterfall_points)
+            finite = y[np.isfinite(y)]
+            low, high = (finite.min(), finite.max()) if len(finite) else (0.0, 0.0)
+            cached = (data, np.column_stack((x, y - low)), high - low)
+            self._cache[key] = cached
+        return cached[1:]
+
+    def prepare(self, generation, mode, names, datasets, scale, xlim=None):
+        names = [name for name in names if name in datasets]
+        if mode == 'single':
+            names = names[:1]
+        if mode == 'waterfall':
+            lines = [self.decimated(generation, name, datasets[name], scale, xlim) for name in names]
+            # One (lines, vertices, 2) block, shorter lines padded with NaN (not drawn), so the GUI can shift
+            # every line with a single array operation
+            vertices = np.full((len(lines), max([len(segment) for segment, _ in lines], default=0), 2), np.nan)
+            for i, (segment, _) in enumerate(lines):
+                vertices[i, :len(segment)] = segment
+            self._check(generation)
+            return {'mode': mode, 'scale': scale, 'names': names, 'vertices': vertices,
+                    'heights': np.array([height for _, height in lines])}
+        lines = [(name,) + self.scaled(generation, name, datasets[name], scale) for name in names]
+        prepared = {'mode': mode, 'scale': scale, 'lines': lines}
+        if mode == 'contour' and lines:
+            from scipy import interpolate  # deferred from startup, only the contour plot needs it
+            # Create a grid of 2theta and scan number values
+            tth = np.unique(np.concatenate([x for _, x, _ in lines]))
+            scans = np.arange(1, len(lines) + 1)  # use scan number as a proxy for scan name
+            tth_grid, scan_grid = np.meshgrid(tth, scans)
+            # Interpolate the intensity values onto the grid
+            intensity_grid = np.zeros_like(tth_grid)
+            for i, (_, tth_data, intensity_data) in enumerate(lines):
+                self._check(generation)
+                interp_func = interpolate.interp1d(tth_data, intensity_data, kind='linear', fill_value="extrapolate")
+                intensity_grid[i, :] = interp_func(tth)
+            prepared['grid'] = (tth_grid, scan_grid, intensity_grid)
+            prepared['lines'] = []
+        self._check(generation)
+        return prepared